@@ -1,7 +1,159 @@
+import os
+import re
+import json
+import hashlib
+from bids import BIDSLayout
+from .cache import get_cache_dir
 
 
+def _fingerprint(root, exclude=()):
+    """Compute a fingerprint of the files of a directory tree from their path, mtime and size.
+
+    Only `lstat` is used, so that the files of a datalad dataset don't have to be fetched, and the
+    directories in `exclude` (relative to `root`) as well as hidden ones are skipped.
+    """
+    sha1 = hashlib.sha1()
+    stack = [root]
+    while stack:
+        entries = sorted(os.scandir(stack.pop()), key=lambda entry: entry.name)
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            relpath = os.path.relpath(entry.path, root)
+            if entry.is_dir(follow_symlinks=False):
+                if relpath not in exclude:
+                    stack.append(entry.path)
+                continue
+            stat = entry.stat(follow_symlinks=False)
+            sha1.update("{}\0{}\0{}\n".format(relpath, stat.st_mtime_ns, stat.st_size).encode())
+    return sha1.hexdigest()
+
+
+def _layout_key(kwargs):
+    """Identify the parameters of a BIDSLayout, including the options of objects like indexers."""
+
+    def default(value):
+        if isinstance(value, re.Pattern):
+            return value.pattern
+        if hasattr(value, "__dict__"):
+            options = {name: option for name, option in vars(value).items() if name[0] != "_"}
+            return [type(value).__name__, options]
+        return repr(value)
+
+    return hashlib.sha1(json.dumps(kwargs, sort_keys=True, default=default).encode()).hexdigest()
+
+
+def _open_layout(root, database_path, exclude=(), **kwargs):
+    """Open a BIDSLayout indexed in a database, indexed again if its files or options changed."""
+    fingerprint_path = os.path.join(database_path, "fingerprint.json")
+    fingerprint = [_fingerprint(root, exclude), _layout_key(kwargs)]
+    try:
+        with open(fingerprint_path) as f:
+            stale = json.load(f) != fingerprint
+    except (FileNotFoundError, ValueError):
+        stale = True
+    layout = BIDSLayout(root, database_path=database_path, reset_database=stale, **kwargs)
+    if stale:
+        os.makedirs(database_path, exist_ok=True)
+        with open(fingerprint_path, "w") as f:
+            json.dump(fingerprint, f)
+    return layout
+
 
 class BaseLoader(object):
+    """Base class of the loaders, giving access to the pybids layout of a BIDS dataset.
+
+    Indexing a large dataset with pybids takes minutes, so the layout is saved in a database in
+    the cache and reused as long as none of the files of the dataset changed, according to their
+    modification time and size, and the parameters of the layout are the same. The raw dataset
+    and each derivatives dataset have their own database, so that a change in a derivative
+    doesn't trigger the indexing of the raw dataset, and the derivatives are only indexed when
+    they are first used.
+
+    Parameters
+    ----------
+    root : str
+        Path to the root of the BIDS dataset.
+    derivatives : bool or list of str
+        Paths to the derivatives datasets. If True, the datasets with a dataset_description.json
+        file in the derivatives folder of the dataset are used. Default is True.
+    cache_dir : str
+        Directory where the layout databases are saved. If None, a directory in the
+        bids_loader cache, see `bids_loader.cache.get_cache_dir`, is used. Default is None.
+    validate : bool
+        Whether to validate the files of the raw dataset, see `bids.BIDSLayout`. Default is False.
+    **kwargs
+        Other parameters passed to `bids.BIDSLayout` for the raw dataset.
+    """
+
+    def __init__(self, root, derivatives=True, cache_dir=None, validate=False, **kwargs):
+        self.root = os.path.abspath(root)
+        if cache_dir is None:
+            root_hash = hashlib.sha1(self.root.encode()).hexdigest()
+            cache_dir = os.path.join(get_cache_dir(), "layouts", root_hash)
+        self.cache_dir = cache_dir
+        self._derivatives_paths = derivatives
+        self._layout_kwargs = dict(kwargs, validate=validate)
+        self._layout = None
+        self._derivatives = {}
+
+    @property
+    def layout(self):
+        """Layout of the raw dataset, without the derivatives."""
+        if self._layout is None:
+            self._layout = _open_layout(
+                self.root,
+                os.path.join(self.cache_dir, "raw"),
+                # folders that are not indexed by pybids
+                exclude=("code", "derivatives", "models", "sourcedata", "stimuli"),
+                **self._layout_kwargs
+            )
+        return self._layout
+
+    @property
+    def derivatives_paths(self):
+        """Paths to the derivatives datasets, by name."""
+        paths = self._derivatives_paths
+        if paths is True:
+            derivatives_dir = os.path.join(self.root, "derivatives")
+            paths = []
+            if os.path.isdir(derivatives_dir):
+                for entry in sorted(os.scandir(derivatives_dir), key=lambda entry: entry.name):
+                    if os.path.exists(os.path.join(entry.path, "dataset_description.json")):
+                        paths.append(entry.path)
+        elif not paths:
+            paths = []
+        return {os.path.basename(os.path.normpath(path)): path for path in paths}
+
+    def get_derivatives(self, name):
+        """Get the layout of a derivatives dataset, indexing it at first use.
+
+        Parameters
+        ----------
+        name : str
+            Name of the derivatives dataset, i.e. of its folder, e.g. "fmriprep".
+
+        Returns
+        -------
+        bids.BIDSLayout
+            Layout of the derivatives dataset.
+        """
+        if name not in self._derivatives:
+            paths = self.derivatives_paths
+            if name not in paths:
+                raise ValueError(
+                    "Unknown derivatives {}, must be one of {}.".format(name, sorted(paths))
+                )
+            self._derivatives[name] = _open_layout(
+                os.path.abspath(paths[name]),
+                os.path.join(self.cache_dir, "derivatives", name),
+                validate=False,
+                is_derivative=True,
+                config=["bids", "derivatives"],
+            )
+        return self._derivatives[name]
 
-    def __init__(self, **kwargs):
-        pass
+    @property
+    def derivatives(self):
+        """Layouts of all the derivatives datasets, by name."""
+        return {name: self.get_derivatives(name) for name in self.derivatives_paths}
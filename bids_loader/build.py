@@ -0,0 +1,458 @@
+import os
+import glob
+import json
+import zipfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from . import __version__
+from .base import BaseLoader
+from .cache import hash_file, hash_key
+
+#: Extensions of the video stimuli.
+VIDEO_EXTENSIONS = (".mkv", ".mp4", ".avi", ".mov")
+
+
+def build_game_replay(output_path, bk2_path, *integration_files, integration_paths=(), **kwargs):
+    """Replay a bk2 file and save the arrays of the replay in a .npz file.
+
+    The `integration_files` of the game, e.g. its rom.sha and data.json files, are not read, they
+    are only inputs of the target so that the replay is built again when they change.
+    """
+    # the dependencies of each kind of target are only needed to build it
+    from .stimuli.game import register_integrations, replay_bk2_array
+
+    for integration_path in integration_paths:
+        register_integrations(integration_path)
+    arrays = replay_bk2_array(bk2_path, **kwargs).to_arrays()
+    with open(output_path, "wb") as f:
+        np.savez(f, **arrays)
+
+
+def build_masked_bold(output_path, bold_path, mask_path, chunk_size=64):
+    """Save the timeseries of the voxels of a mask in a BOLD run in a .npy file.
+
+    The voxels are gathered from the NIfTI file one chunk of volumes at a time, without
+    decompressing the whole run in the cache as `MRILoader.open_bold` does.
+    """
+    import nibabel as nib
+    from .mri import MRILoader, _is_scaled
+
+    img = nib.load(bold_path, keep_file_open=True)
+    shape, n_volumes = img.shape[:3], img.shape[3]
+    loader = MRILoader(os.path.dirname(bold_path), derivatives=False)
+    indices = loader.get_mask_indices(mask_path, shape, img.affine)
+    dtype = np.float32 if _is_scaled(img) else img.get_data_dtype()
+    masked = np.lib.format.open_memmap(
+        output_path, mode="w+", dtype=dtype, shape=(n_volumes, len(indices))
+    )
+    for start in range(0, n_volumes, chunk_size):
+        stop = min(start + chunk_size, n_volumes)
+        chunk = img.dataobj[..., start:stop].reshape((-1, stop - start), order="F")
+        masked[start:stop] = chunk[indices].T
+    masked.flush()
+
+
+def build_physio_features(output_path, physio_path, sidecar_path, tr, **kwargs):
+    """Compute the physio features of each volume of a run and save them in a .npz file."""
+    from .physio import PhysioRun, read_physio
+
+    with open(sidecar_path) as f:
+        sidecar = json.load(f)
+    data = np.concatenate(list(read_physio(physio_path, sidecar["Columns"])))
+    run = PhysioRun(
+        np.asfortranarray(data),
+        sidecar["Columns"],
+        float(sidecar["SamplingFrequency"]),
+        float(sidecar.get("StartTime", 0.0)),
+        physio_path,
+    )
+    features, names = run.features(tr, **kwargs)
+    with open(output_path, "wb") as f:
+        np.savez(f, features=features, names=np.array(names, dtype=str))
+
+
+def build_video_frames(output_path, video_path, cache=None, **kwargs):
+    """Decode the frames of a video shown at given times and save them in a .npy file."""
+    from .stimuli.video import VideoLoader, _frame_shape
+
+    loader = VideoLoader(cache)
+    index = loader.get_index(video_path)
+    selection = {
+        option: kwargs.get(option) for option in ("frame_stride", "target_fps", "tr", "onsets")
+    }
+    shape = _frame_shape(
+        index, kwargs.get("size"), kwargs.get("format", "rgb24"), kwargs.get("crop")
+    )
+    frames = np.lib.format.open_memmap(
+        output_path,
+        mode="w+",
+        dtype=np.uint8,
+        shape=(len(index.select_frames(**selection)),) + shape,
+    )
+    loader.load_frames(video_path, out=frames, **kwargs)
+    frames.flush()
+
+
+def _bk2_game(bk2_path):
+    """Read the name of the game of a bk2 movie from its header, without gym-retro."""
+    with zipfile.ZipFile(bk2_path) as archive:
+        header = archive.read("Header.txt").decode()
+    for line in header.splitlines():
+        key, _, value = line.partition(" ")
+        if key == "GameName":
+            return value.strip()
+    return None
+
+
+def _game_inputs(bk2_path, integrations, scenario=None):
+    """Find the files of the integration of a bk2 file its replay depends on, as `retro.make`."""
+    integration_path = integrations.get(_bk2_game(bk2_path))
+    if integration_path is None:
+        return []
+    if scenario is None:
+        scenario = "scenario"
+    if not scenario.endswith(".json"):
+        scenario = os.path.join(integration_path, scenario + ".json")
+    paths = [os.path.join(integration_path, name) for name in ("rom.sha", "data.json")]
+    return [path for path in paths + [scenario] if os.path.exists(path)]
+
+
+def _find_mask(layout, bold, space):
+    """Find the brain mask of a BOLD run, of the run itself or else of its subject."""
+    entities = bold.get_entities()
+    masks = layout.get(
+        suffix="mask",
+        desc="brain",
+        space=space,
+        extension=[".nii", ".nii.gz"],
+        subject=entities["subject"],
+    )
+    keys = ("session", "task", "acquisition", "run")
+    run_masks = [
+        mask
+        for mask in masks
+        if all(mask.get_entities().get(key) == entities.get(key) for key in keys)
+    ]
+    subject_masks = [
+        mask
+        for mask in masks
+        if mask.get_entities().get("session") in (None, entities.get("session"))
+        and "task" not in mask.get_entities()
+    ]
+    for mask in run_masks + subject_masks:
+        return mask.path
+    return None
+
+
+class Target(object):
+    """Derivative built from input files by a function.
+
+    Parameters
+    ----------
+    output : str
+        Path to the output file of the target.
+    func : callable
+        Function building the target, called as `func(output_path, *inputs, **params)`. It must
+        be defined at the top level of a module to be run in worker processes.
+    inputs : list of str
+        Paths to the input files of the target.
+    params : dict
+        JSON-serializable parameters of the target. Default is None, for no parameters.
+    """
+
+    def __init__(self, output, func, inputs, params=None):
+        self.output = os.path.abspath(output)
+        self.func = func
+        self.inputs = [os.path.abspath(path) for path in inputs]
+        self.params = params or {}
+
+    def __repr__(self):
+        return "Target({!r})".format(self.output)
+
+
+def _run_target(target, tmp_path):
+    target.func(tmp_path, *target.inputs, **target.params)
+    return target
+
+
+class Builder(object):
+    """Incremental builder of dataset-wide derivatives.
+
+    The manifest of the builder records, for each target it built, the hashes of its inputs, its
+    parameters, the function building it and the version of bids_loader. A target is only built
+    again if it is stale, i.e. if its output is missing or if any of these changed, e.g. when a
+    new session is added to the dataset or a parameter changes. The hash of an input is reused as
+    long as its modification time and size don't change, so that unchanged files are not read
+    again. The stale targets are independent, and are built in parallel over worker processes.
+
+    Example
+    -------
+    ```
+    builder = Builder("derivatives/bids_loader", n_jobs=8)
+    targets = plan_dataset("cneuromod/shinobi", "derivatives/bids_loader", tr=1.49)
+    built = builder.build(targets)
+    ```
+
+    Parameters
+    ----------
+    path : str
+        Directory of the manifest, "manifest.json".
+    n_jobs : int
+        Number of worker processes. If None, the number of CPUs is used. If 1, the targets are
+        built one after the other in the calling process. Default is None.
+    """
+
+    def __init__(self, path, n_jobs=None):
+        self.path = os.path.abspath(path)
+        self.n_jobs = n_jobs
+        self.manifest_path = os.path.join(self.path, "manifest.json")
+        try:
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {"targets": {}, "hashes": {}}
+
+    def _hash_input(self, path):
+        """Hash an input file, reusing its previous hash if its mtime and size didn't change."""
+        stat = os.stat(path)
+        previous = self.manifest["hashes"].get(path)
+        if previous is not None and previous[:2] == [stat.st_mtime_ns, stat.st_size]:
+            return previous[2]
+        sha1 = hash_file(path)
+        self.manifest["hashes"][path] = [stat.st_mtime_ns, stat.st_size, sha1]
+        return sha1
+
+    def _record(self, target):
+        return {
+            "inputs": {path: self._hash_input(path) for path in target.inputs},
+            "params": hash_key(target.params),
+            "func": "{}.{}".format(target.func.__module__, target.func.__qualname__),
+            "version": __version__,
+        }
+
+    def is_stale(self, target):
+        """Whether a target must be built, see `Builder`."""
+        if not os.path.exists(target.output):
+            return True
+        return self.manifest["targets"].get(target.output) != self._record(target)
+
+    def _save_manifest(self):
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _done(self, target, tmp_path):
+        os.replace(tmp_path, target.output)
+        self.manifest["targets"][target.output] = self._record(target)
+        self._save_manifest()
+
+    def build(self, targets, progress=None):
+        """Build the stale targets.
+
+        Each target is written to a temporary file which is only moved to its output once it is
+        complete, and the manifest is saved after each target, so that an interrupted build can
+        be resumed.
+
+        Parameters
+        ----------
+        targets : list of Target
+            Targets to build if they are stale.
+        progress : callable
+            Function called with each target once it is built. Default is None.
+
+        Returns
+        -------
+        list of Target
+            Targets that were built.
+
+        Raises
+        ------
+        RuntimeError
+            If some targets failed, once all the others are built.
+        """
+        stale = [target for target in targets if self.is_stale(target)]
+        tmp_paths = {}
+        for target in stale:
+            dirname, basename = os.path.split(target.output)
+            os.makedirs(dirname, exist_ok=True)
+            tmp_paths[target.output] = os.path.join(dirname, ".tmp-" + basename)
+        built = []
+        failed = []
+
+        def done(target):
+            self._done(target, tmp_paths[target.output])
+            built.append(target)
+            if progress is not None:
+                progress(target)
+
+        try:
+            if self.n_jobs == 1:
+                for target in stale:
+                    try:
+                        _run_target(target, tmp_paths[target.output])
+                    except Exception as error:
+                        failed.append((target, error))
+                        continue
+                    done(target)
+            elif stale:
+                # spawn, as gym-retro only allows one emulator per process
+                context = multiprocessing.get_context("spawn")
+                with ProcessPoolExecutor(self.n_jobs, mp_context=context) as executor:
+                    futures = {
+                        executor.submit(_run_target, target, tmp_paths[target.output]): target
+                        for target in stale
+                    }
+                    for future in as_completed(futures):
+                        try:
+                            future.result()
+                        except Exception as error:
+                            failed.append((futures[future], error))
+                            continue
+                        done(futures[future])
+        finally:
+            self._save_manifest()
+            for tmp_path in tmp_paths.values():
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        if failed:
+            raise RuntimeError(
+                "Failed to build {} of {} targets:\n{}".format(
+                    len(failed),
+                    len(stale),
+                    "\n".join("{}: {!r}".format(target.output, error) for target, error in failed),
+                )
+            ) from failed[0][1]
+        return built
+
+
+def plan_dataset(
+    root,
+    output_dir,
+    tr=None,
+    fmriprep="fmriprep",
+    space="MNI152NLin2009cAsym",
+    replay_params=None,
+    physio_params=None,
+    video_params=None,
+):
+    """List the targets of the usual derivatives of a BIDS dataset.
+
+    The targets are, in `output_dir`:
+
+    - "game/<path of the bk2 file>.npz": arrays of the replay of each bk2 file of the dataset, see
+      `replay_bk2_array`, with the integrations of the stimuli folder of the dataset, see
+      `register_integrations`,
+    - "bold/<path of the run in fMRIPrep>.npy": timeseries of the voxels of the brain mask of each
+      preprocessed BOLD run of fMRIPrep in `space`,
+    - "physio/<path of the recording>.npz": physio features of each volume of each recording,
+      see `physio_features`, if `tr` is set,
+    - "video/<path of the video>.npy": frames of each video of the stimuli folder of the dataset,
+      shown at each TR if `tr` is set.
+
+    Parameters
+    ----------
+    root : str
+        Path to the root of the BIDS dataset.
+    output_dir : str
+        Directory of the derivatives.
+    tr : float
+        Repetition time of the runs. Default is None.
+    fmriprep : str
+        Name of the fMRIPrep derivatives dataset. Default is "fmriprep".
+    space : str
+        Space of the BOLD runs and masks. Default is "MNI152NLin2009cAsym".
+    replay_params, physio_params, video_params : dict
+        Parameters of the replays, physio features and videos, see `build_game_replay`,
+        `build_physio_features` and `build_video_frames`. Default is None.
+
+    Returns
+    -------
+    list of Target
+        Targets of the dataset.
+    """
+    root = os.path.abspath(root)
+    output_dir = os.path.abspath(output_dir)
+    loader = BaseLoader(root)
+    targets = []
+
+    def output(kind, path, extension, base=root):
+        relpath = os.path.relpath(path, base)
+        for suffix in (".nii.gz", ".tsv.gz"):
+            if relpath.endswith(suffix):
+                relpath = relpath[: -len(suffix)]
+        return os.path.join(output_dir, kind, os.path.splitext(relpath)[0] + extension)
+
+    stimuli_dir = os.path.join(root, "stimuli")
+    bk2_paths = sorted(
+        path
+        for path in glob.glob(os.path.join(root, "**", "*.bk2"), recursive=True)
+        if not path.startswith(os.path.join(root, "derivatives") + os.sep)
+    )
+    replay_params = dict(replay_params or {})
+    if os.path.isdir(stimuli_dir):
+        replay_params.setdefault("integration_paths", [stimuli_dir])
+    # same integrations as `find_integrations`, which can't be imported without gym-retro
+    integrations = {}
+    for integration_path in replay_params.get("integration_paths", []):
+        for dirpath, dirnames, filenames in os.walk(os.path.abspath(integration_path)):
+            if "data.json" in filenames and "metadata.json" in filenames:
+                integrations.setdefault(os.path.basename(dirpath), dirpath)
+                dirnames[:] = []
+            else:
+                dirnames[:] = sorted(name for name in dirnames if not name.startswith("."))
+    for bk2_path in bk2_paths:
+        # the replay is built again when the integration of its game changes
+        inputs = [bk2_path] + _game_inputs(bk2_path, integrations, replay_params.get("scenario"))
+        targets.append(
+            Target(output("game", bk2_path, ".npz"), build_game_replay, inputs, replay_params)
+        )
+    if fmriprep in loader.derivatives_paths:
+        layout = loader.get_derivatives(fmriprep)
+        for bold in layout.get(
+            suffix="bold", desc="preproc", space=space, extension=[".nii", ".nii.gz"]
+        ):
+            mask_path = _find_mask(layout, bold, space)
+            if mask_path is not None:
+                targets.append(
+                    Target(
+                        output("bold", bold.path, ".npy", layout.root),
+                        build_masked_bold,
+                        [bold.path, mask_path],
+                    )
+                )
+    if tr is not None:
+        physio_params = dict(physio_params or {}, tr=tr)
+        for physio_path in loader.layout.get(
+            suffix="physio", extension=".tsv.gz", return_type="filename"
+        ):
+            sidecar_path = physio_path[: -len(".tsv.gz")] + ".json"
+            targets.append(
+                Target(
+                    output("physio", physio_path, ".npz"),
+                    build_physio_features,
+                    [physio_path, sidecar_path],
+                    physio_params,
+                )
+            )
+    if os.path.isdir(stimuli_dir):
+        video_params = dict(video_params or {})
+        if tr is not None and not any(
+            option in video_params for option in ("frame_stride", "target_fps", "onsets")
+        ):
+            video_params.setdefault("tr", tr)
+        for dirpath, _, filenames in os.walk(stimuli_dir):
+            for filename in sorted(filenames):
+                if filename.lower().endswith(VIDEO_EXTENSIONS):
+                    video_path = os.path.join(dirpath, filename)
+                    targets.append(
+                        Target(
+                            output("video", video_path, ".npy"),
+                            build_video_frames,
+                            [video_path],
+                            video_params,
+                        )
+                    )
+    return targets
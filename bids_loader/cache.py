@@ -0,0 +1,167 @@
+import os
+import json
+import hashlib
+import tempfile
+import contextlib
+import numpy as np
+
+
+def get_cache_dir():
+    """Return the root directory of the bids_loader cache.
+
+    It is the `BIDS_LOADER_CACHE` environment variable if it is set, `~/.cache/bids_loader`
+    otherwise.
+    """
+    cache_dir = os.environ.get("BIDS_LOADER_CACHE")
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "bids_loader")
+    return cache_dir
+
+
+def hash_file(path, chunk_size=1 << 20):
+    """Compute the SHA1 hash of a file, reading it by chunks."""
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def hash_key(*parts):
+    """Compute a cache key from json-serializable parts."""
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+class DiskCache(object):
+    """Content-addressed cache of numpy arrays on disk, with size-bounded LRU eviction.
+
+    Each entry is a dictionary of arrays stored in its own compressed npz file, one array per
+    member of the archive, named after the key of the entry. Entries can also be single files
+    written by the caller, e.g. .npy files to be memory mapped, see `writing` and `get_path`. The
+    modification time of an entry is updated each time it is read, so that the least recently
+    used entries are removed first when the cache grows larger than `max_size`.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the cache, which must only hold its entries since they are all evicted
+        together. If None, the "replays" folder of `get_cache_dir()` is used. Default is None.
+    max_size : int
+        Maximum size of the cache in bytes. If None, the cache is never evicted. Default is None.
+    """
+
+    def __init__(self, path=None, max_size=None):
+        if path is None:
+            path = os.path.join(get_cache_dir(), "replays")
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+
+    def _entry_path(self, key, suffix=".npz"):
+        return os.path.join(self.path, key + suffix)
+
+    def _entries(self):
+        if not os.path.isdir(self.path):
+            return []
+        return [
+            entry
+            for entry in os.scandir(self.path)
+            if entry.is_file() and not entry.name.endswith(".tmp")
+        ]
+
+    def __contains__(self, key):
+        return os.path.exists(self._entry_path(key))
+
+    @property
+    def size(self):
+        """Total size of the cache entries, in bytes."""
+        return sum(entry.stat().st_size for entry in self._entries())
+
+    def get(self, key):
+        """Load the arrays of an entry, or return None if the entry is not in the cache."""
+        entry_path = self._entry_path(key)
+        try:
+            with np.load(entry_path, allow_pickle=False) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(entry_path)
+        except FileNotFoundError:
+            # evicted by another process in the meantime
+            pass
+        return arrays
+
+    def set(self, key, arrays):
+        """Store a dictionary of arrays as an entry of the cache, then evict old entries."""
+        with self.writing(key) as tmp_path:
+            with open(tmp_path, "wb") as f:
+                np.savez_compressed(f, **arrays)
+
+    def get_path(self, key, suffix):
+        """Get the path of a file entry, or None if the entry is not in the cache.
+
+        Parameters
+        ----------
+        key : str
+            Key of the entry.
+        suffix : str
+            Suffix of the file of the entry, e.g. ".npy".
+
+        Returns
+        -------
+        str
+            Path of the file of the entry.
+        """
+        entry_path = self._entry_path(key, suffix)
+        try:
+            os.utime(entry_path)
+        except FileNotFoundError:
+            return None
+        return entry_path
+
+    @contextlib.contextmanager
+    def writing(self, key, suffix=".npz"):
+        """Context manager to write a file entry, giving a temporary path to write to.
+
+        The file is only moved to its entry, and old entries evicted, once the context exits
+        without error, so that concurrent readers never see partially written entries.
+
+        Example
+        -------
+        ```
+        with cache.writing(key, ".npy") as tmp_path:
+            data = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=shape)
+            ...
+        data = np.load(cache.get_path(key, ".npy"), mmap_mode="r")
+        ```
+        """
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        os.close(fd)
+        try:
+            yield tmp_path
+            os.replace(tmp_path, self._entry_path(key, suffix))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is smaller than `max_size`."""
+        if self.max_size is None:
+            return
+        entries = [(entry.stat(), entry.path) for entry in self._entries()]
+        size = sum(stat.st_size for stat, _ in entries)
+        for stat, entry_path in sorted(entries, key=lambda entry: entry[0].st_mtime):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+            size -= stat.st_size
+
+    def clear(self):
+        """Remove all the entries of the cache."""
+        for entry in self._entries():
+            os.remove(entry.path)
@@ -0,0 +1,250 @@
+import os
+import re
+import sys
+import time
+import shutil
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+
+#: Folders of a BIDS dataset that don't contain bk2 files of the participants.
+_EXCLUDED_DIRS = ("derivatives", "sourcedata", "stimuli", "code")
+#: BIDS entities the bk2 files can be filtered on, by their key in file names.
+_ENTITIES = {"sub": "subject", "ses": "session", "task": "task", "run": "run"}
+
+
+def find_bk2(root, subject=None, session=None, task=None, run=None):
+    """Find the bk2 files of a BIDS dataset, filtered on BIDS entities.
+
+    The entities of a file are read from its name and from the names of its parent folders.
+
+    Parameters
+    ----------
+    root : str
+        Path to the root of the BIDS dataset.
+    subject, session, task, run : list of str
+        Labels the entity of a file must have one of, without their prefix, e.g. ["01", "02"].
+        If None, the entity is not filtered. Default is None.
+
+    Returns
+    -------
+    list of str
+        Sorted paths to the bk2 files.
+    """
+    filters = {"subject": subject, "session": session, "task": task, "run": run}
+    bk2_paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if dirpath == root:
+            dirnames[:] = [name for name in dirnames if name not in _EXCLUDED_DIRS]
+        dirnames[:] = [name for name in dirnames if not name.startswith(".")]
+        for filename in filenames:
+            if not filename.endswith(".bk2"):
+                continue
+            path = os.path.join(dirpath, filename)
+            entities = {}
+            for key, value in re.findall(r"(?:^|[_/])([a-z]+)-([a-zA-Z0-9]+)", path[len(root) :]):
+                if key in _ENTITIES:
+                    entities[_ENTITIES[key]] = value
+            if all(
+                labels is None or _match(entities.get(name), labels)
+                for name, labels in filters.items()
+            ):
+                bk2_paths.append(path)
+    return sorted(bk2_paths)
+
+
+def _match(value, labels):
+    """Whether an entity matches one of the labels, ignoring the zero-padding of numbers."""
+    if value is None:
+        return False
+    return any(
+        value == label or (value.isdigit() and label.isdigit() and int(value) == int(label))
+        for label in labels
+    )
+
+
+def _export_replay(bk2_path, output_path, output_format, kwargs, replayer=None):
+    """Replay a bk2 file and write its outputs, returning the number of replayed frames."""
+    from .stimuli import game
+
+    if replayer is None:
+        replayer = game._worker_replayer
+    if output_format == "npz":
+        replay = replayer.replay_array(bk2_path, **kwargs)
+        tmp_path = output_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **replay.to_arrays())
+        os.replace(tmp_path, output_path)
+        return len(replay)
+    # the folder is only moved to its path once all its files are written
+    tmp_path = output_path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    outputs = kwargs.get("outputs", game.OUTPUTS)
+    replay = replayer.replay_array(
+        bk2_path,
+        frames_path=os.path.join(tmp_path, "frames.npy") if "frames" in outputs else None,
+        audio_path=os.path.join(tmp_path, "audio.wav") if "audio" in outputs else None,
+        **kwargs
+    )
+    arrays = replay.to_arrays()
+    for name in ("frames", "audio"):
+        arrays.pop(name, None)
+    if "keys" in arrays:
+        np.save(os.path.join(tmp_path, "keys.npy"), arrays.pop("keys"))
+    np.savez(os.path.join(tmp_path, "annotations.npz"), **arrays)
+    shutil.rmtree(output_path, ignore_errors=True)
+    os.replace(tmp_path, output_path)
+    return len(replay)
+
+
+def _output_path(root, output_dir, bk2_path, output_format):
+    relpath = os.path.splitext(os.path.relpath(bk2_path, root))[0]
+    return os.path.join(output_dir, relpath + (".npz" if output_format == "npz" else ""))
+
+
+def replay(args):
+    """Replay the bk2 files of a dataset and write their outputs, reporting the progress."""
+    from .stimuli import game
+
+    root = os.path.abspath(args.root)
+    output_dir = args.output_dir or os.path.join(root, "derivatives", "replays")
+    bk2_paths = find_bk2(root, args.subject, args.session, args.task, args.run)
+    outputs = {
+        bk2_path: _output_path(root, output_dir, bk2_path, args.format) for bk2_path in bk2_paths
+    }
+    if args.skip_existing:
+        bk2_paths = [path for path in bk2_paths if not os.path.exists(outputs[path])]
+    print("Replaying {} bk2 files into {}".format(len(bk2_paths), output_dir), file=sys.stderr)
+    if not bk2_paths:
+        return 0
+    integration_paths = []
+    stimuli_dir = os.path.join(root, "stimuli")
+    if os.path.isdir(stimuli_dir):
+        integration_paths.append(stimuli_dir)
+        # check the roms once here, the workers reuse the results
+        integrations = game.register_integrations(stimuli_dir)
+        print("Found integrations: {}".format(", ".join(sorted(integrations))), file=sys.stderr)
+    kwargs = {"outputs": tuple(args.outputs), "skip_first_step": not args.keep_first_step}
+    for option in ("scenario", "frame_stride", "target_fps", "tr"):
+        if getattr(args, option) is not None:
+            kwargs[option] = getattr(args, option)
+    for bk2_path in bk2_paths:
+        os.makedirs(os.path.dirname(outputs[bk2_path]), exist_ok=True)
+
+    start_time = time.monotonic()
+    n_frames = 0
+
+    def report(i, bk2_path, n):
+        elapsed = time.monotonic() - start_time
+        print(
+            "[{}/{}] {} : {} frames, {:.1f} frames/s".format(
+                i, len(bk2_paths), os.path.relpath(bk2_path, root), n, n_frames / elapsed
+            ),
+            file=sys.stderr,
+        )
+
+    n_jobs = max(min(args.n_jobs or os.cpu_count(), len(bk2_paths)), 1)
+    if n_jobs == 1:
+        game._init_replay_worker(integration_paths)
+        with game._worker_replayer:
+            for i, bk2_path in enumerate(bk2_paths, 1):
+                n = _export_replay(bk2_path, outputs[bk2_path], args.format, kwargs)
+                n_frames += n
+                report(i, bk2_path, n)
+    else:
+        # as in `replay_many`, one emulator per spawned worker process
+        with ProcessPoolExecutor(
+            max_workers=n_jobs,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=game._init_replay_worker,
+            initargs=(integration_paths,),
+        ) as executor:
+            futures = {
+                executor.submit(
+                    _export_replay, bk2_path, outputs[bk2_path], args.format, kwargs
+                ): bk2_path
+                for bk2_path in bk2_paths
+            }
+            for i, future in enumerate(as_completed(futures), 1):
+                n = future.result()
+                n_frames += n
+                report(i, futures[future], n)
+    elapsed = time.monotonic() - start_time
+    print(
+        "Replayed {} frames of {} files in {:.1f} s, {:.1f} frames/s".format(
+            n_frames, len(bk2_paths), elapsed, n_frames / elapsed
+        ),
+        file=sys.stderr,
+    )
+    return 0
+
+
+def get_parser():
+    """Build the parser of the `bids-loader` command."""
+    parser = argparse.ArgumentParser(
+        prog="bids-loader", description="Tools for BIDS datasets of the bids_loader package."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    replay_parser = commands.add_parser(
+        "replay",
+        help="Replay the bk2 files of a dataset.",
+        description="Replay the bk2 files of a BIDS dataset in parallel and write their frames, "
+        "keys, annotations and audio, using the stimuli folder of the dataset as custom "
+        "integration path.",
+    )
+    replay_parser.add_argument("root", help="Root of the BIDS dataset.")
+    for entity in ("subject", "session", "task", "run"):
+        replay_parser.add_argument(
+            "--" + entity, nargs="+", help="Only replay the files with one of these labels."
+        )
+    replay_parser.add_argument(
+        "-o",
+        "--output-dir",
+        help="Folder where the outputs are written, in the same tree as the bk2 files. Default "
+        "is <root>/derivatives/replays.",
+    )
+    replay_parser.add_argument(
+        "--format",
+        choices=("npz", "npy"),
+        default="npz",
+        help="npz: one .npz file per bk2 file. npy: one folder per bk2 file, with frames.npy "
+        "and keys.npy to be memory mapped, audio.wav and annotations.npz. Default is npz.",
+    )
+    replay_parser.add_argument(
+        "--outputs",
+        nargs="+",
+        choices=("frames", "keys", "reward", "done", "info", "audio", "ram"),
+        default=["frames", "keys", "reward", "done", "info", "audio"],
+        help="Outputs of the replays. Default is all of them but ram.",
+    )
+    selection = replay_parser.add_mutually_exclusive_group()
+    selection.add_argument("--frame-stride", type=int, help="Keep every n-th frame.")
+    selection.add_argument("--target-fps", type=float, help="Keep the frames at this rate.")
+    selection.add_argument("--tr", type=float, help="Keep the frames at the onset of each TR.")
+    replay_parser.add_argument("--scenario", help="Scenario of the replays.")
+    replay_parser.add_argument(
+        "--keep-first-step",
+        action="store_true",
+        help="Don't skip the first step of the movies.",
+    )
+    replay_parser.add_argument(
+        "-j", "--n-jobs", type=int, help="Number of worker processes. Default is the CPU count."
+    )
+    replay_parser.add_argument(
+        "--skip-existing", action="store_true", help="Don't replay the files already written."
+    )
+    replay_parser.set_defaults(func=replay)
+    return parser
+
+
+def main(argv=None):
+    """Entry point of the `bids-loader` command."""
+    args = get_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
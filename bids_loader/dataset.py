@@ -0,0 +1,134 @@
+import os
+import numpy as np
+from .mri import MRILoader
+
+
+def _stimulus_source(stimulus):
+    """Get a path to reopen a stimulus from, or the stimulus itself if it is in memory."""
+    if isinstance(stimulus, np.memmap) and stimulus.filename is not None:
+        try:
+            stored = np.load(stimulus.filename, mmap_mode="r")
+        except ValueError:
+            # not a .npy file
+            return stimulus
+        # a view of part of the file can't be reopened from its path
+        if stored.shape == stimulus.shape and stored.dtype == stimulus.dtype:
+            return stimulus.filename
+    return stimulus
+
+
+class WindowDataset(MRILoader):
+    """Map-style dataset of aligned windows of stimulus and BOLD runs of a BIDS dataset.
+
+    An index of (run,start) pairs of all the windows is computed once, and each item only reads
+    the slices of its window from the memory maps of the runs, so that random windows can be
+    sampled across a whole dataset, e.g. by the workers of a `torch.utils.data.DataLoader`. The
+    memory maps are opened lazily in each process, and are not pickled along with the dataset.
+
+    Example
+    -------
+    ```
+    loader = VideoLoader()
+    runs = [
+        (bold_path, loader.align_to(video_path, tr, size=(64, 64)))
+        for bold_path, video_path in zip(bold_paths, video_paths)
+    ]
+    dataset = WindowDataset("cneuromod/friends", runs, window=10, lag=3, mask=mask_path)
+    stimulus, bold = dataset[0]
+    ```
+
+    Parameters
+    ----------
+    root : str
+        Path to the root of the BIDS dataset.
+    runs : list of tuple
+        Pairs of (bold,stimulus) of each run, where bold is the path to the NIfTI file of the run,
+        and stimulus is the stimulus aligned to its volumes, e.g. by `StimulusLoader.align_to`,
+        as an array of shape (n_volumes,...) or the path to a .npy file of it. Stimuli in .npy
+        files or memory maps of them are memory mapped, others are kept in memory.
+    window : int
+        Number of volumes per window. Default is 1.
+    stride : int
+        Number of volumes between the starts of consecutive windows of a run. Default is 1.
+    lag : int
+        Number of volumes the BOLD window is shifted by relative to the stimulus window, to
+        account for the hemodynamic delay. Default is 0.
+    mask : str or nibabel.Nifti1Image
+        Mask of the voxels, see `MRILoader.get_masked`. If None, all the voxels are used.
+        Default is None.
+    **kwargs
+        Parameters passed to `MRILoader`.
+    """
+
+    def __init__(self, root, runs, window=1, stride=1, lag=0, mask=None, **kwargs):
+        super(WindowDataset, self).__init__(root, **kwargs)
+        self.bold_paths = [os.path.abspath(bold) for bold, _ in runs]
+        self.stimuli = [_stimulus_source(stimulus) for _, stimulus in runs]
+        self.window = window
+        self.stride = stride
+        self.lag = lag
+        self.mask = mask
+        self._pid = None
+        self._bold = {}
+        self._stimuli = {}
+        starts = []
+        for run in range(len(runs)):
+            n_volumes = min(len(self.get_timeseries(run)) - lag, len(self.get_stimulus(run)))
+            run_starts = np.arange(0, n_volumes - window + 1, stride)
+            starts.append(np.stack([np.full(len(run_starts), run), run_starts], axis=1))
+        self.index = np.concatenate(starts) if starts else np.empty((0, 2), dtype=np.int64)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_bold"], state["_stimuli"] = {}, {}
+        # the layouts are reopened from their database when needed
+        state["_layout"], state["_derivatives"] = None, {}
+        return state
+
+    def _check_process(self):
+        """Forget the memory maps opened by another process, e.g. before a fork."""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._bold, self._stimuli = {}, {}
+
+    def get_timeseries(self, run):
+        """Get the memory-mapped timeseries of a run, of shape (T,n_voxels)."""
+        self._check_process()
+        if run not in self._bold:
+            bold = self.open_bold(self.bold_paths[run])
+            if self.mask is None:
+                self._bold[run] = bold.timeseries
+            else:
+                self._bold[run] = self.get_masked(bold, self.mask)
+        return self._bold[run]
+
+    def get_stimulus(self, run):
+        """Get the stimulus of a run, memory mapped if it is in a .npy file."""
+        self._check_process()
+        if run not in self._stimuli:
+            stimulus = self.stimuli[run]
+            if isinstance(stimulus, str):
+                stimulus = np.load(stimulus, mmap_mode="r")
+            self._stimuli[run] = stimulus
+        return self._stimuli[run]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        """Get the stimulus and BOLD windows of item `i`.
+
+        Returns
+        -------
+        stimulus : numpy.ndarray
+            Stimulus window, of shape (window,...).
+        bold : numpy.ndarray
+            BOLD window, of shape (window,n_voxels).
+        """
+        if not -len(self) <= i < len(self):
+            raise IndexError("Index {} out of range for {} windows.".format(i, len(self)))
+        run, start = self.index[i]
+        stimulus = self.get_stimulus(run)[start : start + self.window]
+        bold_start = start + self.lag
+        bold = self.get_timeseries(run)[bold_start : bold_start + self.window]
+        return np.array(stimulus), np.array(bold)
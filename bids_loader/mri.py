@@ -0,0 +1,591 @@
+import os
+import re
+import fnmatch
+import hashlib
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from scipy import sparse
+from nilearn import image
+from .base import BaseLoader
+from .cache import DiskCache, get_cache_dir, hash_key
+
+#: Confound columns of fMRIPrep by strategy name, as shell-style patterns.
+CONFOUND_STRATEGIES = {
+    "motion": ["trans_x", "trans_y", "trans_z", "rot_x", "rot_y", "rot_z"],
+    "motion24": ["trans_?", "trans_?_*", "rot_?", "rot_?_*"],
+    "wm_csf": ["white_matter", "csf"],
+    "global_signal": ["global_signal"],
+    "compcor": ["a_comp_cor_??"],
+    "cosine": ["cosine*"],
+    "non_steady_state": ["non_steady_state_outlier*"],
+    "motion_outliers": ["motion_outlier*"],
+}
+
+#: Entities of the preprocessed BOLD runs of fMRIPrep that its confounds don't have.
+_BOLD_ONLY_ENTITIES = ("space", "res", "den", "desc")
+
+
+def _file_key(path):
+    """Identify a file by its path, modification time and size, without reading it."""
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_mtime_ns, stat.st_size]
+
+
+def _run_key(run, chunk_size=64):
+    """Identify a run by its file, or by a digest of its timeseries if it has no file."""
+    if run.path is not None:
+        return _file_key(run.path)
+    sha1 = hashlib.sha1()
+    for _, chunk in run.iter_chunks(chunk_size):
+        sha1.update(np.ascontiguousarray(chunk).tobytes())
+    return [sha1.hexdigest(), run.timeseries.dtype.str, list(run.timeseries.shape)]
+
+
+def _is_scaled(img):
+    """Whether the data of a NIfTI image is scaled, in which case it can't be memory mapped."""
+    slope, inter = img.dataobj.slope, img.dataobj.inter
+    scaled_slope = slope is not None and not np.isnan(slope) and slope != 1
+    scaled_inter = inter is not None and not np.isnan(inter) and inter != 0
+    return scaled_slope or scaled_inter
+
+
+def _mask_key(mask):
+    """Identify a mask given as a path or an image."""
+    if isinstance(mask, str):
+        return _file_key(mask)
+    data = np.ascontiguousarray(np.asanyarray(mask.dataobj) != 0)
+    digest = hashlib.sha1(data.tobytes()).hexdigest()
+    return [digest, data.shape, np.round(mask.affine, 6).tolist()]
+
+
+def _atlas_key(atlas):
+    """Identify an atlas given as a path or an image, by its labels and not only its voxels."""
+    if isinstance(atlas, str):
+        return _file_key(atlas)
+    data = np.ascontiguousarray(np.asanyarray(atlas.dataobj))
+    digest = hashlib.sha1(data.tobytes()).hexdigest()
+    return [digest, data.dtype.str, data.shape, np.round(atlas.affine, 6).tolist()]
+
+
+def _grid_key(shape, affine):
+    return [list(shape), np.round(affine, 6).tolist()]
+
+
+def get_confounds_path(bold_path):
+    """Get the path of the fMRIPrep confounds of a preprocessed BOLD run."""
+    dirname, basename = os.path.split(bold_path)
+    entities = [
+        entity
+        for entity in re.sub(r"_bold\.nii(\.gz)?$", "", basename).split("_")
+        if entity.split("-")[0] not in _BOLD_ONLY_ENTITIES
+    ]
+    return os.path.join(dirname, "_".join(entities) + "_desc-confounds_timeseries.tsv")
+
+
+def get_confound_columns(columns, strategy):
+    """Select the confound columns of a strategy.
+
+    Parameters
+    ----------
+    columns : list of str
+        Columns of the confounds file.
+    strategy : str or list of str
+        Names of strategies in `CONFOUND_STRATEGIES`, or shell-style patterns of columns.
+
+    Returns
+    -------
+    list of str
+        Selected columns, in the order of the file.
+    """
+    if isinstance(strategy, str):
+        strategy = [strategy]
+    patterns = []
+    for name in strategy:
+        patterns.extend(CONFOUND_STRATEGIES.get(name, [name]))
+    return [
+        column
+        for column in columns
+        if any(fnmatch.fnmatchcase(column, pattern) for pattern in patterns)
+    ]
+
+
+def clean_timeseries(timeseries, confounds=None, detrend=True, standardize=False, chunk_size=4096):
+    """Regress confounds out of timeseries, in place.
+
+    The confounds, with an intercept and optionally a linear trend, are orthonormalized once with
+    a QR decomposition, and their projection is removed from the timeseries one chunk of columns
+    at a time, so that only a chunk is copied in memory.
+
+    Parameters
+    ----------
+    timeseries : numpy.ndarray
+        Writable timeseries of shape (T,n_voxels), e.g. float32.
+    confounds : numpy.ndarray
+        Confounds of shape (T,n_confounds). NaNs are replaced by the mean of their column. If
+        None, only the intercept and trend are removed. Default is None.
+    detrend : bool
+        Whether to remove a linear trend. Default is True.
+    standardize : bool
+        Whether to scale the timeseries to unit variance. Default is False.
+    chunk_size : int
+        Number of columns cleaned at a time. Default is 4096.
+
+    Returns
+    -------
+    numpy.ndarray
+        The timeseries, cleaned in place.
+    """
+    n_samples = len(timeseries)
+    regressors = [np.ones((n_samples, 1))]
+    if detrend:
+        regressors.append(np.linspace(-1, 1, n_samples)[:, None])
+    if confounds is not None and np.size(confounds):
+        confounds = np.array(confounds, dtype=np.float64).reshape((n_samples, -1))
+        means = np.nanmean(confounds, axis=0)
+        nans = np.isnan(confounds)
+        confounds[nans] = np.take(np.nan_to_num(means), np.nonzero(nans)[1])
+        regressors.append(confounds)
+    q, r = np.linalg.qr(np.concatenate(regressors, axis=1))
+    # drop the directions of collinear confounds
+    q = q[:, np.abs(np.diag(r)) > 1e-10 * np.abs(r).max()].astype(timeseries.dtype)
+    for start in range(0, timeseries.shape[1], chunk_size):
+        chunk = timeseries[:, start : start + chunk_size]
+        chunk -= q @ (q.T @ chunk)
+        if standardize:
+            std = chunk.std(axis=0)
+            std[std == 0] = 1
+            chunk /= std
+    return timeseries
+
+
+class BoldRun(object):
+    """BOLD run seen as a (T,n_voxels) matrix, backed by a memory map.
+
+    The voxels of each volume are in the order of the NIfTI file, i.e. x varies fastest, so that
+    each volume is contiguous on disk and slicing a window of time only reads that window. The
+    flat index of voxel (x,y,z) is thus `np.ravel_multi_index((x,y,z), shape, order="F")`.
+
+    Parameters
+    ----------
+    timeseries : numpy.ndarray
+        Timeseries of the voxels, array of shape (T,n_voxels).
+    shape : tuple of int
+        Spatial shape (X,Y,Z) of the volumes.
+    affine : numpy.ndarray
+        Affine of the volumes, of shape (4,4).
+    tr : float
+        Repetition time, in seconds.
+    path : str
+        Path to the NIfTI file of the run.
+    """
+
+    def __init__(self, timeseries, shape, affine, tr, path=None):
+        self.timeseries = timeseries
+        self.shape = tuple(shape)
+        self.affine = affine
+        self.tr = tr
+        self.path = path
+
+    def __len__(self):
+        return len(self.timeseries)
+
+    @property
+    def onsets(self):
+        """Onset of each volume, in seconds."""
+        return np.arange(len(self)) * self.tr
+
+    def volumes(self, start=None, stop=None):
+        """Get a window of time as 4D volumes of shape (X,Y,Z,n), without copying it."""
+        window = self.timeseries[start:stop]
+        return window.T.reshape(self.shape + (len(window),), order="F")
+
+    def iter_chunks(self, chunk_size):
+        """Iterate over windows of `chunk_size` volumes of the run.
+
+        Yields
+        ------
+        start : int
+            Index of the first volume of the chunk.
+        chunk : numpy.ndarray
+            Timeseries of the chunk, view of shape (chunk_size,n_voxels), or less for the last
+            chunk.
+        """
+        for start in range(0, len(self), chunk_size):
+            yield start, self.timeseries[start : start + chunk_size]
+
+
+class MRILoader(BaseLoader):
+    """Loader of the BOLD runs of a BIDS dataset, as memory maps.
+
+    Uncompressed NIfTI files are memory mapped in place. Compressed .nii.gz files, or files with
+    scaled data, can't be memory mapped : they are decompressed once, one chunk of volumes at a
+    time, into .npy files of the cache, which are then memory mapped. The runs are never loaded
+    whole in memory, and training loops can read windows of time from them.
+
+    Example
+    -------
+    ```
+    loader = MRILoader("cneuromod/shinobi")
+    for run in loader.get_bold(subject="01", space="MNI152NLin2009cAsym"):
+        for start, chunk in run.iter_chunks(64):
+            ...
+    ```
+
+    Parameters
+    ----------
+    root : str
+        Path to the root of the BIDS dataset.
+    bold_cache : DiskCache or str
+        Cache of the decompressed runs, or path to its directory. If None, the "bold" folder of
+        the bids_loader cache is used. Default is None.
+    **kwargs
+        Parameters passed to `BaseLoader`.
+    """
+
+    def __init__(self, root, bold_cache=None, **kwargs):
+        super(MRILoader, self).__init__(root, **kwargs)
+        if bold_cache is None:
+            bold_cache = os.path.join(get_cache_dir(), "bold")
+        if not isinstance(bold_cache, DiskCache):
+            bold_cache = DiskCache(bold_cache)
+        self.bold_cache = bold_cache
+        self._mask_indices = {}
+        self._parcel_operators = {}
+        self._confound_dtypes = {}
+
+    def get_bold(self, derivatives="fmriprep", desc="preproc", **entities):
+        """Open the BOLD runs matching BIDS entities.
+
+        Parameters
+        ----------
+        derivatives : str
+            Name of the derivatives dataset of the runs. If None, the runs of the raw dataset are
+            used. Default is "fmriprep".
+        desc : str
+            Description entity of the runs. Default is "preproc".
+        **entities
+            Other BIDS entities of the runs, e.g. `subject="01", space="T1w"`.
+
+        Returns
+        -------
+        list of BoldRun
+            Runs matching the entities.
+        """
+        if derivatives is None:
+            layout = self.layout
+        else:
+            layout = self.get_derivatives(derivatives)
+            entities["desc"] = desc
+        paths = layout.get(
+            suffix="bold", extension=[".nii", ".nii.gz"], return_type="filename", **entities
+        )
+        return [self.open_bold(path) for path in paths]
+
+    def open_bold(self, path, chunk_size=64):
+        """Open a BOLD run as a memory map, decompressing it in the cache if needed.
+
+        Parameters
+        ----------
+        path : str
+            Path to the NIfTI file of the run.
+        chunk_size : int
+            Number of volumes decompressed at a time when the run is added to the cache. Default
+            is 64.
+
+        Returns
+        -------
+        BoldRun
+            Memory-mapped run.
+        """
+        img = nib.load(path, mmap=True, keep_file_open=True)
+        shape = img.shape[:3]
+        n_volumes = img.shape[3]
+        tr = float(img.header.get_zooms()[3])
+        if img.header.get_xyzt_units()[1] == "msec":
+            tr /= 1000
+        if not path.endswith(".gz") and not _is_scaled(img):
+            data = np.asanyarray(img.dataobj)
+            timeseries = data.reshape((-1, n_volumes), order="F").T
+        else:
+            timeseries = self._cached_timeseries(img, path, n_volumes, chunk_size)
+        return BoldRun(timeseries, shape, img.affine, tr, path)
+
+    def _cached_timeseries(self, img, path, n_volumes, chunk_size):
+        """Get the memory map of the decompressed copy of a run, making it if needed."""
+        key = hash_key("bold", _file_key(path))
+        cached_path = self.bold_cache.get_path(key, ".npy")
+        if cached_path is None:
+            dtype = np.float32 if _is_scaled(img) else img.get_data_dtype()
+            shape = (n_volumes, int(np.prod(img.shape[:3])))
+            with self.bold_cache.writing(key, ".npy") as tmp_path:
+                timeseries = np.lib.format.open_memmap(
+                    tmp_path, mode="w+", dtype=dtype, shape=shape
+                )
+                for start in range(0, n_volumes, chunk_size):
+                    stop = min(start + chunk_size, n_volumes)
+                    chunk = img.dataobj[..., start:stop]
+                    timeseries[start:stop] = chunk.reshape((-1, stop - start), order="F").T
+                timeseries.flush()
+                del timeseries
+            cached_path = self.bold_cache.get_path(key, ".npy")
+        return np.load(cached_path, mmap_mode="r")
+
+    def get_mask_indices(self, mask, shape, affine):
+        """Get the flat indices of the voxels of a mask in the grid of a run.
+
+        The indices are computed once per mask and grid, and reused for all the runs in that
+        grid. The mask is resampled to the grid with nearest interpolation if needed.
+
+        Parameters
+        ----------
+        mask : str or nibabel.Nifti1Image
+            Mask, path to its NIfTI file or image. Non-zero voxels are in the mask.
+        shape : tuple of int
+            Spatial shape (X,Y,Z) of the grid.
+        affine : numpy.ndarray
+            Affine of the grid, of shape (4,4).
+
+        Returns
+        -------
+        numpy.ndarray
+            Sorted flat indices of the voxels of the mask, see `BoldRun`.
+        """
+        key = hash_key(_mask_key(mask), _grid_key(shape, affine))
+        if key not in self._mask_indices:
+            img = nib.load(mask) if isinstance(mask, str) else mask
+            if img.shape[:3] != tuple(shape) or not np.allclose(img.affine, affine):
+                img = image.resample_img(
+                    img, target_affine=affine, target_shape=shape, interpolation="nearest"
+                )
+            data = np.asanyarray(img.dataobj).reshape(shape)
+            self._mask_indices[key] = np.flatnonzero(data.ravel(order="F"))
+        return self._mask_indices[key]
+
+    def get_masked(self, run, mask, chunk_size=64):
+        """Get the timeseries of the voxels of a mask in a run, cached on disk.
+
+        The voxels are gathered from the memory map of the run with fancy indexing, one chunk of
+        volumes at a time, and saved in a .npy file of the cache, which is then memory mapped.
+        Runs without a file are identified in the cache by a digest of their timeseries.
+
+        Parameters
+        ----------
+        run : BoldRun
+            Run, see `open_bold`.
+        mask : str or nibabel.Nifti1Image
+            Mask, see `get_mask_indices`.
+        chunk_size : int
+            Number of volumes gathered at a time when the timeseries are added to the cache.
+            Default is 64.
+
+        Returns
+        -------
+        numpy.ndarray
+            Memory-mapped timeseries, of shape (T,n_voxels) with the voxels of the mask in the
+            order of their flat indices.
+        """
+        indices = self.get_mask_indices(mask, run.shape, run.affine)
+        run_key = _run_key(run, chunk_size)
+        key = hash_key("masked", run_key, _mask_key(mask), _grid_key(run.shape, run.affine))
+        cached_path = self.bold_cache.get_path(key, ".npy")
+        if cached_path is None:
+            with self.bold_cache.writing(key, ".npy") as tmp_path:
+                shape = (len(run), len(indices))
+                masked = np.lib.format.open_memmap(
+                    tmp_path, mode="w+", dtype=run.timeseries.dtype, shape=shape
+                )
+                for start, chunk in run.iter_chunks(chunk_size):
+                    masked[start : start + len(chunk)] = chunk[:, indices]
+                masked.flush()
+                del masked
+            cached_path = self.bold_cache.get_path(key, ".npy")
+        return np.load(cached_path, mmap_mode="r")
+
+    def get_parcel_operator(self, atlas, shape, affine, background_label=0):
+        """Get the sparse operator averaging the voxels of each parcel of an atlas in a grid.
+
+        The operator is computed once per atlas and grid, and reused for all the runs in that
+        grid. The atlas is resampled to the grid with nearest interpolation if needed.
+
+        Parameters
+        ----------
+        atlas : str or nibabel.Nifti1Image
+            Atlas of integer labels, path to its NIfTI file or image.
+        shape : tuple of int
+            Spatial shape (X,Y,Z) of the grid.
+        affine : numpy.ndarray
+            Affine of the grid, of shape (4,4).
+        background_label : int
+            Label of the voxels outside of the parcels. Default is 0.
+
+        Returns
+        -------
+        operator : scipy.sparse.csr_matrix
+            Operator of shape (n_parcels,n_voxels), such that `operator @ volume` is the mean of
+            the flat volume in each parcel.
+        labels : numpy.ndarray
+            Sorted labels of the parcels.
+        """
+        key = hash_key(_atlas_key(atlas), _grid_key(shape, affine), int(background_label))
+        if key not in self._parcel_operators:
+            img = nib.load(atlas) if isinstance(atlas, str) else atlas
+            if img.shape[:3] != tuple(shape) or not np.allclose(img.affine, affine):
+                img = image.resample_img(
+                    img, target_affine=affine, target_shape=shape, interpolation="nearest"
+                )
+            data = np.asanyarray(img.dataobj).reshape(shape).ravel(order="F")
+            voxels = np.flatnonzero(data != background_label)
+            labels, parcels = np.unique(data[voxels], return_inverse=True)
+            weights = (1 / np.bincount(parcels)[parcels]).astype(np.float32)
+            operator = sparse.csr_matrix(
+                (weights, (parcels, voxels)), shape=(len(labels), len(data))
+            )
+            self._parcel_operators[key] = operator, labels
+        return self._parcel_operators[key]
+
+    def get_parcels(self, run, atlas, background_label=0, chunk_size=64):
+        """Get the mean timeseries of the parcels of an atlas in a run, cached on disk.
+
+        The timeseries are computed with one sparse matrix product per chunk of volumes read from
+        the memory map of the run, see `get_parcel_operator`.
+
+        Parameters
+        ----------
+        run : BoldRun
+            Run, see `open_bold`.
+        atlas : str or nibabel.Nifti1Image
+            Atlas, see `get_parcel_operator`.
+        background_label : int
+            Label of the voxels outside of the parcels. Default is 0.
+        chunk_size : int
+            Number of volumes read at a time. Default is 64.
+
+        Returns
+        -------
+        numpy.ndarray
+            Timeseries of shape (T,n_parcels), with the parcels in the order of their labels.
+        """
+        run_key = _run_key(run, chunk_size)
+        key = hash_key(
+            "parcels",
+            run_key,
+            _atlas_key(atlas),
+            _grid_key(run.shape, run.affine),
+            int(background_label),
+        )
+        cached = self.bold_cache.get(key)
+        if cached is not None:
+            return cached["timeseries"]
+        operator, labels = self.get_parcel_operator(
+            atlas, run.shape, run.affine, background_label
+        )
+        dtype = np.result_type(run.timeseries.dtype, np.float32)
+        timeseries = np.empty((len(run), len(labels)), dtype=dtype)
+        for start, chunk in run.iter_chunks(chunk_size):
+            timeseries[start : start + len(chunk)] = (operator @ chunk.T).T
+        self.bold_cache.set(key, {"timeseries": timeseries})
+        return timeseries
+
+    def load_confounds(self, path, strategy=("motion", "wm_csf")):
+        """Load the confounds of a strategy from an fMRIPrep confounds file.
+
+        Only the columns of the strategy are parsed, as float32. The header of each file is only
+        read once per loader.
+
+        Parameters
+        ----------
+        path : str
+            Path to the `*_desc-confounds_timeseries.tsv` file, see `get_confounds_path`.
+        strategy : str or list of str
+            Strategy, see `get_confound_columns`. Default is ("motion", "wm_csf").
+
+        Returns
+        -------
+        pandas.DataFrame
+            Confounds, with NaNs for the "n/a" values.
+        """
+        key = hash_key(_file_key(path))
+        if key not in self._confound_dtypes:
+            with open(path) as f:
+                columns = f.readline().rstrip("\n").split("\t")
+            self._confound_dtypes[key] = {column: np.float32 for column in columns}
+        dtypes = self._confound_dtypes[key]
+        columns = get_confound_columns(list(dtypes), strategy)
+        return pd.read_csv(
+            path,
+            sep="\t",
+            usecols=columns,
+            dtype={column: dtypes[column] for column in columns},
+            na_values="n/a",
+            engine="c",
+        )[columns]
+
+    def clean_runs(
+        self,
+        runs,
+        mask=None,
+        strategy=("motion", "wm_csf"),
+        detrend=True,
+        standardize=False,
+        dtype=np.float32,
+    ):
+        """Clean a batch of runs, regressing out their confounds.
+
+        Each run is copied once from its memory map, masked if a mask is given, then cleaned in
+        place with the QR projection of its confounds, see `clean_timeseries`.
+
+        Parameters
+        ----------
+        runs : list of BoldRun
+            Preprocessed runs of fMRIPrep, see `get_bold`.
+        mask : str or nibabel.Nifti1Image
+            Mask of the voxels, see `get_masked`. If None, all the voxels are used. Default is
+            None.
+        strategy : str or list of str
+            Strategy, see `get_confound_columns`. If None, only the intercept and trend are
+            removed. Default is ("motion", "wm_csf").
+        detrend : bool
+            Whether to remove a linear trend. Default is True.
+        standardize : bool
+            Whether to scale the timeseries to unit variance. Default is False.
+        dtype : numpy.dtype
+            Type of the cleaned timeseries. Default is float32.
+
+        Returns
+        -------
+        list of numpy.ndarray
+            Cleaned timeseries of shape (T,n_voxels) of each run.
+        """
+        cleaned = []
+        for run in runs:
+            timeseries = run.timeseries if mask is None else self.get_masked(run, mask)
+            confounds = None
+            if strategy is not None:
+                confounds = self.load_confounds(get_confounds_path(run.path), strategy).values
+            timeseries = np.array(timeseries, dtype=dtype)
+            cleaned.append(clean_timeseries(timeseries, confounds, detrend, standardize))
+        return cleaned
+
+    def get_masked_bold(self, mask, derivatives="fmriprep", desc="preproc", **entities):
+        """Get the masked timeseries of the BOLD runs matching BIDS entities.
+
+        Parameters
+        ----------
+        mask : str or nibabel.Nifti1Image
+            Mask, see `get_mask_indices`. The runs of all the entities share it, so the entities
+            should select a single space.
+        derivatives : str
+            Name of the derivatives dataset of the runs, see `get_bold`. Default is "fmriprep".
+        desc : str
+            Description entity of the runs. Default is "preproc".
+        **entities
+            Other BIDS entities of the runs, e.g. `subject="01", space="T1w"`.
+
+        Returns
+        -------
+        list of numpy.ndarray
+            Memory-mapped timeseries of shape (T,n_voxels) of each run, see `get_masked`.
+        """
+        runs = self.get_bold(derivatives=derivatives, desc=desc, **entities)
+        return [self.get_masked(run, mask) for run in runs]
@@ -0,0 +1,377 @@
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from scipy import signal
+from .base import BaseLoader
+from .cache import DiskCache, get_cache_dir, hash_key
+from .timing import sample_index, window_mean
+
+#: Pass band of the cardiac signal, in Hz.
+CARDIAC_BAND = (0.6, 3.0)
+#: Pass band of the respiratory signal, in Hz.
+RESPIRATORY_BAND = (0.05, 1.0)
+
+
+def read_sidecar(physio_path):
+    """Read the JSON sidecar of a physio file, next to it with the same name."""
+    sidecar_path = physio_path[: -len(".tsv.gz")] + ".json"
+    with open(sidecar_path) as f:
+        return json.load(f)
+
+
+def read_physio(physio_path, columns, dtype=np.float32, chunk_size=1 << 16):
+    """Read a physio file by chunks of samples, decompressing it on the fly.
+
+    Parameters
+    ----------
+    physio_path : str
+        Path to the `*_physio.tsv.gz` file.
+    columns : list of str
+        Names of the columns of the file, from its sidecar.
+    dtype : numpy.dtype
+        Type of the samples. Default is float32.
+    chunk_size : int
+        Number of samples per chunk. Default is 65536.
+
+    Yields
+    ------
+    numpy.ndarray
+        Chunk of samples, of shape (chunk_size,n_columns), or less for the last chunk.
+    """
+    chunks = pd.read_csv(
+        physio_path,
+        sep="\t",
+        header=None,
+        names=columns,
+        dtype=dtype,
+        na_values="n/a",
+        compression="gzip",
+        engine="c",
+        chunksize=chunk_size,
+    )
+    with chunks:
+        for chunk in chunks:
+            yield chunk.values
+
+
+def analytic_signal(x, sampling_frequency, band):
+    """Band-pass filter a signal and compute its analytic signal, with a single FFT.
+
+    The spectrum is zeroed outside of the band and for the negative frequencies, and doubled for
+    the positive ones, so that the real part of the inverse FFT is the filtered signal, and its
+    angle and modulus are the instantaneous phase and amplitude.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Signal, of shape (n_samples,).
+    sampling_frequency : float
+        Sampling frequency, in Hz.
+    band : tuple of float
+        Low and high frequencies of the pass band, in Hz.
+
+    Returns
+    -------
+    numpy.ndarray
+        Complex analytic signal, of shape (n_samples,).
+    """
+    spectrum = np.fft.fft(np.asarray(x, dtype=np.float64) - np.mean(x))
+    frequencies = np.fft.fftfreq(len(spectrum), 1 / sampling_frequency)
+    spectrum *= 2 * ((frequencies >= band[0]) & (frequencies <= band[1]))
+    return np.fft.ifft(spectrum)
+
+
+def get_volume_onsets(run, trigger="trigger", threshold=None):
+    """Get the onsets of the volumes from the rising edges of the trigger column of a recording.
+
+    Parameters
+    ----------
+    run : PhysioRun
+        Recording.
+    trigger : str
+        Name of the trigger column. Default is "trigger".
+    threshold : float
+        Level of the rising edges. If None, halfway between the minimum and maximum of the
+        trigger. Default is None.
+
+    Returns
+    -------
+    numpy.ndarray
+        Onset of each volume relative to the start of the first volume, in seconds.
+    """
+    x = run[trigger]
+    if threshold is None:
+        threshold = (np.min(x) + np.max(x)) / 2
+    high = x >= threshold
+    edges = np.flatnonzero(high[1:] & ~high[:-1]) + 1
+    if high[0]:
+        edges = np.r_[0, edges]
+    return run.start_time + edges / run.sampling_frequency
+
+
+def physio_features(
+    run,
+    tr,
+    n_volumes=None,
+    onsets=None,
+    cardiac="cardiac",
+    respiratory="respiratory",
+    trigger="trigger",
+    averages=None,
+):
+    """Compute physiological features for each volume of a run, in one vectorized pass.
+
+    The cardiac and respiratory signals are band-pass filtered in the frequency domain, see
+    `analytic_signal`. The features are:
+
+    - "cardiac_sin", "cardiac_cos": sine and cosine of the cardiac phase at the volume onset,
+    - "heart_rate": mean heart rate in the volume, in beats per minute, from the peaks of the
+      filtered cardiac signal, NaN if there are less than two peaks,
+    - "respiratory_sin", "respiratory_cos": sine and cosine of the respiratory phase at the volume
+      onset,
+    - "rvt": mean respiration volume per time in the volume, i.e. peak-to-trough amplitude of the
+      filtered respiratory signal times its instantaneous frequency,
+    - "mean_<column>": mean of each column of `averages` in the volume.
+
+    The cardiac and respiratory features are only computed if their column is in the recording.
+
+    Parameters
+    ----------
+    run : PhysioRun
+        Recording, see `PhysioLoader`.
+    tr : float
+        Repetition time, in seconds. Each volume averages the samples of [onset,onset+tr).
+    n_volumes : int
+        Number of volumes. If None, the number of onsets is used. Default is None.
+    onsets : numpy.ndarray
+        Onsets of the volumes, in seconds. If None, they are found in the trigger column, or are
+        multiples of `tr` if there is none. Default is None.
+    cardiac : str
+        Name of the cardiac column. Default is "cardiac".
+    respiratory : str
+        Name of the respiratory column. Default is "respiratory".
+    trigger : str
+        Name of the trigger column, see `get_volume_onsets`. Default is "trigger".
+    averages : list of str
+        Columns averaged in each volume. Default is None, for no averages.
+
+    Returns
+    -------
+    features : numpy.ndarray
+        Features of each volume, of shape (n_volumes,n_features).
+    names : list of str
+        Names of the features.
+    """
+    if onsets is None:
+        if trigger in run.columns:
+            onsets = get_volume_onsets(run, trigger)
+        elif n_volumes is not None:
+            onsets = np.arange(n_volumes) * tr
+        else:
+            raise ValueError("n_volumes must be set when there is no trigger column.")
+    onsets = np.asarray(onsets, dtype=float)[:n_volumes]
+    stops = onsets + tr
+    times = run.times
+    fs = run.sampling_frequency
+    onset_indices = sample_index(times, onsets)
+    names, features = [], []
+    if cardiac in run.columns:
+        analytic = analytic_signal(run[cardiac], fs, CARDIAC_BAND)
+        phase = np.angle(analytic[onset_indices])
+        peaks, _ = signal.find_peaks(analytic.real, distance=max(1, int(fs / CARDIAC_BAND[1])))
+        peak_times = times[peaks]
+        if len(peaks) < 2:
+            # e.g. a flat or disconnected channel, without any heart beat
+            heart_rate = np.full(len(onsets), np.nan)
+        else:
+            heart_rate = np.interp(times, peak_times[1:], 60 / np.diff(peak_times))
+            heart_rate = window_mean(times, heart_rate, onsets, stops)
+        names += ["cardiac_sin", "cardiac_cos", "heart_rate"]
+        features += [np.sin(phase), np.cos(phase), heart_rate]
+    if respiratory in run.columns:
+        analytic = analytic_signal(run[respiratory], fs, RESPIRATORY_BAND)
+        phase = np.unwrap(np.angle(analytic))
+        frequency = np.gradient(phase) * fs / (2 * np.pi)
+        rvt = 2 * np.abs(analytic) * frequency
+        phase = phase[onset_indices]
+        names += ["respiratory_sin", "respiratory_cos", "rvt"]
+        features += [np.sin(phase), np.cos(phase), window_mean(times, rvt, onsets, stops)]
+    if averages:
+        indices = [run.columns.index(column) for column in averages]
+        names += ["mean_" + column for column in averages]
+        features += list(window_mean(times, run.data[:, indices], onsets, stops).T)
+    features = np.stack(features, axis=1) if features else np.empty((len(onsets), 0))
+    return features, names
+
+
+class PhysioRun(object):
+    """Physiological recording of a run, backed by a memory map.
+
+    The samples are stored by column, so that reading a channel reads a contiguous block of the
+    file.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Samples, array of shape (n_samples,n_columns) in Fortran order.
+    columns : list of str
+        Names of the columns.
+    sampling_frequency : float
+        Sampling frequency, in Hz.
+    start_time : float
+        Time of the first sample relative to the start of the first volume of the run, in
+        seconds.
+    path : str
+        Path to the physio file of the run.
+    """
+
+    def __init__(self, data, columns, sampling_frequency, start_time=0.0, path=None):
+        self.data = data
+        self.columns = list(columns)
+        self.sampling_frequency = sampling_frequency
+        self.start_time = start_time
+        self.path = path
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, column):
+        """Get the samples of a column, by name."""
+        return self.data[:, self.columns.index(column)]
+
+    @property
+    def times(self):
+        """Time of each sample relative to the start of the first volume, in seconds."""
+        return self.start_time + np.arange(len(self)) / self.sampling_frequency
+
+    def features(self, tr, n_volumes=None, **kwargs):
+        """Compute the features of each volume of the run, see `physio_features`."""
+        return physio_features(self, tr, n_volumes, **kwargs)
+
+
+class PhysioLoader(BaseLoader):
+    """Loader of the physiological recordings of a BIDS dataset, as memory maps.
+
+    Parsing a large physio.tsv.gz file takes long, so each file is decompressed and parsed once,
+    one chunk of samples at a time, into a .npy file of the cache, which is then memory mapped.
+
+    Example
+    -------
+    ```
+    loader = PhysioLoader("cneuromod/shinobi")
+    for run in loader.get_physio(subject="01", task="shinobi"):
+        cardiac = run["cardiac"]
+    ```
+
+    Parameters
+    ----------
+    root : str
+        Path to the root of the BIDS dataset.
+    physio_cache : DiskCache or str
+        Cache of the parsed recordings, or path to its directory. If None, the "physio" folder of
+        the bids_loader cache is used. Default is None.
+    dtype : numpy.dtype
+        Type of the samples. Default is float32.
+    **kwargs
+        Parameters passed to `BaseLoader`.
+    """
+
+    def __init__(self, root, physio_cache=None, dtype=np.float32, **kwargs):
+        super(PhysioLoader, self).__init__(root, **kwargs)
+        if physio_cache is None:
+            physio_cache = os.path.join(get_cache_dir(), "physio")
+        if not isinstance(physio_cache, DiskCache):
+            physio_cache = DiskCache(physio_cache)
+        self.physio_cache = physio_cache
+        self.dtype = np.dtype(dtype)
+
+    def get_physio(self, **entities):
+        """Open the physio recordings matching BIDS entities.
+
+        Parameters
+        ----------
+        **entities
+            BIDS entities of the recordings, e.g. `subject="01", task="shinobi"`.
+
+        Returns
+        -------
+        list of PhysioRun
+            Recordings matching the entities.
+        """
+        paths = self.layout.get(
+            suffix="physio", extension=".tsv.gz", return_type="filename", **entities
+        )
+        return [self.open_physio(path) for path in paths]
+
+    def open_physio(self, path, chunk_size=1 << 16):
+        """Open a physio recording as a memory map, parsing it in the cache if needed.
+
+        Parameters
+        ----------
+        path : str
+            Path to the `*_physio.tsv.gz` file.
+        chunk_size : int
+            Number of samples parsed at a time when the recording is added to the cache. Default
+            is 65536.
+
+        Returns
+        -------
+        PhysioRun
+            Memory-mapped recording.
+        """
+        sidecar = read_sidecar(path)
+        columns = sidecar["Columns"]
+        stat = os.stat(path)
+        key = hash_key(
+            "physio", os.path.abspath(path), stat.st_mtime_ns, stat.st_size, self.dtype.str
+        )
+        cached_path = self.physio_cache.get_path(key, ".npy")
+        if cached_path is None:
+            with self.physio_cache.writing(key, ".npy") as tmp_path:
+                self._write_columns(path, columns, tmp_path, chunk_size)
+            cached_path = self.physio_cache.get_path(key, ".npy")
+        data = np.load(cached_path, mmap_mode="r")
+        return PhysioRun(
+            data,
+            columns,
+            float(sidecar["SamplingFrequency"]),
+            float(sidecar.get("StartTime", 0.0)),
+            path,
+        )
+
+    def _write_columns(self, path, columns, npy_path, chunk_size):
+        """Parse a physio file into a .npy file in Fortran order.
+
+        The number of samples is only known at the end of the file, so each column is first
+        appended to its own temporary file, and the columns are then concatenated after the
+        header of the .npy file.
+        """
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(npy_path), suffix=".tmp")
+        try:
+            column_files = [
+                open(os.path.join(tmp_dir, "{}.bin".format(i)), "wb") for i in range(len(columns))
+            ]
+            n_samples = 0
+            try:
+                for chunk in read_physio(path, columns, self.dtype, chunk_size):
+                    for i, column_file in enumerate(column_files):
+                        column_file.write(np.ascontiguousarray(chunk[:, i]).tobytes())
+                    n_samples += len(chunk)
+            finally:
+                for column_file in column_files:
+                    column_file.close()
+            header = {
+                "descr": np.lib.format.dtype_to_descr(self.dtype),
+                "fortran_order": True,
+                "shape": (n_samples, len(columns)),
+            }
+            with open(npy_path, "wb") as f:
+                np.lib.format.write_array_header_1_0(f, header)
+                for column_file in column_files:
+                    with open(column_file.name, "rb") as column:
+                        shutil.copyfileobj(column, f)
+        finally:
+            shutil.rmtree(tmp_dir)
@@ -0,0 +1,198 @@
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+
+def _slot_arrays(blocks, layouts, batch_size):
+    """Make the arrays of a slot of the ring over its shared memory blocks."""
+    return [
+        np.ndarray((batch_size,) + shape, dtype=dtype, buffer=block.buf)
+        for block, (dtype, shape) in zip(blocks, layouts)
+    ]
+
+
+def _prefetch_worker(dataset, slot_names, layouts, batch_size, tasks, results):
+    """Fill the slots of the ring with the items of the batches received in `tasks`."""
+    blocks = [[shared_memory.SharedMemory(name) for name in names] for names in slot_names]
+    slots = [_slot_arrays(slot_blocks, layouts, batch_size) for slot_blocks in blocks]
+    try:
+        for batch, slot, indices in iter(tasks.get, None):
+            try:
+                for i, index in enumerate(indices):
+                    for array, value in zip(slots[slot], dataset[index]):
+                        array[i] = value
+                results.put((batch, slot, None))
+            except Exception:
+                results.put((batch, slot, traceback.format_exc()))
+    finally:
+        del slots
+        for slot_blocks in blocks:
+            for block in slot_blocks:
+                block.close()
+
+
+class SharedMemoryPrefetcher(object):
+    """Iterate over batches of a dataset prefetched by worker processes into shared memory.
+
+    The items of a dataset, e.g. the stimulus and BOLD windows of a `WindowDataset`, are tuples
+    of arrays with the same shapes and types. The prefetcher allocates a ring of `n_buffers`
+    slots, each holding one batch of each array in a `multiprocessing.shared_memory` block. The
+    worker processes write the items of a batch in place in its slot and only send back its
+    index, so that no array is pickled, and the batches are given as views of the slots, without
+    copying them.
+
+    The views of a batch are only valid until the next batch is requested, after which its slot
+    is filled again: they must be copied to be kept.
+
+    Example
+    -------
+    ```
+    with SharedMemoryPrefetcher(dataset, batch_size=32, n_workers=8, shuffle=True) as batches:
+        for epoch in range(n_epochs):
+            for stimulus, bold in batches:
+                ...
+    ```
+
+    Parameters
+    ----------
+    dataset : object
+        Map-style dataset, with `__len__` and a `__getitem__` returning a tuple of arrays. It is
+        sent to the worker processes, so it must be picklable with the "spawn" start method.
+    batch_size : int
+        Number of items per batch.
+    n_workers : int
+        Number of worker processes. Default is 2.
+    n_buffers : int
+        Number of slots of the ring, i.e. of batches prefetched at most. If None,
+        `2 * n_workers`. Default is None.
+    shuffle : bool
+        Whether to iterate over the items in a random order at each epoch. Default is False.
+    drop_last : bool
+        Whether to skip the last batch if it is smaller than `batch_size`. Default is False.
+    seed : int
+        Seed of the random order of the items. Default is None.
+    context : str
+        Start method of the worker processes, see `multiprocessing.get_context`. If None, the
+        default method is used. Default is None.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        batch_size,
+        n_workers=2,
+        n_buffers=None,
+        shuffle=False,
+        drop_last=False,
+        seed=None,
+        context=None,
+    ):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.random_state = np.random.RandomState(seed)
+        if n_buffers is None:
+            n_buffers = 2 * n_workers
+        first = [np.asarray(value) for value in dataset[0]]
+        self.layouts = [(value.dtype.str, value.shape) for value in first]
+        self._blocks = [
+            [
+                shared_memory.SharedMemory(create=True, size=max(1, batch_size * value.nbytes))
+                for value in first
+            ]
+            for _ in range(n_buffers)
+        ]
+        self._slots = [
+            _slot_arrays(blocks, self.layouts, batch_size) for blocks in self._blocks
+        ]
+        context = multiprocessing.get_context(context)
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        slot_names = [[block.name for block in blocks] for blocks in self._blocks]
+        self._workers = [
+            context.Process(
+                target=_prefetch_worker,
+                args=(dataset, slot_names, self.layouts, batch_size, self._tasks, self._results),
+                daemon=True,
+            )
+            for _ in range(n_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return -(-len(self.dataset) // self.batch_size)
+
+    def _batches(self):
+        indices = np.arange(len(self.dataset))
+        if self.shuffle:
+            self.random_state.shuffle(indices)
+        return [
+            indices[start : start + self.batch_size].tolist()
+            for start in range(0, len(self) * self.batch_size, self.batch_size)
+        ]
+
+    def __iter__(self):
+        """Iterate over the batches of an epoch.
+
+        Yields
+        ------
+        tuple of numpy.ndarray
+            Views of the arrays of the batch in shared memory, of shape (batch_size,...), or less
+            for the last batch.
+        """
+        if self._workers is None:
+            raise ValueError("The prefetcher is closed.")
+        batches = self._batches()
+        ready = {}
+        for batch in range(min(len(self._slots), len(batches))):
+            self._tasks.put((batch, batch, batches[batch]))
+        pending = min(len(self._slots), len(batches))
+        try:
+            for batch in range(len(batches)):
+                while batch not in ready:
+                    done, slot, error = self._results.get()
+                    pending -= 1
+                    if error is not None:
+                        raise RuntimeError("Prefetch worker failed:\n" + error)
+                    ready[done] = slot
+                slot = ready.pop(batch)
+                n_items = len(batches[batch])
+                yield tuple(array[:n_items] for array in self._slots[slot])
+                if batch + len(self._slots) < len(batches):
+                    next_batch = batch + len(self._slots)
+                    self._tasks.put((next_batch, slot, batches[next_batch]))
+                    pending += 1
+        finally:
+            # wait for the batches still being written, so that the next epoch starts clean
+            for _ in range(pending):
+                self._results.get()
+
+    def close(self):
+        """Stop the worker processes and free the shared memory."""
+        if self._workers is None:
+            return
+        for _ in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = None
+        self._slots = None
+        for blocks in self._blocks:
+            for block in blocks:
+                try:
+                    block.close()
+                except BufferError:
+                    # views of the last batch are still used, the memory is freed with them
+                    pass
+                block.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,198 @@
+import numpy as np
+from scipy import signal
+from nilearn.glm.first_level import hemodynamic_models
+from ..timing import sample_index, window_mean
+
+#: Modes of alignment of `align_samples`.
+ALIGN_MODES = ("bin", "hrf", "window")
+
+
+def _get_windows(onsets, events_or_tr, n_volumes):
+    """Get the start and stop of the windows of time to align samples to."""
+    if np.ndim(events_or_tr) == 0:
+        tr = float(events_or_tr)
+        if n_volumes is None:
+            n_volumes = int(np.ceil(onsets[-1] / tr)) if len(onsets) else 0
+        starts = np.arange(n_volumes) * tr
+        return starts, starts + tr
+    if hasattr(events_or_tr, "keys") and "onset" in events_or_tr.keys():
+        starts = np.asarray(events_or_tr["onset"], dtype=float)
+        return starts, starts + np.asarray(events_or_tr["duration"], dtype=float)
+    starts = np.asarray(events_or_tr, dtype=float)
+    # each window lasts until the next onset, and the last one as long as the one before
+    stops = np.r_[starts[1:], 2 * starts[-1] - starts[-2] if len(starts) > 1 else np.inf]
+    return starts, stops
+
+
+def _hold(samples, onsets, times, values):
+    """Replace the NaNs of values at given times by the last sample shown at these times.
+
+    The values stay NaN before the first sample and after the last one, assuming it lasts as long
+    as the median interval between samples.
+    """
+    empty = np.isnan(values).reshape((len(values), -1)).any(axis=1)
+    if not empty.any():
+        return values
+    period = np.median(np.diff(onsets)) if len(onsets) > 1 else np.inf
+    times = times[empty]
+    inside = (times >= onsets[0]) & (times < onsets[-1] + period)
+    held = values[empty]
+    held[inside] = samples[sample_index(onsets, times[inside])]
+    values[empty] = held
+    return values
+
+
+def align_samples(
+    samples,
+    onsets,
+    events_or_tr,
+    mode="bin",
+    n_volumes=None,
+    window=1,
+    oversampling=16,
+    hrf_model="glover",
+):
+    """Align the samples of a stimulus to fMRI volumes or events, without looping over them.
+
+    Parameters
+    ----------
+    samples : numpy.ndarray
+        Samples of the stimulus, e.g. frames or features, array of shape (n_samples,...).
+    onsets : numpy.ndarray
+        Sorted onset of each sample, in seconds, of shape (n_samples,).
+    events_or_tr : float or numpy.ndarray or pandas.DataFrame
+        Repetition time, to align to volumes starting at multiples of it, or onsets of windows,
+        each lasting until the next one, or events with "onset" and "duration" columns, e.g. of a
+        BIDS events.tsv file.
+    mode : str
+        How the samples are aligned, one of:
+        "bin": mean of the samples in each window, or the sample shown at its start if there is
+        none,
+        "hrf": samples convolved with a hemodynamic response function, at the start of each
+        volume, which requires a repetition time,
+        "window": the last `window` samples before the end of each window.
+        Default is "bin".
+    n_volumes : int
+        Number of volumes, when aligning to a repetition time. If None, enough volumes to cover
+        the samples. Default is None.
+    window : int
+        Number of samples per window in "window" mode. Default is 1.
+    oversampling : int
+        Number of time bins per volume in which the samples are averaged before their convolution,
+        in "hrf" mode. Default is 16.
+    hrf_model : str
+        Hemodynamic response function in "hrf" mode, "glover" or "spm". Default is "glover".
+
+    Returns
+    -------
+    numpy.ndarray
+        Aligned samples, float array of shape (n_windows,...) in "bin" and "hrf" modes, array of
+        shape (n_windows,window,...) of the samples in "window" mode. Windows outside of the
+        stimulus are NaN, or zero before convolution in "hrf" mode, and the first sample is
+        repeated before the start of the stimulus in "window" mode.
+    """
+    if mode not in ALIGN_MODES:
+        raise ValueError("Unknown mode {}, must be one of {}.".format(mode, ALIGN_MODES))
+    onsets = np.asarray(onsets, dtype=float)
+    if mode == "hrf":
+        if np.ndim(events_or_tr) != 0:
+            raise ValueError("A repetition time is required in hrf mode.")
+        tr = float(events_or_tr)
+        starts, _ = _get_windows(onsets, tr, n_volumes)
+        dt = tr / oversampling
+        times = np.arange(len(starts) * oversampling) * dt
+        binned = _hold(samples, onsets, times, window_mean(onsets, samples, times, times + dt))
+        binned = np.nan_to_num(binned.reshape((len(times), -1)))
+        hrf = getattr(hemodynamic_models, hrf_model + "_hrf")(tr, oversampling)
+        convolved = signal.fftconvolve(binned, hrf[:, None], axes=0)[: len(times)]
+        return convolved[::oversampling].reshape((len(starts),) + np.shape(samples)[1:])
+    starts, stops = _get_windows(onsets, events_or_tr, n_volumes)
+    if mode == "window":
+        last = np.searchsorted(onsets, stops, side="left") - 1
+        indices = np.clip(last[:, None] + np.arange(1 - window, 1), 0, len(onsets) - 1)
+        return samples[indices]
+    return _hold(samples, onsets, starts, window_mean(onsets, samples, starts, stops))
+
+
+class Stimulus(object):
+    """Samples of a stimulus with their onsets, e.g. the frames of a video or a game.
+
+    Parameters
+    ----------
+    samples : numpy.ndarray
+        Samples of the stimulus, array of shape (n_samples,...).
+    onsets : numpy.ndarray
+        Sorted onset of each sample, in seconds, of shape (n_samples,).
+    """
+
+    def __init__(self, samples, onsets):
+        self.samples = samples
+        self.onsets = onsets
+
+    def __len__(self):
+        return len(self.samples)
+
+    def align_to(self, events_or_tr, mode="bin", **kwargs):
+        """Align the samples to fMRI volumes or events, see `align_samples`."""
+        return align_samples(self.samples, self.onsets, events_or_tr, mode, **kwargs)
+
+
+class StimulusLoader(object):
+    """Base class of the loaders of stimuli.
+
+    Subclasses implement `load`, returning the samples of a stimulus file along with their
+    onsets, and share the alignment of the samples to fMRI volumes or events.
+    """
+
+    def load(self, path, **kwargs):
+        """Load the samples of a stimulus file.
+
+        Parameters
+        ----------
+        path : str
+            Path to the stimulus file.
+        **kwargs
+            Options of the loader.
+
+        Returns
+        -------
+        Stimulus
+            Samples of the stimulus and their onsets.
+        """
+        raise NotImplementedError
+
+    def align_to(
+        self,
+        path,
+        events_or_tr,
+        mode="bin",
+        n_volumes=None,
+        window=1,
+        oversampling=16,
+        hrf_model="glover",
+        **kwargs
+    ):
+        """Load the samples of a stimulus file and align them to fMRI volumes or events.
+
+        Parameters
+        ----------
+        path : str
+            Path to the stimulus file.
+        events_or_tr, mode, n_volumes, window, oversampling, hrf_model
+            Alignment of the samples, see `align_samples`.
+        **kwargs
+            Options of the loader, see `load`.
+
+        Returns
+        -------
+        numpy.ndarray
+            Aligned samples.
+        """
+        return self.load(path, **kwargs).align_to(
+            events_or_tr,
+            mode,
+            n_volumes=n_volumes,
+            window=window,
+            oversampling=oversampling,
+            hrf_model=hrf_model,
+        )
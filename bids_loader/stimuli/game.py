@@ -1,8 +1,733 @@
+import os
+import json
+import wave
+import zipfile
+import tempfile
+import warnings
+import itertools
+import collections
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import numpy as np
 import retro
+from ..cache import DiskCache, get_cache_dir, hash_file, hash_key
+from .base import Stimulus, StimulusLoader
+
+
+OUTPUTS = ("frames", "keys", "reward", "done", "info", "audio")
+
+# systems whose memory is stored by the emulator as native (little-endian) words of the given
+# size, that gym-retro swaps back when reading the variables of the data.json file
+_RAM_WORD_SIZES = {"Genesis": 2}
+
+# custom integration paths registered in this process, see `register_integrations`
+_registered_paths = set()
+# results of `verify_rom` in this process, by rom path
+_verified_roms = {}
+
+
+def find_integrations(stimuli_path):
+    """Find the custom game integrations in the tree of a stimuli folder.
+
+    An integration is a folder with the data.json and metadata.json files of a game, named after
+    the game, e.g. `stimuli/ShinobiIIIReturnOfTheNinjaMaster-Genesis`.
+
+    Parameters
+    ----------
+    stimuli_path : str
+        Path to the stimuli folder of a dataset.
+
+    Returns
+    -------
+    dict of str
+        Absolute path to the folder of each integration, by name of the game.
+    """
+    integrations = {}
+    for dirpath, dirnames, filenames in os.walk(os.path.abspath(stimuli_path)):
+        if "data.json" in filenames and "metadata.json" in filenames:
+            integrations[os.path.basename(dirpath)] = dirpath
+            # integrations are not nested
+            dirnames[:] = []
+        else:
+            dirnames[:] = sorted(name for name in dirnames if not name.startswith("."))
+    return integrations
+
+
+def _rom_key(rom_path, sha_path):
+    rom_stat, sha_stat = os.stat(rom_path), os.stat(sha_path)
+    return [rom_stat.st_mtime_ns, rom_stat.st_size, sha_stat.st_mtime_ns, sha_stat.st_size]
+
+
+def verify_rom(integration_path, cache_path=None):
+    """Check that the rom.md file of an integration matches the SHA1 hash of its rom.sha file.
+
+    Hashing a rom takes long compared to a short replay, so the result is saved in a JSON file
+    and reused as long as the modification time and size of the rom and rom.sha files don't
+    change.
+
+    Parameters
+    ----------
+    integration_path : str
+        Path to the folder of the integration, see `find_integrations`.
+    cache_path : str
+        Path to the JSON file of the results. If None, "roms.json" in the bids_loader cache is
+        used. Default is None.
+
+    Returns
+    -------
+    bool
+        Whether the rom exists and matches one of the hashes of rom.sha.
+    """
+    rom_path = os.path.join(os.path.abspath(integration_path), "rom.md")
+    sha_path = os.path.join(os.path.abspath(integration_path), "rom.sha")
+    if not os.path.exists(rom_path) or not os.path.exists(sha_path):
+        return False
+    key = _rom_key(rom_path, sha_path)
+    if _verified_roms.get(rom_path, (None,))[0] == key:
+        return _verified_roms[rom_path][1]
+    if cache_path is None:
+        cache_path = os.path.join(get_cache_dir(), "roms.json")
+    try:
+        with open(cache_path) as f:
+            results = json.load(f)
+    except (FileNotFoundError, ValueError):
+        results = {}
+    if results.get(rom_path, [None])[:-1] == key:
+        valid = results[rom_path][-1]
+    else:
+        with open(sha_path) as f:
+            hashes = {line.strip().lower() for line in f if line.strip()}
+        valid = hash_file(rom_path) in hashes
+        results[rom_path] = key + [valid]
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache_path)))
+        with os.fdopen(fd, "w") as f:
+            json.dump(results, f)
+        os.replace(tmp_path, cache_path)
+    _verified_roms[rom_path] = (key, valid)
+    return valid
+
+
+def register_integrations(stimuli_path, verify=True):
+    """Register the custom integrations of a stimuli folder in gym-retro.
+
+    The parent folder of each integration is given to `retro.data.Integrations.add_custom_path`
+    once per process, and the rom of each integration is checked with `verify_rom`, with a
+    warning if it is missing or doesn't match.
+
+    Example
+    -------
+    ```
+    register_integrations(os.path.join(dataset_path, "stimuli"))
+    replay = replay_bk2_array(bk2_path)
+    ```
+
+    Parameters
+    ----------
+    stimuli_path : str
+        Path to the stimuli folder of a dataset.
+    verify : bool
+        Whether to check the roms of the integrations. Default is True.
+
+    Returns
+    -------
+    dict of str
+        Absolute path to the folder of each integration, by name of the game.
+    """
+    integrations = find_integrations(stimuli_path)
+    for game, integration_path in sorted(integrations.items()):
+        if verify and not verify_rom(integration_path):
+            warnings.warn(
+                "The rom.md file of {} is missing or doesn't match its rom.sha file, in {}. See "
+                "Game_integration.md.".format(game, integration_path)
+            )
+        custom_path = os.path.dirname(integration_path)
+        if custom_path not in _registered_paths:
+            retro.data.Integrations.add_custom_path(custom_path)
+            _registered_paths.add(custom_path)
+    return integrations
+
+
+def _bk2_length(bk2_path):
+    """Count the frames recorded in a bk2 movie, without emulating it.
+
+    The input log of a bk2 file holds one `|...|` line per recorded frame, so the length of the
+    replay is known before the emulator is even created.
+    """
+    with zipfile.ZipFile(bk2_path) as archive:
+        with archive.open("Input Log.txt") as input_log:
+            return sum(1 for line in input_log if line.startswith(b"|"))
+
+
+def _start_replay(bk2_path, skip_first_step, scenario, inttype, replayer=None):
+    """Open a bk2 movie and an emulator set to the movie's initial state.
+
+    The emulator is taken from `replayer` if it is not None, otherwise a new one is made.
+    """
+    movie = retro.Movie(bk2_path)
+    if replayer is None:
+        emulator = retro.make(movie.get_game(), scenario=scenario, inttype=inttype)
+    else:
+        emulator = replayer._acquire(movie.get_game(), scenario, inttype)
+    emulator.initial_state = movie.get_state()
+    emulator.reset()
+    if skip_first_step:
+        movie.step()
+    return movie, emulator
+
+
+def _stop_replay(emulator, replayer=None):
+    """Close the emulator of a replay, or give it back to its `replayer`."""
+    if replayer is None:
+        emulator.close()
+    else:
+        replayer._release()
+
+
+def _get_keys(movie, emulator):
+    """Read the keypresses of the current movie frame, for all players."""
+    keys = []
+    for p in range(movie.players):
+        for i in range(emulator.num_buttons):
+            keys.append(movie.get_key(i, p))
+    return keys
+
+
+def _step_emulator(emulator, keys):
+    """Emulate one frame with the given keypresses and return the reward and done condition.
+
+    This is the part of `RetroEnv.step` that has to run on every frame, the screen and the
+    variables of the data.json file are only read by the caller for the frames it keeps.
+    """
+    for p, action in enumerate(emulator.action_to_array(keys)):
+        emulator.em.set_button_mask(action, p)
+    emulator.em.step()
+    emulator.data.update_ram()
+    if emulator.players > 1:
+        reward = [emulator.data.current_reward(p) for p in range(emulator.players)]
+    else:
+        reward = emulator.data.current_reward()
+    return reward, bool(emulator.data.is_done())
+
+
+def _select_frames(
+    n_frames,
+    fps,
+    frame_stride=None,
+    target_fps=None,
+    tr=None,
+    onsets=None,
+    start=None,
+    stop=None,
+):
+    """Compute the sorted indices of the frames to keep out of the `n_frames` of a replay."""
+    if sum(option is not None for option in (frame_stride, target_fps, tr, onsets)) > 1:
+        raise ValueError("Only one of frame_stride, target_fps, tr and onsets can be set.")
+    duration = n_frames / fps
+    if frame_stride is not None:
+        indices = np.arange(0, n_frames, frame_stride)
+    elif target_fps is not None:
+        onsets = np.arange(0, duration, 1 / target_fps)
+    elif tr is not None:
+        onsets = np.arange(0, duration, tr)
+    else:
+        indices = np.arange(n_frames)
+    if onsets is not None:
+        indices = np.unique(np.round(np.asarray(onsets, dtype=float) * fps).astype(int))
+    start = 0 if start is None else start
+    stop = n_frames if stop is None else min(stop, n_frames)
+    return indices[(indices >= start) & (indices < stop)]
+
+
+def _checkpoints_path(bk2_path):
+    return os.path.splitext(bk2_path)[0] + "_checkpoints.npz"
+
+
+def _restore_checkpoint(movie, emulator, bk2_path, skip_first_step, checkpoints_path, start):
+    """Restore the last emulator state saved by `checkpoint_bk2` before frame `start`.
+
+    The movie is moved to the frame of the restored state, whose index is returned. If there is
+    no valid checkpoint, nothing is restored and 0 is returned.
+    """
+    if checkpoints_path is None:
+        checkpoints_path = _checkpoints_path(bk2_path)
+    if not start or not os.path.exists(checkpoints_path):
+        return 0
+    with np.load(checkpoints_path) as checkpoints:
+        if (
+            checkpoints["bk2_sha1"].item() != hash_file(bk2_path)
+            or checkpoints["skip_first_step"].item() != skip_first_step
+        ):
+            # checkpoints of another version of the bk2 file
+            return 0
+        frame_indices = checkpoints["frame_indices"]
+        checkpoint = np.searchsorted(frame_indices, start, side="right") - 1
+        bounds = np.r_[0, np.cumsum(checkpoints["state_lengths"])]
+        state = checkpoints["states"][bounds[checkpoint] : bounds[checkpoint + 1]]
+    frame = int(frame_indices[checkpoint])
+    emulator.em.set_state(state.tobytes())
+    # so that the rewards are computed relative to the restored state
+    emulator.data.update_ram()
+    for _ in range(frame):
+        movie.step()
+    return frame
+
+
+def _replay_steps(movie, emulator, frame_indices, first_frame=0, start=0):
+    """Emulate the frames of a movie, yielding only the frames in `frame_indices`.
+
+    The emulation starts at `first_frame`, the movie and emulator must already be at that frame.
+    Yields the index of each kept frame, its keypresses, and the reward and done condition
+    accumulated since the previous kept frame, or since frame `start` for the first one. The
+    emulation stops after the last kept frame.
+    """
+    keep = np.zeros(frame_indices[-1] + 1 if len(frame_indices) else 0, dtype=bool)
+    keep[frame_indices] = True
+    reward = 0
+    done = False
+    for step in range(first_frame, len(keep)):
+        if not movie.step():
+            return
+        keys = _get_keys(movie, emulator)
+        step_reward, step_done = _step_emulator(emulator, keys)
+        if step < start:
+            continue
+        reward = np.add(reward, step_reward)
+        done = done or step_done
+        if keep[step]:
+            yield step, keys, reward, done
+            reward = 0
+            done = False
+
+
+def _check_outputs(outputs):
+    """Check the names of the requested outputs of a replay and return them as a tuple."""
+    outputs = tuple(outputs)
+    for output in outputs:
+        if output not in OUTPUTS + ("ram",):
+            raise ValueError(
+                "Unknown output {}, must be one of {}.".format(output, OUTPUTS + ("ram",))
+            )
+    return outputs
+
+
+def _replay_cache_key(bk2_path, skip_first_step, scenario, inttype, **options):
+    """Compute the cache key of a replay, from the content of all the files it depends on."""
+    game = retro.Movie(bk2_path).get_game()
+    # same resolution of the scenario as retro.make
+    if scenario is None:
+        scenario = "scenario"
+    if scenario.endswith(".json"):
+        scenario_path = scenario
+    else:
+        scenario_path = retro.data.get_file_path(game, scenario + ".json", inttype)
+    with open(retro.data.get_file_path(game, "rom.sha", inttype)) as f:
+        rom_sha = f.read().strip()
+    return hash_key(
+        "replay_bk2",
+        hash_file(bk2_path),
+        rom_sha,
+        hash_file(scenario_path),
+        hash_file(retro.data.get_file_path(game, "data.json", inttype)),
+        bool(skip_first_step),
+        options,
+    )
+
+
+def _ram_columns(addresses, ram_blocks, word_size):
+    """Find the columns of the RAM snapshots that hold the given memory addresses."""
+    addresses = np.asarray(addresses)
+    columns = np.full(addresses.shape, -1, dtype=np.int64)
+    start = 0
+    for offset, size in ram_blocks:
+        in_block = (addresses >= offset) & (addresses < offset + size)
+        # undo the swapping of bytes within the words of the emulator's memory
+        columns[in_block] = start + ((addresses[in_block] - offset) ^ (word_size - 1))
+        start += size
+    if np.any(columns < 0):
+        raise ValueError("Addresses outside of the RAM: {}".format(addresses[columns < 0]))
+    return columns
+
+
+def decode_ram(ram, variables, ram_blocks, ram_word_size=1):
+    """Decode the variables of a data.json file from RAM snapshots, for all the frames at once.
+
+    Parameters
+    ----------
+    ram : numpy.ndarray
+        RAM snapshots, uint8 array of shape (T,ram_size), as recorded in `GameReplay.ram`.
+    variables : dict
+        Definition of the variables, as in the "info" field of the data.json file of the game
+        integration, e.g. `{"score": {"address": 16712082, "type": ">u4"}}`. The types are
+        gym-retro types : endianness (<, >, = or |), kind (u for unsigned, i for signed, d for
+        binary-coded decimal, n for one decimal digit per byte) and number of bytes.
+    ram_blocks : array-like
+        Start address and size of each block of memory in the snapshots, as recorded in
+        `GameReplay.ram_blocks`.
+    ram_word_size : int
+        Size of the words of the emulator's memory, see `GameReplay.ram_word_size`. Default is 1.
+
+    Returns
+    -------
+    dict of numpy.ndarray
+        Values of each variable, integer array of shape (T,).
+    """
+    values = {}
+    for name, variable in variables.items():
+        var_type = variable["type"]
+        endian, kind, n_bytes = var_type[0], var_type[1], int(var_type[2:])
+        columns = _ram_columns(variable["address"] + np.arange(n_bytes), ram_blocks, ram_word_size)
+        if endian == "<" or (endian == "=" and np.little_endian):
+            columns = columns[::-1]
+        # bytes of the variable, most significant first
+        data = np.ascontiguousarray(ram[:, columns])
+        if kind in "ui" and n_bytes in (1, 2, 4, 8):
+            values[name] = data.view(">{}{}".format(kind, n_bytes))[:, 0].astype(np.int64)
+            continue
+        if kind in "ui":
+            digits, base = data, 256
+        elif kind == "d":
+            digits, base = (data >> 4) * 10 + (data & 15), 100
+        elif kind == "n":
+            digits, base = data & 15, 10
+        else:
+            raise ValueError("Unknown type {} for variable {}.".format(var_type, name))
+        weights = base ** np.arange(n_bytes - 1, -1, -1, dtype=np.int64)
+        value = digits.astype(np.int64) @ weights
+        if kind == "i":
+            value = np.where(value >= 1 << (8 * n_bytes - 1), value - (1 << (8 * n_bytes)), value)
+        values[name] = value
+    return values
+
+
+class AudioSink(object):
+    """Collect the per-frame audio chunks of a replay into one contiguous waveform.
+
+    The chunks are appended to a preallocated int16 buffer that grows by doubling its size, or
+    written straight to a WAV file on disk, and the sample offset of each frame is recorded so
+    that the audio stays aligned with the frames.
+
+    Example
+    -------
+    ```
+    sink = AudioSink(audio_rate=sound["audio_rate"])
+    for frame, keys, annotations, sound in replay_bk2(path):
+        sink.append(sound["audio"])
+    sink.close()
+    sink.audio[sink.offsets[t] : sink.offsets[t + 1]]  # audio of frame t
+    ```
+
+    Parameters
+    ----------
+    audio_rate : float
+        Sampling rate of the audio.
+    path : str
+        Path to a WAV file where the audio is written. If None, the audio is kept in memory.
+        Default is None.
+    n_samples : int
+        Expected number of samples, used to preallocate the buffer. Default is 0.
+    n_channels : int
+        Number of audio channels. Default is 2.
+    """
+
+    def __init__(self, audio_rate, path=None, n_samples=0, n_channels=2):
+        self.audio_rate = audio_rate
+        self.path = path
+        self.n_channels = n_channels
+        self._n_samples = 0
+        self._offsets = [0]
+        if path is None:
+            self._buffer = np.empty((max(int(n_samples), 1), n_channels), dtype=np.int16)
+        else:
+            self._wav = wave.open(path, "wb")
+            self._wav.setnchannels(n_channels)
+            self._wav.setsampwidth(2)
+            self._wav.setframerate(int(round(audio_rate)))
+
+    def append(self, chunk):
+        """Append the audio chunk of the next frame, an int16 array of shape (n,n_channels)."""
+        n = len(chunk)
+        if self.path is None:
+            if self._n_samples + n > len(self._buffer):
+                buffer = np.empty(
+                    (max(2 * len(self._buffer), self._n_samples + n), self.n_channels),
+                    dtype=np.int16,
+                )
+                buffer[: self._n_samples] = self._buffer[: self._n_samples]
+                self._buffer = buffer
+            self._buffer[self._n_samples : self._n_samples + n] = chunk
+        else:
+            self._wav.writeframesraw(np.ascontiguousarray(chunk, dtype="<i2").tobytes())
+        self._n_samples += n
+        self._offsets.append(self._n_samples)
+
+    def close(self):
+        """Finish writing the WAV file, if any."""
+        if self.path is not None and self._wav is not None:
+            self._wav.close()
+            self._wav = None
+
+    @property
+    def offsets(self):
+        """Index of the first sample of each frame, integer array of shape (T+1,).
+
+        The audio of frame t is `audio[offsets[t] : offsets[t + 1]]`, and its onset in seconds
+        `offsets[t] / audio_rate`.
+        """
+        return np.array(self._offsets, dtype=np.int64)
+
+    @property
+    def audio(self):
+        """Audio waveform, int16 array of shape (n_samples,n_channels).
+
+        For a WAV file, it is a read-only memory map of the samples in the file.
+        """
+        if self.path is None:
+            return self._buffer[: self._n_samples]
+        self.close()
+        return load_audio(self.path)
+
+
+def load_audio(audio_path):
+    """Open the audio samples of a 16 bit PCM WAV file as a read-only memory map.
+
+    Parameters
+    ----------
+    audio_path : str
+        Path to the WAV file, e.g. given as `audio_path` to `replay_bk2_array`.
+
+    Returns
+    -------
+    numpy.memmap
+        Audio waveform, int16 array of shape (n_samples,n_channels).
+    """
+    with wave.open(audio_path, "rb") as wav:
+        n_channels = wav.getnchannels()
+        n_samples = wav.getnframes()
+    if n_samples == 0:
+        return np.empty((0, n_channels), dtype=np.int16)
+    # the samples are at the end of the file, after the header
+    offset = os.path.getsize(audio_path) - n_samples * n_channels * 2
+    return np.memmap(
+        audio_path, dtype="<i2", mode="r", offset=offset, shape=(n_samples, n_channels)
+    )
+
+
+class GameReplay(object):
+    """Output of a whole bk2 replay, stored in preallocated arrays.
+
+    Attributes
+    ----------
+    frames : numpy.ndarray
+        Frames of the replay, uint8 array of shape (T,H,W,3).
+    keys : numpy.ndarray
+        Keypresses, boolean array of shape (T,n_buttons) where n_buttons is the number of buttons
+        of the emulator times the number of players.
+    rewards : numpy.ndarray
+        Reward at each frame, float array of shape (T,) or (T,n_players) for multiplayer games.
+    done : numpy.ndarray
+        Done condition at each frame, boolean array of shape (T,).
+    info : dict of numpy.ndarray
+        Values of the variables extracted from the emulator's memory, one array of shape (T,) per
+        variable.
+    audio : numpy.ndarray
+        Audio output of the game, int16 array of shape (n_samples,2) of the audio of all the
+        frames.
+    audio_rate : float
+        Sampling rate of the audio.
+    audio_offsets : numpy.ndarray
+        Index of the first sample of each frame in `audio`, integer array of shape (T+1,), see
+        `get_audio`.
+    buttons : list of str
+        Ordered name of the buttons of the emulator.
+    frame_indices : numpy.ndarray
+        Index of each frame in the whole replay, integer array of shape (T,).
+    fps : float
+        Frame rate of the emulator, i.e. of the whole replay.
+    ram : numpy.ndarray
+        Snapshots of the emulator's RAM, uint8 array of shape (T,ram_size).
+    ram_blocks : numpy.ndarray
+        Start address and size of each block of memory in `ram`, integer array of shape
+        (n_blocks,2).
+    ram_word_size : int
+        Size of the words in which the emulator stores its memory.
+    variables : dict
+        Definition of the variables of the data.json file of the game integration.
+
+    The outputs that were not requested from the replay are None.
+    """
+
+    def __init__(
+        self,
+        frames,
+        keys,
+        rewards,
+        done,
+        info,
+        audio,
+        audio_rate,
+        buttons,
+        frame_indices,
+        fps,
+        ram=None,
+        ram_blocks=None,
+        ram_word_size=1,
+        variables=None,
+        audio_offsets=None,
+    ):
+        self.frames = frames
+        self.keys = keys
+        self.rewards = rewards
+        self.done = done
+        self.info = info
+        self.audio = audio
+        self.audio_rate = audio_rate
+        self.audio_offsets = audio_offsets
+        self.buttons = buttons
+        self.frame_indices = frame_indices
+        self.fps = fps
+        self.ram = ram
+        self.ram_blocks = ram_blocks
+        self.ram_word_size = ram_word_size
+        self.variables = variables
+
+    def get_audio(self, t):
+        """Get the audio of frame `t`, an int16 array of shape (n,2)."""
+        return self.audio[self.audio_offsets[t] : self.audio_offsets[t + 1]]
+
+    @property
+    def onsets(self):
+        """Onset of each frame relative to the start of the replay, in seconds."""
+        return self.frame_indices / self.fps
+
+    @property
+    def audio_onsets(self):
+        """Onset of each sample of `audio` relative to the start of the replay, in seconds."""
+        counts = np.diff(self.audio_offsets)
+        first = np.repeat(self.audio_offsets[:-1], counts)
+        return np.repeat(self.onsets, counts) + (np.arange(len(first)) - first) / self.audio_rate
+
+    def decode_ram(self, variables=None):
+        """Decode variables from the RAM snapshots of the replay, without replaying it again.
+
+        Parameters
+        ----------
+        variables : dict
+            Definition of the variables, see `decode_ram`. If None, the variables of the data.json
+            file of the game integration are decoded. Default is None.
+
+        Returns
+        -------
+        dict of numpy.ndarray
+            Values of each variable, integer array of shape (T,).
+        """
+        if self.ram is None:
+            raise ValueError("The RAM was not recorded, replay with `outputs` including 'ram'.")
+        if variables is None:
+            variables = self.variables
+        return decode_ram(self.ram, variables, self.ram_blocks, self.ram_word_size)
+
+    def __len__(self):
+        return len(self.frame_indices)
+
+    def __iter__(self):
+        """Iterate over the frames of the replay, with the same outputs as `replay_bk2`."""
+        for t in range(len(self)):
+            annotations = {}
+            if self.rewards is not None:
+                annotations["reward"] = self.rewards[t].tolist()
+            if self.done is not None:
+                annotations["done"] = bool(self.done[t])
+            if self.info is not None:
+                annotations["info"] = {name: values[t].item() for name, values in self.info.items()}
+            if self.ram is not None:
+                annotations["ram"] = self.ram[t]
+            frame = None if self.frames is None else self.frames[t]
+            keys = None if self.keys is None else self.keys[t].tolist()
+            sound = None
+            if self.audio is not None:
+                sound = {"audio": self.get_audio(t), "audio_rate": self.audio_rate}
+            yield frame, keys, annotations, sound
+
+    def to_arrays(self):
+        """Convert the replay to a flat dictionary of arrays, e.g. to store it in a `DiskCache`."""
+        arrays = {
+            "buttons": np.array(self.buttons, dtype=str),
+            "frame_indices": self.frame_indices,
+            "fps": np.array(self.fps),
+        }
+        outputs = []
+        for output, values in [
+            ("frames", self.frames),
+            ("keys", self.keys),
+            ("reward", self.rewards),
+            ("done", self.done),
+        ]:
+            if values is not None:
+                arrays[output] = values
+                outputs.append(output)
+        if self.info is not None:
+            for name, values in self.info.items():
+                arrays["info/" + name] = values
+            outputs.append("info")
+        if self.audio is not None:
+            arrays["audio"] = self.audio
+            arrays["audio_offsets"] = self.audio_offsets
+            arrays["audio_rate"] = np.array(self.audio_rate)
+            outputs.append("audio")
+        if self.ram is not None:
+            arrays["ram"] = self.ram
+            arrays["ram_blocks"] = self.ram_blocks
+            arrays["ram_word_size"] = np.array(self.ram_word_size)
+            arrays["variables"] = np.array(json.dumps(self.variables))
+            outputs.append("ram")
+        arrays["outputs"] = np.array(outputs, dtype=str)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Build a replay from a dictionary of arrays made by `to_arrays`."""
+        outputs = arrays["outputs"].tolist()
+        info = None
+        if "info" in outputs:
+            info = {name[5:]: values for name, values in arrays.items() if name.startswith("info/")}
+        audio_rate = None
+        if "audio" in outputs:
+            audio_rate = arrays["audio_rate"].item()
+        return cls(
+            frames=arrays.get("frames"),
+            keys=arrays.get("keys"),
+            rewards=arrays.get("reward"),
+            done=arrays.get("done"),
+            info=info,
+            audio=arrays.get("audio"),
+            audio_rate=audio_rate,
+            audio_offsets=arrays.get("audio_offsets"),
+            buttons=arrays["buttons"].tolist(),
+            frame_indices=arrays["frame_indices"],
+            fps=arrays["fps"].item(),
+            ram=arrays.get("ram"),
+            ram_blocks=arrays.get("ram_blocks"),
+            ram_word_size=arrays["ram_word_size"].item() if "ram" in outputs else 1,
+            variables=json.loads(arrays["variables"].item()) if "ram" in outputs else None,
+        )
 
 
 def replay_bk2(
-    bk2_path, skip_first_step=True, scenario=None, inttype=retro.data.Integrations.CUSTOM_ONLY
+    bk2_path,
+    skip_first_step=True,
+    scenario=None,
+    inttype=retro.data.Integrations.CUSTOM_ONLY,
+    cache=None,
+    frame_stride=None,
+    target_fps=None,
+    tr=None,
+    onsets=None,
+    outputs=OUTPUTS,
+    start=None,
+    stop=None,
+    checkpoints_path=None,
+    replayer=None,
 ):
     """Make an iterator that replays a bk2 file, returning frames, keypresses and annotations.
 
@@ -15,6 +740,7 @@ def replay_bk2(
         all_frames.append(frame)
         all_keys.append(keys)
     ```
+    To get the whole replay as arrays, use `replay_bk2_array` instead.
 
     Parameters
     ----------
@@ -31,6 +757,48 @@ def replay_bk2(
         Type of gym-retro integration to use. Default is `retro.data.Integrations.CUSTOM_ONLY`
         for custom integrations, for default integrations shipped with gym-retro, use
         `retro.data.Integrations.STABLE`.
+    cache : DiskCache or str
+        Cache of the replays, or path to its directory. If the replay is in the cache, it is read
+        without running the emulator, otherwise the whole replay is run with `replay_bk2_array`
+        and added to the cache before being iterated over. If None, no cache is used. Default is
+        None.
+    frame_stride : int
+        Keep one frame every `frame_stride` frames. Default is None.
+    target_fps : float
+        Keep the frames closest to a regular sampling at `target_fps` frames per second. Default
+        is None.
+    tr : float
+        Keep the frames closest to the onset of each fMRI volume, given the repetition time in
+        seconds, with the first volume at the start of the replay. Default is None.
+    onsets : array-like of float
+        Keep the frames closest to the given onsets, in seconds from the start of the replay.
+        Default is None.
+    outputs : tuple of str
+        Outputs of the replay, among "frames", "keys", "reward", "done", "info", "audio" and
+        "ram". The screen and audio are not read from the emulator when "frames" and "audio" are
+        not requested, e.g. `outputs=("keys", "info", "reward")` for annotations only. "ram"
+        records a snapshot of the emulator's RAM at each frame. Default is `OUTPUTS`, i.e. all
+        the outputs but "ram".
+    start : int
+        Index of the first frame of the window to replay. The emulator is restored from the last
+        checkpoint saved by `checkpoint_bk2` before `start`, if any, so that only the frames from
+        that checkpoint are emulated. If None, the replay starts at the first frame. Default is
+        None.
+    stop : int
+        Index of the frame after the last frame of the window to replay. If None, the replay goes
+        to the end of the movie. Default is None.
+    checkpoints_path : str
+        Path to the checkpoints of the bk2 file. If None, the default path of `checkpoint_bk2` is
+        used. Default is None.
+    replayer : GameReplayer
+        Replayer whose emulator is used for the replay. If None, a new emulator is made for the
+        replay and closed at its end. Default is None.
+
+    Only one of `frame_stride`, `target_fps`, `tr` and `onsets` can be set, all the frames are
+    kept if none is set. All the frames are still emulated, but the screen, memory variables and
+    audio are only read for the kept frames, and the rewards and done conditions are accumulated
+    since the previous kept frame. The frames are further restricted to the window between
+    `start` and `stop`, the onsets are still relative to the start of the movie.
 
     Yields
     -------
@@ -44,19 +812,559 @@ def replay_bk2(
         the variables that are extracted from the emulator's memory.
     sound : dict
         Dictionnary containing the sound output from the game : audio and audio_rate.
+
+    If "ram" is requested, the annotations also contain the snapshot of the RAM. The outputs that
+    are not requested are None, and the annotations only contain the requested ones.
     """
-    movie = retro.Movie(bk2_path)
-    emulator = retro.make(movie.get_game(), scenario=scenario, inttype=inttype)
-    emulator.initial_state = movie.get_state()
-    emulator.reset()
-    if skip_first_step:
-        movie.step()
-    while movie.step():
-        keys = []
-        for p in range(movie.players):
-            for i in range(emulator.num_buttons):
-                keys.append(movie.get_key(i, p))
-        frame, rew, done, info = emulator.step(keys)
-        sound = {"audio": emulator.em.get_audio(), "audio_rate": emulator.em.get_audio_rate()}
-        annotations = {"reward": rew, "done": done, "info": info}
-        yield frame, keys, annotations, sound
+    selection = {
+        "frame_stride": frame_stride,
+        "target_fps": target_fps,
+        "tr": tr,
+        "onsets": onsets,
+        "start": start,
+        "stop": stop,
+    }
+    outputs = _check_outputs(outputs)
+    if cache is not None:
+        yield from replay_bk2_array(
+            bk2_path,
+            skip_first_step,
+            scenario,
+            inttype,
+            cache=cache,
+            outputs=outputs,
+            checkpoints_path=checkpoints_path,
+            replayer=replayer,
+            **selection
+        )
+        return
+    n_frames = max(_bk2_length(bk2_path) - int(skip_first_step), 0)
+    movie, emulator = _start_replay(bk2_path, skip_first_step, scenario, inttype, replayer)
+    try:
+        frame_indices = _select_frames(n_frames, emulator.em.get_screen_rate(), **selection)
+        first_frame = _restore_checkpoint(
+            movie, emulator, bk2_path, skip_first_step, checkpoints_path, start
+        )
+        for _, keys, rew, done in _replay_steps(
+            movie, emulator, frame_indices, first_frame, start or 0
+        ):
+            frame = emulator.em.get_screen() if "frames" in outputs else None
+            annotations = {}
+            if "reward" in outputs:
+                annotations["reward"] = rew.tolist()
+            if "done" in outputs:
+                annotations["done"] = done
+            if "info" in outputs:
+                annotations["info"] = dict(emulator.data.lookup_all())
+            if "ram" in outputs:
+                annotations["ram"] = emulator.get_ram()
+            sound = None
+            if "audio" in outputs:
+                sound = {
+                    "audio": emulator.em.get_audio(),
+                    "audio_rate": emulator.em.get_audio_rate(),
+                }
+            yield frame, keys if "keys" in outputs else None, annotations, sound
+    finally:
+        _stop_replay(emulator, replayer)
+
+
+def replay_bk2_array(
+    bk2_path,
+    skip_first_step=True,
+    scenario=None,
+    inttype=retro.data.Integrations.CUSTOM_ONLY,
+    cache=None,
+    frames_path=None,
+    audio_path=None,
+    frame_stride=None,
+    target_fps=None,
+    tr=None,
+    onsets=None,
+    outputs=OUTPUTS,
+    start=None,
+    stop=None,
+    checkpoints_path=None,
+    replayer=None,
+):
+    """Replay a whole bk2 file into preallocated arrays.
+
+    The number of frames is read from the bk2 file before the replay starts, so that frames,
+    keypresses and annotations are written in place into arrays allocated once, instead of
+    being accumulated in lists and stacked afterwards.
+
+    Example
+    -------
+    ```
+    replay = replay_bk2_array(path)
+    replay.frames  # (T,H,W,3) uint8 array
+    replay.keys  # (T,n_buttons) boolean array
+    ```
+
+    Parameters
+    ----------
+    bk2_path : str
+        Path to the bk2 file to replay.
+    skip_first_step : bool
+        Whether to skip the first step before starting the replay, see `replay_bk2`. Default is
+        True.
+    scenario : str
+        Path to the scenario json file. If None, the scenario.json file in the game integration
+        folder will be used. Default is None.
+    inttype : gym-retro Integration
+        Type of gym-retro integration to use. Default is `retro.data.Integrations.CUSTOM_ONLY`.
+    cache : DiskCache or str
+        Cache of the replays, or path to its directory. If the replay is in the cache, it is
+        returned without running the emulator, otherwise it is added to the cache. Entries are
+        keyed on the content of the bk2, rom, scenario and data files and on `skip_first_step`.
+        If None, no cache is used. Default is None.
+    frames_path : str
+        Path to a .npy file where the frames are written during the replay, instead of being kept
+        in memory. The frames of the returned replay are then a memory map of that file, which can
+        be opened again later with `load_frames`. It cannot be used along with `cache`. If None,
+        the frames are kept in memory. Default is None.
+    audio_path : str
+        Path to a WAV file where the audio is written during the replay, instead of being kept
+        in memory. The audio of the returned replay is then a memory map of that file, which can
+        be opened again later with `load_audio`. It cannot be used along with `cache`. If None,
+        the audio is kept in memory. Default is None.
+    frame_stride : int
+        Keep one frame every `frame_stride` frames. Default is None.
+    target_fps : float
+        Keep the frames closest to a regular sampling at `target_fps` frames per second. Default
+        is None.
+    tr : float
+        Keep the frames closest to the onset of each fMRI volume, given the repetition time in
+        seconds, with the first volume at the start of the replay. Default is None.
+    onsets : array-like of float
+        Keep the frames closest to the given onsets, in seconds from the start of the replay.
+        Default is None.
+    outputs : tuple of str
+        Outputs of the replay, among "frames", "keys", "reward", "done", "info", "audio" and
+        "ram". The screen and audio are not read from the emulator when "frames" and "audio" are
+        not requested, e.g. `outputs=("keys", "info", "reward")` for annotations only. "ram"
+        records a snapshot of the emulator's RAM at each frame. Default is `OUTPUTS`, i.e. all
+        the outputs but "ram".
+    start : int
+        Index of the first frame of the window to replay. The emulator is restored from the last
+        checkpoint saved by `checkpoint_bk2` before `start`, if any, so that only the frames from
+        that checkpoint are emulated. If None, the replay starts at the first frame. Default is
+        None.
+    stop : int
+        Index of the frame after the last frame of the window to replay. If None, the replay goes
+        to the end of the movie. Default is None.
+    checkpoints_path : str
+        Path to the checkpoints of the bk2 file. If None, the default path of `checkpoint_bk2` is
+        used. Default is None.
+    replayer : GameReplayer
+        Replayer whose emulator is used for the replay. If None, a new emulator is made for the
+        replay and closed at its end. Default is None.
+
+    See `replay_bk2` for the selection of frames.
+
+    Returns
+    -------
+    GameReplay
+        Frames, keypresses, rewards, done conditions, memory variables and audio of the replay.
+    """
+    if cache is not None and (frames_path is not None or audio_path is not None):
+        raise ValueError("frames_path and audio_path cannot be used along with a cache.")
+    outputs = _check_outputs(outputs)
+    selection = {
+        "frame_stride": frame_stride,
+        "target_fps": target_fps,
+        "tr": tr,
+        "onsets": onsets,
+        "start": start,
+        "stop": stop,
+    }
+    if cache is not None:
+        if not isinstance(cache, DiskCache):
+            cache = DiskCache(cache)
+        cache_key = _replay_cache_key(
+            bk2_path,
+            skip_first_step,
+            scenario,
+            inttype,
+            outputs=sorted(outputs),
+            **{name: np.asarray(value).tolist() for name, value in selection.items()},
+        )
+        arrays = cache.get(cache_key)
+        if arrays is not None:
+            return GameReplay.from_arrays(arrays)
+    n_frames = max(_bk2_length(bk2_path) - int(skip_first_step), 0)
+    movie, emulator = _start_replay(bk2_path, skip_first_step, scenario, inttype, replayer)
+    try:
+        fps = emulator.em.get_screen_rate()
+        frame_indices = _select_frames(n_frames, fps, **selection)
+        n_frames = len(frame_indices)
+        frames = None
+        if "frames" in outputs:
+            frames_shape = (n_frames,) + emulator.observation_space.shape
+            if frames_path is None:
+                frames = np.empty(frames_shape, dtype=np.uint8)
+            else:
+                frames = np.lib.format.open_memmap(
+                    frames_path, mode="w+", dtype=np.uint8, shape=frames_shape
+                )
+        keys = np.empty((n_frames, movie.players * emulator.num_buttons), dtype=bool)
+        n_rewards = () if emulator.players == 1 else (emulator.players,)
+        rewards = np.empty((n_frames,) + n_rewards, dtype=np.float64)
+        done = np.empty(n_frames, dtype=bool)
+        info = None
+        audio = None
+        if "audio" in outputs:
+            audio_rate = emulator.em.get_audio_rate()
+            # preallocate the expected number of samples, with some margin
+            n_samples = 1.05 * audio_rate / fps * (frame_indices[-1] + 1 if n_frames else 0)
+            audio = AudioSink(audio_rate, audio_path, n_samples)
+        ram = ram_blocks = variables = None
+        ram_word_size = 1
+        if "ram" in outputs:
+            game = movie.get_game()
+            blocks = emulator.data.memory.blocks
+            ram_blocks = np.array(
+                [(offset, len(blocks[offset])) for offset in sorted(blocks)], dtype=np.int64
+            ).reshape(-1, 2)
+            ram = np.empty((n_frames, ram_blocks[:, 1].sum()), dtype=np.uint8)
+            ram_word_size = _RAM_WORD_SIZES.get(game.rsplit("-", 1)[-1], 1)
+            with open(retro.data.get_file_path(game, "data.json", inttype)) as f:
+                variables = json.load(f).get("info", {})
+        t = 0
+        first_frame = _restore_checkpoint(
+            movie, emulator, bk2_path, skip_first_step, checkpoints_path, start
+        )
+        for _, step_keys, rew, step_done in _replay_steps(
+            movie, emulator, frame_indices, first_frame, start or 0
+        ):
+            keys[t] = step_keys
+            rewards[t] = rew
+            done[t] = step_done
+            if frames is not None:
+                frames[t] = emulator.em.get_screen()
+            if ram is not None:
+                ram[t] = emulator.get_ram()
+            elif "info" in outputs:
+                step_info = emulator.data.lookup_all()
+                if info is None:
+                    info = {name: np.empty(n_frames, dtype=np.int64) for name in step_info}
+                for name, value in step_info.items():
+                    info[name][t] = value
+            if audio is not None:
+                audio.append(emulator.em.get_audio())
+            t += 1
+        if frames_path is not None and frames is not None:
+            frames.flush()
+        if ram is not None:
+            ram = ram[:t]
+            if "info" in outputs:
+                # decode all the variables at once instead of looking them up at each frame
+                info = decode_ram(ram, variables, ram_blocks, ram_word_size)
+        elif "info" in outputs:
+            info = {name: values[:t] for name, values in (info or {}).items()}
+        replay = GameReplay(
+            frames=None if frames is None else frames[:t],
+            keys=keys[:t] if "keys" in outputs else None,
+            rewards=rewards[:t] if "reward" in outputs else None,
+            done=done[:t] if "done" in outputs else None,
+            info=info,
+            audio=None if audio is None else audio.audio,
+            audio_rate=None if audio is None else audio.audio_rate,
+            audio_offsets=None if audio is None else audio.offsets,
+            buttons=list(emulator.buttons),
+            frame_indices=frame_indices[:t],
+            fps=fps,
+            ram=ram,
+            ram_blocks=ram_blocks,
+            ram_word_size=ram_word_size,
+            variables=variables,
+        )
+    finally:
+        _stop_replay(emulator, replayer)
+    if cache is not None:
+        cache.set(cache_key, replay.to_arrays())
+    return replay
+
+
+def checkpoint_bk2(
+    bk2_path,
+    interval=600,
+    skip_first_step=True,
+    scenario=None,
+    inttype=retro.data.Integrations.CUSTOM_ONLY,
+    checkpoints_path=None,
+    replayer=None,
+):
+    """Save the state of the emulator every `interval` frames of a bk2 replay.
+
+    The states are saved in a sidecar file of the bk2 file, from which `replay_bk2` and
+    `replay_bk2_array` restore the closest state before the `start` of a window, so that only
+    the frames of the window are emulated instead of the whole movie from its first frame.
+
+    Example
+    -------
+    ```
+    checkpoint_bk2(path)
+    replay = replay_bk2_array(path, start=32400, stop=33000)
+    ```
+
+    Parameters
+    ----------
+    bk2_path : str
+        Path to the bk2 file to replay.
+    interval : int
+        Number of frames between two saved states. Default is 600, i.e. 10s at 60 fps.
+    skip_first_step : bool
+        Whether to skip the first step before starting the replay, see `replay_bk2`. Default is
+        True.
+    scenario : str
+        Path to the scenario json file. If None, the scenario.json file in the game integration
+        folder will be used. Default is None.
+    inttype : gym-retro Integration
+        Type of gym-retro integration to use. Default is `retro.data.Integrations.CUSTOM_ONLY`.
+    checkpoints_path : str
+        Path to the file where the states are saved. If None, it is saved next to the bk2 file,
+        with the `_checkpoints.npz` suffix instead of the `.bk2` extension. Default is None.
+    replayer : GameReplayer
+        Replayer whose emulator is used for the replay. If None, a new emulator is made for the
+        replay and closed at its end. Default is None.
+
+    Returns
+    -------
+    str
+        Path to the saved checkpoints.
+    """
+    if checkpoints_path is None:
+        checkpoints_path = _checkpoints_path(bk2_path)
+    n_frames = max(_bk2_length(bk2_path) - int(skip_first_step), 0)
+    movie, emulator = _start_replay(bk2_path, skip_first_step, scenario, inttype, replayer)
+    states = []
+    frame_indices = []
+    try:
+        for step in range(n_frames):
+            if step % interval == 0:
+                states.append(np.frombuffer(emulator.em.get_state(), dtype=np.uint8))
+                frame_indices.append(step)
+            if not movie.step():
+                break
+            _step_emulator(emulator, _get_keys(movie, emulator))
+    finally:
+        _stop_replay(emulator, replayer)
+    np.savez_compressed(
+        checkpoints_path,
+        frame_indices=np.array(frame_indices, dtype=np.int64),
+        states=np.concatenate(states) if states else np.empty(0, np.uint8),
+        state_lengths=np.array([len(state) for state in states], dtype=np.int64),
+        bk2_sha1=np.array(hash_file(bk2_path)),
+        skip_first_step=np.array(bool(skip_first_step)),
+    )
+    return checkpoints_path
+
+
+def load_frames(frames_path):
+    """Open the frames written by `replay_bk2_array` as a read-only memory map.
+
+    Slicing the returned array only reads the corresponding frames from disk, e.g.
+    `load_frames(path)[start:stop]` for a time window.
+
+    Parameters
+    ----------
+    frames_path : str
+        Path to the .npy file given as `frames_path` to `replay_bk2_array`.
+
+    Returns
+    -------
+    numpy.memmap
+        Frames of the replay, of shape (T,H,W,3).
+    """
+    return np.load(frames_path, mmap_mode="r")
+
+
+class GameReplayer(StimulusLoader):
+    """Replay bk2 files with a long-lived emulator.
+
+    Making an emulator loads the rom and the integration files of the game, which dominates the
+    replay of short bk2 files. A replayer keeps its emulator from one replay to the next, and only
+    resets it to the initial state of each new movie. As gym-retro allows a single emulator per
+    process, the emulator is closed and a new one is made when the game, scenario or integration
+    type changes, and only one replayer should be used at a time in a process.
+
+    Example
+    -------
+    ```
+    with GameReplayer() as replayer:
+        for path in paths:
+            replay = replayer.replay_array(path, outputs=("keys", "info"))
+    ```
+    """
+
+    def __init__(self):
+        self._emulator = None
+        self._emulator_key = None
+        self._in_use = False
+
+    def _acquire(self, game, scenario, inttype):
+        """Get the emulator of a game, making it if the current one is for another game."""
+        if self._in_use:
+            raise RuntimeError("The emulator of the replayer is already used by another replay.")
+        key = (game, scenario, inttype)
+        if self._emulator_key != key:
+            self.close()
+            self._emulator = retro.make(game, scenario=scenario, inttype=inttype)
+            self._emulator_key = key
+        self._in_use = True
+        return self._emulator
+
+    def _release(self):
+        self._in_use = False
+
+    def replay(self, bk2_path, **kwargs):
+        """Replay a bk2 file frame by frame, see `replay_bk2`."""
+        return replay_bk2(bk2_path, replayer=self, **kwargs)
+
+    def replay_array(self, bk2_path, **kwargs):
+        """Replay a whole bk2 file into arrays, see `replay_bk2_array`."""
+        return replay_bk2_array(bk2_path, replayer=self, **kwargs)
+
+    def checkpoint(self, bk2_path, **kwargs):
+        """Save the emulator states of a bk2 replay, see `checkpoint_bk2`."""
+        return checkpoint_bk2(bk2_path, replayer=self, **kwargs)
+
+    def load(self, bk2_path, samples="frames", **kwargs):
+        """Replay a bk2 file into the samples of a stimulus, with their onsets.
+
+        Parameters
+        ----------
+        bk2_path : str
+            Path to the bk2 file.
+        samples : str
+            Output used as samples, among "frames", "keys", "rewards", "done", "ram" and "audio",
+            or the name of a variable of the info of the replay. Default is "frames".
+        **kwargs
+            Parameters passed to `replay_bk2_array`.
+
+        Returns
+        -------
+        Stimulus
+            Samples of the replay with their onsets.
+        """
+        output = {"rewards": "reward"}.get(samples, samples)
+        if output not in OUTPUTS + ("ram",):
+            output = "info"
+        kwargs.setdefault("outputs", (output,))
+        replay = self.replay_array(bk2_path, **kwargs)
+        if samples == "audio":
+            return Stimulus(replay.audio, replay.audio_onsets)
+        if output == "info":
+            return Stimulus(replay.info[samples], replay.onsets)
+        return Stimulus(getattr(replay, samples), replay.onsets)
+
+    def close(self):
+        """Close the emulator."""
+        if self._emulator is not None:
+            self._emulator.close()
+        self._emulator = None
+        self._emulator_key = None
+        self._in_use = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# replayer of each worker process of `replay_many`
+_worker_replayer = None
+
+
+def _init_replay_worker(integration_paths):
+    """Register the custom integrations in a freshly spawned replay worker."""
+    global _worker_replayer
+    for integration_path in integration_paths:
+        register_integrations(integration_path)
+    _worker_replayer = GameReplayer()
+
+
+def _replay_worker(bk2_path, kwargs, replayer=None):
+    if replayer is None:
+        replayer = _worker_replayer
+    return bk2_path, replay_bk2_array(bk2_path, replayer=replayer, **kwargs)
+
+
+def replay_many(bk2_paths, n_jobs=None, ordered=True, integration_paths=(), **kwargs):
+    """Replay several bk2 files in parallel, over a pool of worker processes.
+
+    gym-retro only allows one emulator per process, so each worker process keeps a single
+    emulator with a `GameReplayer` and the replays are streamed back as they are returned by the
+    workers. At most `2 * n_jobs` files are replayed ahead of the consumer, so that the memory
+    used doesn't grow with the number of files.
+
+    Example
+    -------
+    ```
+    for bk2_path, replay in replay_many(paths, n_jobs=8, integration_paths=[stimuli_path]):
+        np.save(bk2_path.replace(".bk2", "_keys.npy"), replay.keys)
+    ```
+
+    Parameters
+    ----------
+    bk2_paths : list of str
+        Paths to the bk2 files to replay.
+    n_jobs : int
+        Number of worker processes. If None, the number of CPUs is used. If 1, the files are
+        replayed one after the other in the calling process. Default is None.
+    ordered : bool
+        If True, the replays are yielded in the order of `bk2_paths`, otherwise they are yielded
+        as soon as they are finished. Default is True.
+    integration_paths : list of str
+        Stimuli folders whose integrations are registered in each worker process, see
+        `register_integrations`, e.g. the stimuli folder of the dataset. Default is ().
+    **kwargs
+        Parameters passed to `replay_bk2_array` for each file.
+
+    Yields
+    -------
+    bk2_path : str
+        Path to the replayed bk2 file.
+    replay : GameReplay
+        Output of the replay, see `replay_bk2_array`.
+    """
+    bk2_paths = list(bk2_paths)
+    integration_paths = list(integration_paths)
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+    n_jobs = max(min(n_jobs, len(bk2_paths)), 1)
+    if n_jobs == 1:
+        for integration_path in integration_paths:
+            register_integrations(integration_path)
+        with GameReplayer() as replayer:
+            for bk2_path in bk2_paths:
+                yield _replay_worker(bk2_path, kwargs, replayer)
+        return
+    # workers are spawned rather than forked so that they don't inherit the emulator of the
+    # calling process, if any
+    with ProcessPoolExecutor(
+        max_workers=n_jobs,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_replay_worker,
+        initargs=(integration_paths,),
+    ) as executor:
+        # only a few replays are in flight at a time, so that the replays returned by the
+        # workers but not consumed yet don't pile up in memory
+        paths = iter(bk2_paths)
+        pending = collections.deque(
+            executor.submit(_replay_worker, path, kwargs)
+            for path in itertools.islice(paths, 2 * n_jobs)
+        )
+        while pending:
+            if ordered:
+                future = pending.popleft()
+            else:
+                future = next(iter(wait(pending, return_when=FIRST_COMPLETED).done))
+                pending.remove(future)
+            result = future.result()
+            del future
+            for path in itertools.islice(paths, 1):
+                pending.append(executor.submit(_replay_worker, path, kwargs))
+            yield result
@@ -0,0 +1,464 @@
+import os
+import threading
+import numpy as np
+import av
+from ..cache import DiskCache, get_cache_dir, hash_key
+from ..timing import sample_index
+from .base import Stimulus, StimulusLoader
+
+
+def _video_key(video_path):
+    stat = os.stat(video_path)
+    return [os.path.abspath(video_path), stat.st_mtime_ns, stat.st_size]
+
+
+def build_index(video_path):
+    """Index the frames and keyframes of the video stream of a file, without decoding it.
+
+    Parameters
+    ----------
+    video_path : str
+        Path to the video file.
+
+    Returns
+    -------
+    dict of numpy.ndarray
+        Index of the video, with keys:
+        "pts": sorted presentation timestamps of the frames, in units of `time_base`,
+        "keyframes": whether each frame is a keyframe,
+        "time_base": numerator and denominator of the time base of the stream,
+        "start_time": timestamp of the start of the stream,
+        "shape": height and width of the frames.
+    """
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        packets = [
+            (packet.pts, packet.is_keyframe)
+            for packet in container.demux(stream)
+            if packet.pts is not None
+        ]
+        pts, keyframes = zip(*sorted(packets)) if packets else ((), ())
+        return {
+            "pts": np.asarray(pts, dtype=np.int64),
+            "keyframes": np.asarray(keyframes, dtype=bool),
+            "time_base": np.array(
+                [stream.time_base.numerator, stream.time_base.denominator], dtype=np.int64
+            ),
+            "start_time": np.int64(stream.start_time or 0),
+            "shape": np.array([stream.height, stream.width], dtype=np.int64),
+        }
+
+
+class VideoIndex(object):
+    """Index of the frames of a video, see `build_index`.
+
+    Parameters
+    ----------
+    pts : numpy.ndarray
+        Sorted presentation timestamps of the frames.
+    keyframes : numpy.ndarray
+        Whether each frame is a keyframe.
+    time_base : tuple of int
+        Numerator and denominator of the time base of the timestamps, in seconds.
+    start_time : int
+        Timestamp of the start of the stream.
+    shape : tuple of int
+        Height and width of the frames.
+    """
+
+    def __init__(self, pts, keyframes, time_base, start_time, shape):
+        self.pts = pts
+        self.keyframes = keyframes
+        self.time_base = tuple(int(x) for x in time_base)
+        self.start_time = int(start_time)
+        self.shape = tuple(int(x) for x in shape)
+
+    def __len__(self):
+        return len(self.pts)
+
+    @property
+    def times(self):
+        """Time of each frame relative to the start of the stream, in seconds."""
+        return (self.pts - self.start_time) * self.time_base[0] / self.time_base[1]
+
+    @property
+    def fps(self):
+        """Average frame rate of the video."""
+        times = self.times
+        return (len(times) - 1) / (times[-1] - times[0]) if len(times) > 1 else 0.0
+
+    @property
+    def duration(self):
+        """Duration of the video, in seconds."""
+        return len(self) / self.fps if len(self) > 1 else 0.0
+
+    def select_frames(self, frame_stride=None, target_fps=None, tr=None, onsets=None):
+        """Get the indices of the frames shown at given times, or every `frame_stride` frames.
+
+        Only one of the parameters can be set. If none is, all the frames are selected.
+
+        Parameters
+        ----------
+        frame_stride : int
+            Select every `frame_stride` frames. Default is None.
+        target_fps : float
+            Select the frames shown at this rate. Default is None.
+        tr : float
+            Select the frames shown at the onset of each TR. Default is None.
+        onsets : numpy.ndarray
+            Select the frames shown at these times, in seconds. Default is None.
+
+        Returns
+        -------
+        numpy.ndarray
+            Indices of the selected frames, one per time. Indices repeat if the times are denser
+            than the frames.
+        """
+        if sum(option is not None for option in (frame_stride, target_fps, tr, onsets)) > 1:
+            raise ValueError("Only one of frame_stride, target_fps, tr and onsets can be set.")
+        if frame_stride is not None:
+            return np.arange(0, len(self), frame_stride)
+        if target_fps is not None:
+            onsets = np.arange(0, self.duration, 1 / target_fps)
+        elif tr is not None:
+            onsets = np.arange(0, self.duration, tr)
+        elif onsets is None:
+            return np.arange(len(self))
+        return sample_index(self.times, np.asarray(onsets, dtype=float))
+
+    def seek_points(self, frame_indices):
+        """Get the index of the keyframe to seek to in order to decode each frame."""
+        keyframes = np.flatnonzero(self.keyframes)
+        if not len(keyframes) or keyframes[0] != 0:
+            keyframes = np.r_[0, keyframes]
+        return keyframes[np.searchsorted(keyframes, frame_indices, side="right") - 1]
+
+
+def _frame_shape(index, size, format, crop):
+    """Get the shape of the frames decoded with a size, pixel format and crop."""
+    width, height = size if size is not None else index.shape[::-1]
+    if crop is not None:
+        height, width = crop[2:]
+    n_channels = len(av.VideoFormat(format).components)
+    return (height, width) + ((n_channels,) if n_channels > 1 else ())
+
+
+def _decode_frames(container, stream, index, frame_indices, out, size, format, crop):
+    """Decode the frames at sorted indices of a video into `out`, seeking only when needed.
+
+    A seek is made to the keyframe of a frame only if it lies after the last decoded frame, so
+    that frames close to each other are decoded in a single pass.
+    """
+    width, height = size if size is not None else index.shape[::-1]
+    if crop is not None:
+        top, left, crop_height, crop_width = crop
+        window = np.s_[top : top + crop_height, left : left + crop_width]
+    seek_points = index.seek_points(frame_indices)
+    position = -1
+    frames = None
+    for i, (frame_index, seek_point) in enumerate(zip(frame_indices, seek_points)):
+        if frames is None or seek_point > position:
+            container.seek(int(index.pts[seek_point]), stream=stream, backward=True)
+            frames = container.decode(stream)
+            position = seek_point - 1
+        while position < frame_index:
+            frame = next(frames)
+            position = int(np.searchsorted(index.pts, frame.pts))
+        if position != frame_index:
+            raise ValueError("Frame {} was not found in the video.".format(frame_index))
+        array = frame.to_ndarray(format=format, width=width, height=height)
+        out[i] = array if crop is None else array[window]
+    return out
+
+
+def _decode_selection(container, stream, index, frame_indices, out, size, format, crop):
+    """Decode frames at any indices into `out`, decoding each distinct frame once."""
+    unique_indices, inverse = np.unique(frame_indices, return_inverse=True)
+    # decode each distinct frame in place at its first occurrence, then copy it to the others
+    first = np.full(len(unique_indices), len(frame_indices))
+    np.minimum.at(first, inverse, np.arange(len(frame_indices)))
+    _decode_frames(
+        container, stream, index, unique_indices, _Slots(out, first), size, format, crop
+    )
+    repeated = np.flatnonzero(first[inverse] != np.arange(len(frame_indices)))
+    out[repeated] = out[first[inverse[repeated]]]
+    return out
+
+
+class _Slots(object):
+    """View of an array where item i is row `rows[i]`, to decode frames in place."""
+
+    def __init__(self, array, rows):
+        self.array = array
+        self.rows = rows
+
+    def __setitem__(self, i, value):
+        self.array[self.rows[i]] = value
+
+
+class _BatchDecoder(object):
+    """Decode batches of frames on background threads into a ring of preallocated buffers.
+
+    Batch b is decoded by thread `b % n_threads` into buffer `b % n_buffers`, once the consumer
+    released batch `b - n_buffers` from that buffer. Batches are given to the consumer in order,
+    only once they are fully decoded.
+    """
+
+    def __init__(self, video_path, index, batches, n_threads, n_buffers, size, format, crop):
+        self.video_path = video_path
+        self.index = index
+        self.batches = batches
+        self.size = size
+        self.format = format
+        self.crop = crop
+        shape = (max(len(batch) for batch in batches),) + _frame_shape(index, size, format, crop)
+        self.buffers = [np.empty(shape, dtype=np.uint8) for _ in range(n_buffers)]
+        self.condition = threading.Condition()
+        self.ready = set()
+        self.released = 0
+        self.error = None
+        self.stopped = False
+        self.threads = [
+            threading.Thread(target=self._decode, args=(i, n_threads), daemon=True)
+            for i in range(min(n_threads, len(batches)))
+        ]
+
+    def _decode(self, first_batch, n_threads):
+        try:
+            with av.open(self.video_path) as container:
+                stream = container.streams.video[0]
+                for b in range(first_batch, len(self.batches), n_threads):
+                    with self.condition:
+                        self.condition.wait_for(
+                            lambda: self.stopped or self.released > b - len(self.buffers)
+                        )
+                        if self.stopped:
+                            return
+                    buffer = self.buffers[b % len(self.buffers)]
+                    _decode_selection(
+                        container,
+                        stream,
+                        self.index,
+                        self.batches[b],
+                        buffer,
+                        self.size,
+                        self.format,
+                        self.crop,
+                    )
+                    with self.condition:
+                        self.ready.add(b)
+                        self.condition.notify_all()
+        except Exception as error:
+            with self.condition:
+                self.error = error
+                self.condition.notify_all()
+
+    def __iter__(self):
+        for thread in self.threads:
+            thread.start()
+        try:
+            start = 0
+            for b, batch in enumerate(self.batches):
+                with self.condition:
+                    self.condition.wait_for(lambda: b in self.ready or self.error is not None)
+                    if self.error is not None:
+                        raise self.error
+                    self.ready.remove(b)
+                yield start, self.buffers[b % len(self.buffers)][: len(batch)]
+                start += len(batch)
+                with self.condition:
+                    self.released += 1
+                    self.condition.notify_all()
+        finally:
+            with self.condition:
+                self.stopped = True
+                self.condition.notify_all()
+            for thread in self.threads:
+                if thread.is_alive():
+                    thread.join()
+
+
+class VideoLoader(StimulusLoader):
+    """Loader of the frames of video stimuli, decoding only the requested frames.
+
+    The keyframes of each video are indexed once and the index is saved in a cache, so that the
+    loader can seek to the keyframe before each requested frame instead of decoding the whole
+    video.
+
+    Example
+    -------
+    ```
+    loader = VideoLoader()
+    frames = loader.load_frames("friends/stimuli/s1/friends_s01e01a.mkv", tr=1.49, size=(64, 64))
+    ```
+
+    Parameters
+    ----------
+    cache : DiskCache or str
+        Cache of the indices of the videos, or path to its directory. If None, the "video" folder
+        of the bids_loader cache is used. Default is None.
+    """
+
+    def __init__(self, cache=None):
+        if cache is None:
+            cache = os.path.join(get_cache_dir(), "video")
+        if not isinstance(cache, DiskCache):
+            cache = DiskCache(cache)
+        self.cache = cache
+
+    def get_index(self, video_path):
+        """Get the index of the frames of a video, building it if it is not in the cache.
+
+        Parameters
+        ----------
+        video_path : str
+            Path to the video file.
+
+        Returns
+        -------
+        VideoIndex
+            Index of the video.
+        """
+        key = hash_key("video_index", _video_key(video_path))
+        arrays = self.cache.get(key)
+        if arrays is None:
+            arrays = build_index(video_path)
+            self.cache.set(key, arrays)
+        return VideoIndex(**arrays)
+
+    def load_frames(
+        self,
+        video_path,
+        frame_stride=None,
+        target_fps=None,
+        tr=None,
+        onsets=None,
+        size=None,
+        format="rgb24",
+        crop=None,
+        out=None,
+    ):
+        """Decode the frames of a video shown at given times.
+
+        Parameters
+        ----------
+        video_path : str
+            Path to the video file.
+        frame_stride, target_fps, tr, onsets
+            Selection of the frames, see `VideoIndex.select_frames`. All the frames are decoded
+            if none is set.
+        size : tuple of int
+            Width and height the frames are resized to while they are decoded. If None, the
+            frames are not resized. Default is None.
+        format : str
+            Pixel format of the frames, e.g. "rgb24" or "gray". Default is "rgb24".
+        crop : tuple of int
+            Top, left, height and width of the window of the resized frames to keep. If None, the
+            frames are not cropped. Default is None.
+        out : numpy.ndarray
+            Preallocated array the frames are decoded into, e.g. a memory map, of shape
+            (n_frames,height,width,channels). If None, a new array is allocated. Default is None.
+
+        Returns
+        -------
+        numpy.ndarray
+            Frames, uint8 array of shape (n_frames,height,width,channels) for rgb24 or
+            (n_frames,height,width) for gray.
+        """
+        index = self.get_index(video_path)
+        frame_indices = index.select_frames(frame_stride, target_fps, tr, onsets)
+        if out is None:
+            shape = (len(frame_indices),) + _frame_shape(index, size, format, crop)
+            out = np.empty(shape, dtype=np.uint8)
+        with av.open(video_path) as container:
+            stream = container.streams.video[0]
+            stream.thread_type = "AUTO"
+            _decode_selection(container, stream, index, frame_indices, out, size, format, crop)
+        return out
+
+    def iter_batches(
+        self,
+        video_path,
+        batch_size=64,
+        frame_stride=None,
+        target_fps=None,
+        tr=None,
+        onsets=None,
+        size=None,
+        format="rgb24",
+        crop=None,
+        n_threads=2,
+        n_buffers=None,
+    ):
+        """Stream batches of frames of a video, decoded ahead on background threads.
+
+        Each thread decodes its own batches with its own demuxer, into a ring of `n_buffers`
+        preallocated arrays, so that at most `n_buffers` batches are held in memory. A batch is
+        only yielded once it is fully decoded, and its buffer is reused once the next batch is
+        requested, so it must be copied to be kept.
+
+        Example
+        -------
+        ```
+        for start, frames in loader.iter_batches(path, tr=1.49, size=(224, 224), n_threads=4):
+            features[start : start + len(frames)] = model(frames)
+        ```
+
+        Parameters
+        ----------
+        video_path : str
+            Path to the video file.
+        batch_size : int
+            Number of frames per batch. Default is 64.
+        frame_stride, target_fps, tr, onsets, size, format, crop
+            Selection and transformation of the frames, see `load_frames`.
+        n_threads : int
+            Number of decoding threads. Default is 2.
+        n_buffers : int
+            Number of buffers of the ring. If None, `n_threads + 1`. Default is None.
+
+        Yields
+        ------
+        start : int
+            Index of the first frame of the batch in the selection.
+        frames : numpy.ndarray
+            Frames of the batch, of shape (batch_size,height,width,channels), or less for the
+            last batch.
+        """
+        index = self.get_index(video_path)
+        frame_indices = index.select_frames(frame_stride, target_fps, tr, onsets)
+        batches = [
+            frame_indices[start : start + batch_size]
+            for start in range(0, len(frame_indices), batch_size)
+        ]
+        if not batches:
+            return
+        if n_buffers is None:
+            n_buffers = n_threads + 1
+        decoder = _BatchDecoder(
+            video_path, index, batches, n_threads, n_buffers, size, format, crop
+        )
+        for start, frames in decoder:
+            yield start, frames
+
+    def load(self, video_path, **kwargs):
+        """Decode the frames of a video into the samples of a stimulus, with their onsets.
+
+        Parameters
+        ----------
+        video_path : str
+            Path to the video file.
+        **kwargs
+            Parameters passed to `load_frames`.
+
+        Returns
+        -------
+        Stimulus
+            Frames of the video with their onsets.
+        """
+        index = self.get_index(video_path)
+        selection = {
+            option: kwargs.get(option) for option in ("frame_stride", "target_fps", "tr", "onsets")
+        }
+        frame_indices = index.select_frames(**selection)
+        return Stimulus(self.load_frames(video_path, **kwargs), index.times[frame_indices])
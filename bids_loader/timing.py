@@ -0,0 +1,69 @@
+import numpy as np
+
+
+#: Size of the float64 chunks of samples summed at a time by `window_mean`, in bytes.
+_CHUNK_BYTES = 1 << 26
+
+
+def _bound_sums(values, bounds, chunk_size):
+    """Sum the values from the first bound to each bound, summing chunks of samples at a time."""
+    segments = np.zeros((len(bounds),) + values.shape[1:])
+    if len(bounds) > 1:
+        for start in range(bounds[0], bounds[-1], chunk_size):
+            stop = min(start + chunk_size, bounds[-1])
+            lo, hi = np.searchsorted(bounds, [start, stop])
+            # bounds[lo] may be the start itself, which is already the first one of the chunk
+            local = np.r_[start, bounds[lo:hi][bounds[lo:hi] > start]]
+            chunk = np.asarray(values[start:stop], dtype=np.float64)
+            # the bounds are unique, so each sum of the chunk adds to a different segment
+            segments[np.searchsorted(bounds, local, side="right") - 1] += np.add.reduceat(
+                chunk, local - start, axis=0
+            )
+    sums = np.zeros_like(segments)
+    np.cumsum(segments[:-1], axis=0, out=sums[1:])
+    return sums
+
+
+def window_mean(times, values, starts, stops, chunk_size=None):
+    """Average irregularly or densely sampled values in windows of time, without looping.
+
+    The sums of the windows are differences of cumulative sums of the values at the bounds of
+    the windows, found with `searchsorted`. The values between consecutive bounds are summed
+    with `numpy.add.reduceat`, one chunk of samples at a time, so that only arrays of the size
+    of the windows are allocated, however large the samples are, e.g. the frames of a game.
+
+    Parameters
+    ----------
+    times : numpy.ndarray
+        Sorted times of the samples, of shape (n_samples,).
+    values : numpy.ndarray
+        Values of the samples, of shape (n_samples,...).
+    starts : numpy.ndarray
+        Start of each window, included, of shape (n_windows,).
+    stops : numpy.ndarray
+        End of each window, excluded, of shape (n_windows,).
+    chunk_size : int
+        Number of samples summed at a time. If None, as many as fit in 64 MB as float64.
+        Default is None.
+
+    Returns
+    -------
+    numpy.ndarray
+        Mean of the values in each window, of shape (n_windows,...), NaN for empty windows.
+    """
+    values = np.asanyarray(values)
+    if chunk_size is None:
+        chunk_size = max(1, _CHUNK_BYTES // max(8, 8 * int(np.prod(values.shape[1:]))))
+    first = np.searchsorted(times, starts, side="left")
+    last = np.searchsorted(times, stops, side="left")
+    bounds = np.unique(np.r_[first, last])
+    sums = _bound_sums(values, bounds, chunk_size)
+    window_sums = sums[np.searchsorted(bounds, last)] - sums[np.searchsorted(bounds, first)]
+    counts = (last - first).reshape((-1,) + (1,) * (values.ndim - 1))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return window_sums / counts
+
+
+def sample_index(times, query):
+    """Get the index of the last sample at or before each query time, clipped to the samples."""
+    return np.clip(np.searchsorted(times, query, side="right") - 1, 0, len(times) - 1)
@@ -0,0 +1,53 @@
+import os
+import json
+from bids.layout import BIDSLayoutIndexer
+from bids_loader.base import BaseLoader
+
+
+def _make_dataset(root, n_subjects=2):
+    os.makedirs(root)
+    with open(os.path.join(root, "dataset_description.json"), "w") as f:
+        json.dump({"Name": "test", "BIDSVersion": "1.6.0"}, f)
+    for subject in range(1, n_subjects + 1):
+        _add_run(root, subject)
+
+
+def _add_run(root, subject, run=1):
+    func_dir = os.path.join(root, "sub-{:02d}".format(subject), "func")
+    os.makedirs(func_dir, exist_ok=True)
+    filename = "sub-{:02d}_task-test_run-{}_bold.nii.gz".format(subject, run)
+    open(os.path.join(func_dir, filename), "w").close()
+
+
+def test_base_loader_database(tmpdir):
+    root = os.path.join(str(tmpdir), "dataset")
+    cache_dir = os.path.join(str(tmpdir), "cache")
+    _make_dataset(root)
+    loader = BaseLoader(root, cache_dir=cache_dir)
+    assert len(loader.layout.get(suffix="bold")) == 2, "Runs not indexed."
+    database_path = os.path.join(cache_dir, "raw", "layout_index.sqlite")
+    assert os.path.exists(database_path), "Database not saved."
+    mtime = os.path.getmtime(database_path)
+
+    loader = BaseLoader(root, cache_dir=cache_dir)
+    assert len(loader.layout.get(suffix="bold")) == 2, "Runs not loaded from the database."
+    assert os.path.getmtime(database_path) == mtime, "Database indexed again."
+
+    _add_run(root, 1, run=2)
+    loader = BaseLoader(root, cache_dir=cache_dir)
+    assert len(loader.layout.get(suffix="bold")) == 3, "New run not indexed."
+
+
+def test_base_loader_layout_options(tmpdir):
+    root = os.path.join(str(tmpdir), "dataset")
+    cache_dir = os.path.join(str(tmpdir), "cache")
+    _make_dataset(root)
+    assert len(BaseLoader(root, cache_dir=cache_dir).layout.get(suffix="bold")) == 2
+    database_path = os.path.join(cache_dir, "raw", "layout_index.sqlite")
+    mtimes = []
+    for _ in range(2):
+        indexer = BIDSLayoutIndexer(ignore=[os.path.join(root, "sub-02")])
+        loader = BaseLoader(root, cache_dir=cache_dir, indexer=indexer)
+        assert len(loader.layout.get(suffix="bold")) == 1, "Options of the layout are ignored."
+        mtimes.append(os.path.getmtime(database_path))
+    assert mtimes[0] == mtimes[1], "Database indexed again with the same options."
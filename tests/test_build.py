@@ -0,0 +1,139 @@
+import os
+import json
+import gzip
+import zipfile
+import numpy as np
+import nibabel as nib
+import pytest
+from bids_loader.build import Builder, Target, plan_dataset
+
+
+def _write_json(path, content):
+    with open(path, "w") as f:
+        json.dump(content, f)
+
+
+def _copy_input(output_path, input_path):
+    with open(input_path) as f:
+        content = f.read()
+    if content == "fail":
+        raise ValueError("Bad input.")
+    with open(output_path, "w") as f:
+        f.write(content)
+
+
+def _add_run(root, run, shape=(4, 5, 6), n_volumes=10, tr=1.5):
+    """Add a raw physio recording and a preprocessed BOLD run to a synthetic dataset."""
+    base = "sub-01_task-test_run-{}".format(run)
+    func_dir = os.path.join(root, "sub-01", "func")
+    os.makedirs(func_dir, exist_ok=True)
+    nib.save(
+        nib.Nifti1Image(np.random.rand(*shape, n_volumes).astype(np.float32), np.eye(4)),
+        os.path.join(func_dir, base + "_bold.nii.gz"),
+    )
+    with gzip.open(os.path.join(func_dir, base + "_physio.tsv.gz"), "wt") as f:
+        for t in np.arange(int(n_volumes * tr * 100)) / 100:
+            f.write("{}\t{}\n".format(np.sin(2 * np.pi * 1.2 * t), float(t % tr < 0.05)))
+    _write_json(
+        os.path.join(func_dir, base + "_physio.json"),
+        {"SamplingFrequency": 100, "StartTime": 0, "Columns": ["cardiac", "trigger"]},
+    )
+    fmriprep_dir = os.path.join(root, "derivatives", "fmriprep", "sub-01", "func")
+    os.makedirs(fmriprep_dir, exist_ok=True)
+    nib.save(
+        nib.Nifti1Image(np.random.rand(*shape, n_volumes).astype(np.float32), np.eye(4)),
+        os.path.join(fmriprep_dir, base + "_space-MNI_desc-preproc_bold.nii.gz"),
+    )
+    nib.save(
+        nib.Nifti1Image((np.random.rand(*shape) > 0.5).astype(np.uint8), np.eye(4)),
+        os.path.join(fmriprep_dir, base + "_space-MNI_desc-brain_mask.nii.gz"),
+    )
+
+
+def test_builder(tmpdir, monkeypatch):
+    monkeypatch.setenv("BIDS_LOADER_CACHE", os.path.join(str(tmpdir), "cache"))
+    root = os.path.join(str(tmpdir), "dataset")
+    os.makedirs(os.path.join(root, "derivatives", "fmriprep"))
+    _write_json(
+        os.path.join(root, "dataset_description.json"), {"Name": "t", "BIDSVersion": "1.6.0"}
+    )
+    _write_json(
+        os.path.join(root, "derivatives", "fmriprep", "dataset_description.json"),
+        {"Name": "fmriprep", "BIDSVersion": "1.6.0", "DatasetType": "derivative"},
+    )
+    _add_run(root, 1)
+    output_dir = os.path.join(str(tmpdir), "output")
+    builder = Builder(output_dir, n_jobs=1)
+    targets = plan_dataset(root, output_dir, tr=1.5, space="MNI")
+    assert len(targets) == 2, "Targets don't match."
+    assert len(builder.build(targets)) == 2, "All the targets should be built."
+    bold_output = os.path.join(
+        output_dir, "bold", "sub-01", "func", "sub-01_task-test_run-1_space-MNI_desc-preproc_bold"
+    )
+    fmriprep_base = os.path.join(root, "derivatives", "fmriprep", "sub-01", "func", "sub-01_")
+    data = nib.load(fmriprep_base + "task-test_run-1_space-MNI_desc-preproc_bold.nii.gz")
+    mask = nib.load(fmriprep_base + "task-test_run-1_space-MNI_desc-brain_mask.nii.gz")
+    voxels = np.asanyarray(mask.dataobj).ravel(order="F") != 0
+    expected = data.get_fdata(dtype=np.float32).reshape((-1, 10), order="F")[voxels].T
+    assert np.array_equal(np.load(bold_output + ".npy"), expected), "Masked BOLD doesn't match."
+    assert not os.path.exists(os.path.join(str(tmpdir), "cache", "bold")), "Run was cached."
+    physio_output = os.path.join(
+        output_dir, "physio", "sub-01", "func", "sub-01_task-test_run-1_physio.npz"
+    )
+    with np.load(physio_output) as physio:
+        assert physio["features"].shape == (10, 3), "Physio features don't match."
+    assert Builder(output_dir).build(targets) == [], "Up-to-date targets were built again."
+
+    _add_run(root, 2)
+    targets = plan_dataset(root, output_dir, tr=1.5, space="MNI")
+    built = Builder(output_dir, n_jobs=2).build(targets)
+    assert len(built) == 2 and all("run-2" in target.output for target in built)
+    targets = plan_dataset(root, output_dir, tr=1.5, space="MNI", physio_params={"n_volumes": 8})
+    built = Builder(output_dir, n_jobs=1).build(targets)
+    assert sorted(os.path.basename(target.output) for target in built) == [
+        "sub-01_task-test_run-1_physio.npz",
+        "sub-01_task-test_run-2_physio.npz",
+    ], "Only the targets whose parameters changed should be built."
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_builder_failures(tmpdir, n_jobs, n_targets=5):
+    targets = []
+    for i in range(n_targets):
+        input_path = os.path.join(str(tmpdir), "input-{}.txt".format(i))
+        with open(input_path, "w") as f:
+            f.write("fail" if i == 1 else str(i))
+        output_path = os.path.join(str(tmpdir), "output", "output-{}.txt".format(i))
+        targets.append(Target(output_path, _copy_input, [input_path]))
+    with pytest.raises(RuntimeError, match="1 of 5 targets"):
+        Builder(os.path.join(str(tmpdir), "output"), n_jobs=n_jobs).build(targets)
+    builder = Builder(os.path.join(str(tmpdir), "output"), n_jobs=n_jobs)
+    assert [builder.is_stale(target) for target in targets] == [False, True, False, False, False]
+    with open(targets[1].inputs[0], "w") as f:
+        f.write("1")
+    assert builder.build(targets) == [targets[1]], "Only the failed target should be built."
+
+
+def test_plan_game(tmpdir, game="Dummy-Genesis"):
+    root = os.path.join(str(tmpdir), "dataset")
+    integration_dir = os.path.join(root, "stimuli", game)
+    os.makedirs(integration_dir)
+    _write_json(
+        os.path.join(root, "dataset_description.json"), {"Name": "t", "BIDSVersion": "1.6.0"}
+    )
+    for name in ("data.json", "metadata.json", "scenario.json", "Level1.json"):
+        _write_json(os.path.join(integration_dir, name), {})
+    with open(os.path.join(integration_dir, "rom.sha"), "w") as f:
+        f.write("0" * 40 + "\n")
+    bk2_path = os.path.join(root, "sub-01", "gamelogs", "sub-01_task-dummy_run-01.bk2")
+    os.makedirs(os.path.dirname(bk2_path))
+    with zipfile.ZipFile(bk2_path, "w") as archive:
+        archive.writestr("Header.txt", "MovieVersion BizHawk v2.0\nGameName {}\n".format(game))
+    output_dir = os.path.join(str(tmpdir), "output")
+    (target,) = plan_dataset(root, output_dir)
+    expected = [bk2_path] + [
+        os.path.join(integration_dir, name) for name in ("rom.sha", "data.json", "scenario.json")
+    ]
+    assert target.inputs == expected, "Files of the integration are not inputs of the replay."
+    (target,) = plan_dataset(root, output_dir, replay_params={"scenario": "Level1"})
+    assert target.inputs[-1] == os.path.join(integration_dir, "Level1.json")
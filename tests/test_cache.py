@@ -0,0 +1,45 @@
+import os
+import time
+import numpy as np
+from bids_loader.cache import DiskCache, get_cache_dir, hash_key
+
+
+def test_disk_cache(tmpdir):
+    cache = DiskCache(str(tmpdir))
+    key = hash_key("test", 1)
+    assert cache.get(key) is None, "Missing entry should be None."
+    arrays = {"frames": np.arange(24, dtype=np.uint8).reshape(2, 3, 4), "names": np.array(["a"])}
+    cache.set(key, arrays)
+    assert key in cache, "Entry not stored."
+    cached = cache.get(key)
+    assert set(cached) == set(arrays), "Cached arrays don't match."
+    for name in arrays:
+        assert np.array_equal(cached[name], arrays[name]), "Cached array doesn't match."
+
+
+def test_disk_cache_eviction(tmpdir, n_entries=4):
+    cache = DiskCache(str(tmpdir))
+    keys = [hash_key("test", i) for i in range(n_entries)]
+    for i, key in enumerate(keys):
+        cache.set(key, {"data": np.random.rand(1000)})
+        # make sure that the entries have distinct access times
+        os.utime(cache._entry_path(key), (time.time() + i, time.time() + i))
+    # reading the oldest entry makes it the most recently used
+    cache.get(keys[0])
+    os.utime(cache._entry_path(keys[0]), (time.time() + n_entries, time.time() + n_entries))
+    entry_size = max(os.path.getsize(cache._entry_path(key)) for key in keys)
+    cache.max_size = 2 * entry_size
+    cache.evict()
+    assert cache.size <= cache.max_size, "Cache is larger than its maximum size."
+    assert keys[0] in cache and keys[-1] in cache, "Most recently used entries were evicted."
+    assert keys[1] not in cache and keys[2] not in cache, "Least recently used entries were kept."
+
+
+def test_disk_cache_default(tmpdir, monkeypatch):
+    monkeypatch.setenv("BIDS_LOADER_CACHE", str(tmpdir))
+    with open(os.path.join(get_cache_dir(), "roms.json"), "w") as f:
+        f.write("{}")
+    cache = DiskCache()
+    cache.set(hash_key("test"), {"data": np.zeros(10)})
+    cache.clear()
+    assert os.path.exists(os.path.join(str(tmpdir), "roms.json")), "Other files were removed."
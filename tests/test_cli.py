@@ -0,0 +1,67 @@
+import os
+import numpy as np
+import pytest
+from bids_loader.cli import _export_replay, find_bk2, get_parser
+
+
+def test_find_bk2(tmpdir):
+    root = str(tmpdir)
+    names = [
+        "sub-01/ses-001/gamelogs/sub-01_ses-001_task-shinobi_run-01_level-1_rep-000.bk2",
+        "sub-01/ses-002/gamelogs/sub-01_ses-002_task-shinobi_run-02_level-4_rep-001.bk2",
+        "sub-02/ses-001/gamelogs/sub-02_ses-001_task-mario_run-01_level-1_rep-000.bk2",
+        "derivatives/replays/sub-01_task-shinobi_run-01.bk2",
+        "stimuli/Shinobi-Genesis/sub-01_task-shinobi.bk2",
+    ]
+    for name in names:
+        os.makedirs(os.path.dirname(os.path.join(root, name)), exist_ok=True)
+        open(os.path.join(root, name), "w").close()
+    paths = [os.path.join(root, name) for name in names]
+    assert find_bk2(root) == paths[:3], "Files outside of the participants' folders are found."
+    assert find_bk2(root, subject=["01"]) == paths[:2], "Subject filter doesn't match."
+    assert find_bk2(root, subject=["01"], session=["2"]) == paths[1:2], "Session doesn't match."
+    assert find_bk2(root, task=["mario", "shinobi"], run=["1"]) == [paths[0], paths[2]]
+
+
+def test_parser():
+    args = get_parser().parse_args(
+        ["replay", "data/shinobi", "--subject", "01", "02", "--tr", "1.49", "-j", "4"]
+    )
+    assert args.subject == ["01", "02"] and args.tr == 1.49 and args.n_jobs == 4
+    assert args.format == "npz" and "ram" not in args.outputs
+
+
+class _Replay(object):
+    def __init__(self, n_frames):
+        self.n_frames = n_frames
+
+    def __len__(self):
+        return self.n_frames
+
+    def to_arrays(self):
+        return {"keys": np.zeros((self.n_frames, 12), dtype=bool), "reward": np.ones(self.n_frames)}
+
+
+class _Replayer(object):
+    """Replayer writing empty frames, and failing after them if `fail` is True."""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+
+    def replay_array(self, bk2_path, frames_path=None, audio_path=None, **kwargs):
+        np.save(frames_path, np.zeros((10, 4, 4, 3), dtype=np.uint8))
+        if self.fail:
+            raise RuntimeError("Replay interrupted.")
+        return _Replay(10)
+
+
+def test_export_replay_npy(tmpdir):
+    pytest.importorskip("retro")
+    output_path = os.path.join(str(tmpdir), "sub-01_task-shinobi_run-01")
+    kwargs = {"outputs": ("frames", "keys", "reward")}
+    with pytest.raises(RuntimeError):
+        _export_replay("run.bk2", output_path, "npy", kwargs, replayer=_Replayer(fail=True))
+    assert not os.path.exists(output_path), "Output of a failed replay exists."
+    assert _export_replay("run.bk2", output_path, "npy", kwargs, replayer=_Replayer()) == 10
+    assert sorted(os.listdir(output_path)) == ["annotations.npz", "frames.npy", "keys.npy"]
+    assert os.listdir(str(tmpdir)) == [os.path.basename(output_path)], "Temporary folder is left."
@@ -0,0 +1,36 @@
+import os
+import pickle
+import numpy as np
+import nibabel as nib
+from bids_loader.dataset import WindowDataset
+
+
+def test_window_dataset(tmpdir, window=4, stride=2, lag=3):
+    os.makedirs(os.path.join(str(tmpdir), "dataset"))
+    runs, expected = [], []
+    for n_volumes in [20, 15]:
+        bold_path = os.path.join(str(tmpdir), "run-{}_bold.nii".format(n_volumes))
+        data = np.random.rand(2, 3, 4, n_volumes).astype(np.float32)
+        nib.save(nib.Nifti1Image(data, np.eye(4)), bold_path)
+        stimulus = np.random.rand(n_volumes - 1, 5).astype(np.float32)
+        stimulus_path = os.path.join(str(tmpdir), "run-{}_stimulus.npy".format(n_volumes))
+        np.save(stimulus_path, stimulus)
+        runs.append((bold_path, np.load(stimulus_path, mmap_mode="r")))
+        expected.append((data.reshape((-1, n_volumes), order="F").T, stimulus))
+    dataset = WindowDataset(
+        os.path.join(str(tmpdir), "dataset"),
+        runs,
+        window=window,
+        stride=stride,
+        lag=lag,
+        bold_cache=os.path.join(str(tmpdir), "bold"),
+    )
+    assert len(dataset) == 7 + 5, "Number of windows doesn't match."
+    assert isinstance(dataset.stimuli[0], str), "Memory-mapped stimulus is not reopened."
+    dataset = pickle.loads(pickle.dumps(dataset))
+    for i, (run, start) in enumerate(dataset.index):
+        stimulus, bold = dataset[i]
+        bold_expected, stimulus_expected = expected[run]
+        assert np.array_equal(stimulus, stimulus_expected[start : start + window])
+        assert np.array_equal(bold, bold_expected[start + lag : start + lag + window])
+    assert np.array_equal(dataset[-1][1], dataset[len(dataset) - 1][1]), "Negative index fails."
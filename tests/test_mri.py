@@ -0,0 +1,153 @@
+import os
+import numpy as np
+import nibabel as nib
+from bids_loader.mri import BoldRun, MRILoader, get_confounds_path
+
+
+def _make_bold(path, shape=(4, 5, 6, 20), tr=1.49):
+    data = np.random.rand(*shape).astype(np.float32)
+    img = nib.Nifti1Image(data, np.eye(4))
+    img.header.set_xyzt_units("mm", "sec")
+    img.header.set_zooms((2.0, 2.0, 2.0, tr))
+    nib.save(img, path)
+    return data
+
+
+def test_open_bold(tmpdir, tr=1.49):
+    os.makedirs(os.path.join(str(tmpdir), "dataset"))
+    loader = MRILoader(
+        os.path.join(str(tmpdir), "dataset"), bold_cache=os.path.join(str(tmpdir), "bold")
+    )
+    for extension in [".nii", ".nii.gz"]:
+        path = os.path.join(str(tmpdir), "sub-01_task-test_bold" + extension)
+        data = _make_bold(path, tr=tr)
+        run = loader.open_bold(path, chunk_size=8)
+        assert isinstance(run.timeseries, np.memmap), "Run is not memory mapped."
+        assert run.timeseries.shape == (20, 4 * 5 * 6), "Shape of the timeseries doesn't match."
+        assert np.isclose(run.tr, tr), "Repetition time doesn't match."
+        assert np.array_equal(run.volumes(), data), "Volumes don't match."
+        assert np.array_equal(run.volumes(5, 9), data[..., 5:9]), "Window doesn't match."
+        assert np.array_equal(
+            np.concatenate([chunk for _, chunk in run.iter_chunks(8)]), run.timeseries
+        ), "Chunks don't match."
+
+
+def test_get_masked(tmpdir):
+    os.makedirs(os.path.join(str(tmpdir), "dataset"))
+    bold_cache = os.path.join(str(tmpdir), "bold")
+    loader = MRILoader(os.path.join(str(tmpdir), "dataset"), bold_cache=bold_cache)
+    path = os.path.join(str(tmpdir), "sub-01_task-test_bold.nii")
+    data = _make_bold(path)
+    mask = np.random.rand(4, 5, 6) > 0.5
+    mask_path = os.path.join(str(tmpdir), "sub-01_desc-brain_mask.nii.gz")
+    nib.save(nib.Nifti1Image(mask.astype(np.uint8), np.eye(4)), mask_path)
+    run = loader.open_bold(path)
+    masked = loader.get_masked(run, mask_path, chunk_size=8)
+    expected = data.reshape((-1, 20), order="F")[mask.ravel(order="F")].T
+    assert np.array_equal(masked, expected), "Masked timeseries don't match."
+    indices = loader.get_mask_indices(mask_path, run.shape, run.affine)
+    assert loader.get_mask_indices(mask_path, run.shape, run.affine) is indices, "Not reused."
+    n_entries = len(os.listdir(bold_cache))
+    assert np.array_equal(loader.get_masked(run, mask_path), masked), "Cache doesn't match."
+    assert len(os.listdir(bold_cache)) == n_entries, "Masked timeseries were not cached."
+
+
+def test_get_masked_in_memory(tmpdir):
+    os.makedirs(os.path.join(str(tmpdir), "dataset"))
+    loader = MRILoader(
+        os.path.join(str(tmpdir), "dataset"), bold_cache=os.path.join(str(tmpdir), "bold")
+    )
+    mask = nib.Nifti1Image((np.random.rand(4, 5, 6) > 0.5).astype(np.uint8), np.eye(4))
+    indices = loader.get_mask_indices(mask, (4, 5, 6), np.eye(4))
+    # runs without a file are identified by their data, not by their memory address
+    for _ in range(3):
+        timeseries = np.random.rand(20, 4 * 5 * 6).astype(np.float32)
+        run = BoldRun(timeseries, (4, 5, 6), np.eye(4), 1.49)
+        assert np.array_equal(loader.get_masked(run, mask), timeseries[:, indices])
+        del run, timeseries
+
+
+def test_get_mask_indices_affine(tmpdir):
+    os.makedirs(os.path.join(str(tmpdir), "dataset"))
+    root, bold_cache = os.path.join(str(tmpdir), "dataset"), os.path.join(str(tmpdir), "bold")
+    data = np.zeros((4, 5, 6), dtype=np.uint8)
+    data[0, 0, 0] = 1
+    shifted = np.eye(4)
+    shifted[0, 3] = 2
+    # the same voxels of a mask shifted by 2 voxels along x
+    masks = [nib.Nifti1Image(data, np.eye(4)), nib.Nifti1Image(data, shifted)]
+    loader = MRILoader(root, bold_cache=bold_cache)
+    for mask, expected in zip(masks, [[0], [2]]):
+        for other in [loader, MRILoader(root, bold_cache=bold_cache)]:
+            indices = other.get_mask_indices(mask, (4, 5, 6), np.eye(4))
+            assert np.array_equal(indices, expected), "Mask indices don't match."
+
+
+def test_get_parcels(tmpdir):
+    os.makedirs(os.path.join(str(tmpdir), "dataset"))
+    loader = MRILoader(
+        os.path.join(str(tmpdir), "dataset"), bold_cache=os.path.join(str(tmpdir), "bold")
+    )
+    path = os.path.join(str(tmpdir), "sub-01_task-test_bold.nii")
+    data = _make_bold(path)
+    atlas = np.random.choice([0, 3, 5, 8], size=(4, 5, 6))
+    atlas_path = os.path.join(str(tmpdir), "atlas.nii.gz")
+    nib.save(nib.Nifti1Image(atlas.astype(np.int16), np.eye(4)), atlas_path)
+    run = loader.open_bold(path)
+    parcels = loader.get_parcels(run, atlas_path, chunk_size=8)
+    _, labels = loader.get_parcel_operator(atlas_path, run.shape, run.affine)
+    assert np.array_equal(labels, [3, 5, 8]), "Labels don't match."
+    expected = np.stack([data[atlas == label].mean(axis=0) for label in labels], axis=1)
+    assert np.allclose(parcels, expected, atol=1e-6), "Parcel timeseries don't match."
+    assert np.array_equal(loader.get_parcels(run, atlas_path), parcels), "Cache doesn't match."
+
+
+def test_get_parcels_atlas_images(tmpdir):
+    os.makedirs(os.path.join(str(tmpdir), "dataset"))
+    root, bold_cache = os.path.join(str(tmpdir), "dataset"), os.path.join(str(tmpdir), "bold")
+    path = os.path.join(str(tmpdir), "sub-01_task-test_bold.nii")
+    data = _make_bold(path)
+    # two atlases with the same voxels in parcels but different labels
+    first = np.random.choice([1, 2], size=(4, 5, 6))
+    second = np.where(np.random.rand(4, 5, 6) > 0.5, 1, 2)
+    for atlas in [first, second]:
+        img = nib.Nifti1Image(atlas.astype(np.int16), np.eye(4))
+        # a new loader only shares the disk cache
+        for loader in [MRILoader(root, bold_cache=bold_cache) for _ in range(2)]:
+            run = loader.open_bold(path)
+            parcels = loader.get_parcels(run, img)
+            expected = np.stack([data[atlas == label].mean(axis=0) for label in [1, 2]], axis=1)
+            assert np.allclose(parcels, expected, atol=1e-6), "Parcel timeseries don't match."
+
+
+def test_clean_runs(tmpdir):
+    os.makedirs(os.path.join(str(tmpdir), "dataset"))
+    loader = MRILoader(
+        os.path.join(str(tmpdir), "dataset"), bold_cache=os.path.join(str(tmpdir), "bold")
+    )
+    path = os.path.join(str(tmpdir), "sub-01_task-test_run-1_space-MNI_desc-preproc_bold.nii")
+    data = _make_bold(path)
+    confounds = np.random.rand(20, 8)
+    confounds_path = os.path.join(
+        str(tmpdir), "sub-01_task-test_run-1_desc-confounds_timeseries.tsv"
+    )
+    assert get_confounds_path(path) == confounds_path, "Confounds path doesn't match."
+    columns = ["trans_x", "trans_y", "trans_z", "rot_x", "rot_y", "rot_z", "csf", "global_signal"]
+    with open(confounds_path, "w") as f:
+        f.write("\t".join(columns + ["framewise_displacement"]) + "\n")
+        for t, row in enumerate(confounds):
+            fd = "n/a" if t == 0 else "0.1"
+            f.write("\t".join("{:.6f}".format(value) for value in row) + "\t" + fd + "\n")
+    loaded = loader.load_confounds(confounds_path, ["motion", "csf", "framewise_*"])
+    assert list(loaded.columns) == columns[:7] + ["framewise_displacement"], "Wrong columns."
+    assert loaded.dtypes.unique().tolist() == [np.float32], "Confounds are not float32."
+    assert np.isnan(loaded["framewise_displacement"][0]), "n/a is not parsed as NaN."
+
+    run = loader.open_bold(path)
+    (cleaned,) = loader.clean_runs([run], strategy=["motion", "csf"])
+    assert cleaned.dtype == np.float32, "Cleaned timeseries are not float32."
+    regressors = np.c_[np.ones(20), np.linspace(-1, 1, 20), loaded.values[:, :7]]
+    timeseries = data.reshape((-1, 20), order="F").T.astype(np.float64)
+    beta = np.linalg.lstsq(regressors, timeseries, rcond=None)[0]
+    expected = timeseries - regressors @ beta
+    assert np.allclose(cleaned, expected, atol=1e-4), "Cleaned timeseries don't match."
@@ -0,0 +1,81 @@
+import os
+import json
+import gzip
+import numpy as np
+from bids_loader.physio import PhysioLoader, PhysioRun, get_volume_onsets
+
+
+def _make_physio(tmpdir, n_samples=1000, sampling_frequency=1000.0, start_time=-2.0):
+    func_dir = os.path.join(str(tmpdir), "dataset", "sub-01", "func")
+    os.makedirs(func_dir)
+    with open(os.path.join(str(tmpdir), "dataset", "dataset_description.json"), "w") as f:
+        json.dump({"Name": "test", "BIDSVersion": "1.6.0"}, f)
+    path = os.path.join(func_dir, "sub-01_task-test_physio.tsv.gz")
+    columns = ["cardiac", "respiratory", "trigger"]
+    data = np.random.rand(n_samples, len(columns)).astype(np.float32)
+    data[:, 2] = np.arange(n_samples) % 100 == 0
+    with gzip.open(path, "wt") as f:
+        for row in data:
+            f.write("\t".join(repr(float(value)) for value in row) + "\n")
+    with open(path[: -len(".tsv.gz")] + ".json", "w") as f:
+        json.dump(
+            {"SamplingFrequency": sampling_frequency, "StartTime": start_time, "Columns": columns},
+            f,
+        )
+    return path, data
+
+
+def test_open_physio(tmpdir):
+    path, data = _make_physio(tmpdir)
+    physio_cache = os.path.join(str(tmpdir), "physio")
+    loader = PhysioLoader(os.path.join(str(tmpdir), "dataset"), physio_cache=physio_cache)
+    run = loader.open_physio(path, chunk_size=128)
+    assert isinstance(run.data, np.memmap), "Recording is not memory mapped."
+    assert run.data.flags.f_contiguous, "Columns are not contiguous."
+    assert np.array_equal(run.data, data), "Samples don't match."
+    assert np.array_equal(run["respiratory"], data[:, 1]), "Column doesn't match."
+    assert np.isclose(run.times[0], -2) and np.isclose(run.times[-1], -2 + 999 / 1000)
+    assert os.listdir(physio_cache) == [os.path.basename(run.data.filename)], "Cache not clean."
+    (run,) = loader.get_physio(subject="01")
+    assert np.array_equal(run.data, data), "Cached samples don't match."
+    assert len(os.listdir(physio_cache)) == 1, "Recording was not reused from the cache."
+
+
+def test_physio_features(fs=100.0, tr=1.5, n_volumes=40):
+    times = np.arange(int(n_volumes * tr * fs)) / fs
+    data = np.stack(
+        [
+            np.sin(2 * np.pi * 1.2 * times),
+            3 * np.sin(2 * np.pi * 0.25 * times),
+            (times % tr) < 0.05,
+        ],
+        axis=1,
+    ).astype(np.float32)
+    run = PhysioRun(data, ["cardiac", "respiratory", "trigger"], fs)
+    assert np.allclose(get_volume_onsets(run), np.arange(n_volumes) * tr), "Onsets don't match."
+    features, names = run.features(tr, averages=["respiratory"])
+    assert names == [
+        "cardiac_sin",
+        "cardiac_cos",
+        "heart_rate",
+        "respiratory_sin",
+        "respiratory_cos",
+        "rvt",
+        "mean_respiratory",
+    ], "Feature names don't match."
+    assert features.shape == (n_volumes, 7), "Shape of the features doesn't match."
+    inner = slice(5, -5)
+    assert np.allclose(features[inner, 2], 72, rtol=0.02), "Heart rate doesn't match."
+    assert np.allclose(features[inner, 5], 2 * 3 * 0.25, rtol=0.05), "RVT doesn't match."
+    phase = np.arctan2(features[:, 3], features[:, 4])
+    expected = np.angle(np.exp(1j * (2 * np.pi * 0.25 * np.arange(n_volumes) * tr - np.pi / 2)))
+    assert np.allclose(np.angle(np.exp(1j * (phase - expected)))[inner], 0, atol=0.05)
+    mean = data[:, 1].reshape((n_volumes, -1)).mean(axis=1)
+    assert np.allclose(features[:, 6], mean, atol=1e-5), "Averages don't match."
+
+
+def test_physio_features_flat_cardiac(fs=100.0, tr=1.5, n_volumes=10):
+    data = np.zeros((int(n_volumes * tr * fs), 1), dtype=np.float32)
+    features, names = PhysioRun(data, ["cardiac"], fs).features(tr, n_volumes=n_volumes)
+    assert names == ["cardiac_sin", "cardiac_cos", "heart_rate"], "Feature names don't match."
+    assert np.isnan(features[:, 2]).all(), "Heart rate without peaks should be NaN."
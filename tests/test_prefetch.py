@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from bids_loader.prefetch import SharedMemoryPrefetcher
+
+
+class _Dataset(object):
+    def __init__(self, n_items, fail=None):
+        self.n_items = n_items
+        self.fail = fail
+
+    def __len__(self):
+        return self.n_items
+
+    def __getitem__(self, i):
+        if i == self.fail:
+            raise ValueError("Item {} is broken.".format(i))
+        return np.full((4, 3), i, dtype=np.uint8), np.arange(5, dtype=np.float32) * i
+
+
+@pytest.mark.parametrize("context", ["fork", "spawn"])
+def test_shared_memory_prefetcher(context):
+    dataset = _Dataset(23)
+    with SharedMemoryPrefetcher(dataset, 5, n_workers=3, context=context) as batches:
+        assert len(batches) == 5, "Number of batches doesn't match."
+        for epoch in range(2):
+            frames = [batch[0].copy() for batch in batches]
+            assert np.array_equal(np.concatenate(frames)[:, 0, 0], np.arange(23))
+        for i, (frames, values) in enumerate(batches):
+            assert not frames.flags.owndata, "Batch is not a view of the shared memory."
+            if i == 1:
+                break
+        assert np.array_equal(values[:, 1], np.arange(5, 10)), "Batch doesn't match."
+    with SharedMemoryPrefetcher(dataset, 5, shuffle=True, drop_last=True, seed=0) as batches:
+        indices = np.concatenate([batch[0][:, 0, 0].copy() for batch in batches])
+        assert len(indices) == 20 and len(np.unique(indices)) == 20, "Shuffle doesn't match."
+
+
+def test_shared_memory_prefetcher_error():
+    with SharedMemoryPrefetcher(_Dataset(10, fail=7), 2, n_workers=2) as batches:
+        with pytest.raises(RuntimeError, match="Item 7 is broken"):
+            for _ in batches:
+                pass
@@ -1,9 +1,24 @@
 import os
 import glob
+import shutil
 import retro
 import numpy as np
 from random import random
-from bids_loader.stimuli.game import replay_bk2
+from bids_loader.cache import DiskCache
+from bids_loader.stimuli import game
+from bids_loader.stimuli.game import (
+    replay_bk2,
+    replay_bk2_array,
+    replay_many,
+    load_frames,
+    decode_ram,
+    checkpoint_bk2,
+    GameReplayer,
+    load_audio,
+    find_integrations,
+    verify_rom,
+    register_integrations,
+)
 
 
 def test_replay_bk2(
@@ -83,3 +98,253 @@ def test_replay_bk2(
         assert np.array_equal(
             sound["audio_rate"], list_audio_rate[i]
         ), "Replayed audio rate doesn't match."
+
+
+def _record_random_bk2(
+    tmpdir,
+    game="Airstriker-Genesis",
+    scenario=None,
+    integration_path="tests/test_stimuli/dummy_custom_integration",
+    inttype=retro.data.Integrations.CUSTOM_ONLY,
+    n_steps=500,
+):
+    """Record a bk2 of random keypresses and return its path."""
+    retro.data.Integrations.add_custom_path(os.path.abspath(integration_path))
+    emulator = retro.make(game, record=str(tmpdir), inttype=inttype, scenario=scenario)
+    emulator.reset()
+    done = False
+    i = 0
+    while not done and i < n_steps:
+        key = [random() < 0.5, random() < 0.5] + [False] * 10
+        _, _, done, _ = emulator.step(key)
+        i += 1
+    emulator.close()
+    del emulator
+    return glob.glob(os.path.join(str(tmpdir), "*.bk2"))[0]
+
+
+def test_replay_bk2_array(
+    tmpdir,
+    skip_first_step=True,
+    scenario=None,
+    inttype=retro.data.Integrations.CUSTOM_ONLY,
+):
+    bk2_path = _record_random_bk2(tmpdir, scenario=scenario, inttype=inttype)
+    replay = replay_bk2_array(bk2_path, skip_first_step, scenario, inttype)
+
+    n_frames = 0
+    for i, (frame, key, annotations, sound) in enumerate(
+        replay_bk2(bk2_path, skip_first_step, scenario, inttype)
+    ):
+        assert np.array_equal(frame, replay.frames[i]), "Frame doesn't match."
+        assert key == replay.keys[i].tolist(), "Keypress doesn't match."
+        assert annotations["reward"] == replay.rewards[i], "Reward doesn't match."
+        assert annotations["done"] == replay.done[i], "Done condition doesn't match."
+        for name, value in annotations["info"].items():
+            assert value == replay.info[name][i], "Info doesn't match."
+        assert np.array_equal(sound["audio"], replay.get_audio(i)), "Audio doesn't match."
+        n_frames += 1
+    assert len(replay) == n_frames, "Number of frames doesn't match."
+    assert replay.frames.dtype == np.uint8 and replay.keys.dtype == bool
+
+
+def test_replay_many(
+    tmpdir,
+    monkeypatch,
+    integration_path="tests/test_stimuli/dummy_custom_integration",
+    inttype=retro.data.Integrations.CUSTOM_ONLY,
+):
+    # the roms are verified in the cache of the test, also by the spawned workers
+    monkeypatch.setenv("BIDS_LOADER_CACHE", os.path.join(str(tmpdir), "cache"))
+    bk2_paths = []
+    for i in range(3):
+        bk2_paths.append(_record_random_bk2(tmpdir.mkdir(str(i)), inttype=inttype))
+    replays = list(
+        replay_many(bk2_paths, n_jobs=2, integration_paths=[integration_path], inttype=inttype)
+    )
+    assert [path for path, _ in replays] == bk2_paths, "Replays are not in order."
+    for bk2_path, replay in replays:
+        expected = replay_bk2_array(bk2_path, inttype=inttype)
+        assert np.array_equal(replay.frames, expected.frames), "Frames don't match."
+        assert np.array_equal(replay.keys, expected.keys), "Keypresses don't match."
+
+
+def test_replay_bk2_cache(tmpdir, inttype=retro.data.Integrations.CUSTOM_ONLY):
+    bk2_path = _record_random_bk2(tmpdir.mkdir("bk2"), inttype=inttype)
+    cache = DiskCache(str(tmpdir.mkdir("cache")))
+    replay = replay_bk2_array(bk2_path, inttype=inttype, cache=cache)
+    assert cache.size > 0, "Replay not added to the cache."
+    cached = replay_bk2_array(bk2_path, inttype=inttype, cache=cache)
+    assert np.array_equal(cached.frames, replay.frames), "Cached frames don't match."
+    assert np.array_equal(cached.keys, replay.keys), "Cached keypresses don't match."
+    assert np.array_equal(cached.rewards, replay.rewards), "Cached rewards don't match."
+    for name, values in replay.info.items():
+        assert np.array_equal(cached.info[name], values), "Cached info doesn't match."
+    assert np.array_equal(cached.audio, replay.audio), "Cached audio doesn't match."
+    assert np.array_equal(cached.audio_offsets, replay.audio_offsets), "Cached offsets don't match."
+    for (frame, key, annotations, sound), expected in zip(
+        replay_bk2(bk2_path, inttype=inttype, cache=cache), replay_bk2(bk2_path, inttype=inttype)
+    ):
+        assert np.array_equal(frame, expected[0]), "Cached frame doesn't match."
+        assert key == expected[1], "Cached keypress doesn't match."
+        assert annotations == expected[2], "Cached annotations don't match."
+
+
+def test_replay_bk2_frames_path(tmpdir, inttype=retro.data.Integrations.CUSTOM_ONLY):
+    bk2_path = _record_random_bk2(tmpdir, inttype=inttype)
+    frames_path = os.path.join(str(tmpdir), "frames.npy")
+    replay = replay_bk2_array(bk2_path, inttype=inttype, frames_path=frames_path)
+    frames = load_frames(frames_path)
+    assert isinstance(frames, np.memmap), "Frames are not memory mapped."
+    expected = replay_bk2_array(bk2_path, inttype=inttype).frames
+    assert np.array_equal(replay.frames, expected), "Replayed frames don't match."
+    assert np.array_equal(frames[10:20], expected[10:20]), "Loaded frames don't match."
+
+
+def test_replay_bk2_frame_selection(tmpdir, inttype=retro.data.Integrations.CUSTOM_ONLY):
+    bk2_path = _record_random_bk2(tmpdir, inttype=inttype)
+    full = replay_bk2_array(bk2_path, inttype=inttype)
+    for selection in [{"frame_stride": 7}, {"target_fps": 10}, {"tr": 1.49}, {"onsets": [0.5, 2]}]:
+        replay = replay_bk2_array(bk2_path, inttype=inttype, **selection)
+        indices = replay.frame_indices
+        assert len(indices) == len(replay) > 0, "No frame kept."
+        assert np.array_equal(replay.frames, full.frames[indices]), "Kept frames don't match."
+        assert np.array_equal(replay.keys, full.keys[indices]), "Kept keypresses don't match."
+        for name, values in replay.info.items():
+            assert np.array_equal(values, full.info[name][indices]), "Kept info doesn't match."
+        rewards = np.add.reduceat(full.rewards[: indices[-1] + 1], np.r_[0, indices[:-1] + 1])
+        assert np.allclose(replay.rewards, rewards), "Accumulated rewards don't match."
+        frames = [frame for frame, _, _, _ in replay_bk2(bk2_path, inttype=inttype, **selection)]
+        assert np.array_equal(np.stack(frames), replay.frames), "Iterated frames don't match."
+
+
+def test_replay_bk2_outputs(
+    tmpdir, outputs=("keys", "info", "reward"), inttype=retro.data.Integrations.CUSTOM_ONLY
+):
+    bk2_path = _record_random_bk2(tmpdir, inttype=inttype)
+    full = replay_bk2_array(bk2_path, inttype=inttype)
+    replay = replay_bk2_array(bk2_path, inttype=inttype, outputs=outputs)
+    assert replay.frames is None and replay.audio is None, "Unrequested outputs were read."
+    assert np.array_equal(replay.keys, full.keys), "Keypresses don't match."
+    assert np.array_equal(replay.rewards, full.rewards), "Rewards don't match."
+    for name, values in full.info.items():
+        assert np.array_equal(replay.info[name], values), "Info doesn't match."
+    for frame, keys, annotations, sound in replay_bk2(bk2_path, inttype=inttype, outputs=outputs):
+        assert frame is None and sound is None, "Unrequested outputs were read."
+        assert set(annotations) == {"reward", "info"}, "Annotations don't match the outputs."
+
+
+def test_decode_ram():
+    ram = np.array([[0x12, 0x34, 0xFF, 0xFE], [0x00, 0x01, 0x80, 0x00]], dtype=np.uint8)
+    variables = {
+        "big": {"address": 0, "type": ">u2"},
+        "little": {"address": 0, "type": "<u2"},
+        "signed": {"address": 2, "type": ">i2"},
+        "bcd": {"address": 0, "type": ">d2"},
+        "three_bytes": {"address": 1, "type": ">u3"},
+    }
+    values = decode_ram(ram, variables, [(0, 4)])
+    assert values["big"].tolist() == [0x1234, 0x0001], "Big endian value doesn't match."
+    assert values["little"].tolist() == [0x3412, 0x0100], "Little endian value doesn't match."
+    assert values["signed"].tolist() == [-2, -32768], "Signed value doesn't match."
+    assert values["bcd"].tolist() == [1234, 1], "BCD value doesn't match."
+    assert values["three_bytes"].tolist() == [0x34FFFE, 0x018000], "3 bytes value doesn't match."
+    swapped = decode_ram(ram[:, [1, 0, 3, 2]], variables, [(0, 4)], ram_word_size=2)
+    for name in variables:
+        assert np.array_equal(swapped[name], values[name]), "Swapped words value doesn't match."
+
+
+def test_replay_bk2_ram(tmpdir, inttype=retro.data.Integrations.CUSTOM_ONLY):
+    bk2_path = _record_random_bk2(tmpdir, inttype=inttype)
+    full = replay_bk2_array(bk2_path, inttype=inttype)
+    replay = replay_bk2_array(bk2_path, inttype=inttype, outputs=("info", "ram"))
+    assert replay.ram.shape[0] == len(full), "Number of RAM snapshots doesn't match."
+    for name, values in full.info.items():
+        assert np.array_equal(replay.info[name], values), "Decoded info doesn't match."
+    assert replay.decode_ram().keys() == full.info.keys(), "Decoded variables don't match."
+    cache = DiskCache(str(tmpdir.mkdir("cache")))
+    for _ in range(2):
+        for (_, _, annotations, _), expected in zip(
+            replay_bk2(bk2_path, inttype=inttype, outputs=("ram",), cache=cache),
+            replay_bk2(bk2_path, inttype=inttype, outputs=("ram",)),
+        ):
+            assert np.array_equal(annotations["ram"], expected[2]["ram"]), "RAM doesn't match."
+
+
+def test_replay_bk2_checkpoints(
+    tmpdir, start=250, stop=300, inttype=retro.data.Integrations.CUSTOM_ONLY
+):
+    bk2_path = _record_random_bk2(tmpdir, inttype=inttype)
+    full = replay_bk2_array(bk2_path, inttype=inttype)
+    checkpoint_bk2(bk2_path, interval=100, inttype=inttype)
+    window = replay_bk2_array(bk2_path, inttype=inttype, start=start, stop=stop)
+    assert np.array_equal(window.frame_indices, np.arange(start, stop)), "Window doesn't match."
+    assert np.array_equal(window.frames, full.frames[start:stop]), "Frames don't match."
+    assert np.array_equal(window.keys, full.keys[start:stop]), "Keypresses don't match."
+    assert np.array_equal(window.rewards, full.rewards[start:stop]), "Rewards don't match."
+    for name, values in full.info.items():
+        assert np.array_equal(window.info[name], values[start:stop]), "Info doesn't match."
+
+
+def test_game_replayer(tmpdir, inttype=retro.data.Integrations.CUSTOM_ONLY):
+    bk2_paths = [_record_random_bk2(tmpdir.mkdir(str(i)), inttype=inttype) for i in range(3)]
+    expected = [replay_bk2_array(bk2_path, inttype=inttype) for bk2_path in bk2_paths]
+    with GameReplayer() as replayer:
+        for bk2_path, replay in zip(bk2_paths, expected):
+            replayed = replayer.replay_array(bk2_path, inttype=inttype)
+            assert np.array_equal(replayed.frames, replay.frames), "Frames don't match."
+            assert np.array_equal(replayed.rewards, replay.rewards), "Rewards don't match."
+            for i, (frame, _, _, _) in enumerate(replayer.replay(bk2_path, inttype=inttype)):
+                assert np.array_equal(frame, replay.frames[i]), "Iterated frame doesn't match."
+
+
+def test_replay_bk2_audio(tmpdir, inttype=retro.data.Integrations.CUSTOM_ONLY):
+    bk2_path = _record_random_bk2(tmpdir, inttype=inttype)
+    chunks = [sound["audio"] for _, _, _, sound in replay_bk2(bk2_path, inttype=inttype)]
+    replay = replay_bk2_array(bk2_path, inttype=inttype)
+    assert np.array_equal(replay.audio, np.concatenate(chunks)), "Audio doesn't match."
+    assert np.array_equal(
+        np.diff(replay.audio_offsets), [len(chunk) for chunk in chunks]
+    ), "Audio offsets don't match."
+    audio_path = os.path.join(str(tmpdir), "audio.wav")
+    written = replay_bk2_array(bk2_path, inttype=inttype, audio_path=audio_path)
+    assert np.array_equal(written.audio, replay.audio), "Written audio doesn't match."
+    assert np.array_equal(load_audio(audio_path), replay.audio), "Loaded audio doesn't match."
+
+
+def test_game_replayer_align_to(tmpdir, inttype=retro.data.Integrations.CUSTOM_ONLY, tr=1.49):
+    bk2_path = _record_random_bk2(tmpdir, inttype=inttype)
+    replay = replay_bk2_array(bk2_path, inttype=inttype, frame_stride=4)
+    assert np.allclose(replay.onsets, replay.frame_indices / replay.fps), "Onsets don't match."
+    with GameReplayer() as replayer:
+        stimulus = replayer.load(bk2_path, samples="rewards", inttype=inttype, frame_stride=4)
+        assert np.array_equal(stimulus.samples, replay.rewards), "Samples don't match."
+        keys = replayer.load(bk2_path, samples="keys", inttype=inttype)
+        aligned = replayer.align_to(bk2_path, tr, samples="keys", inttype=inttype)
+        assert aligned.shape == (int(np.ceil(keys.onsets[-1] / tr)), len(replay.buttons))
+        assert np.allclose(aligned[0], keys.samples[: int(tr * replay.fps) + 1].mean(axis=0))
+        audio = replayer.load(bk2_path, samples="audio", inttype=inttype)
+        assert len(audio.onsets) == len(audio.samples), "Audio onsets don't match."
+
+
+def test_integrations(
+    tmpdir, monkeypatch, integration_path="tests/test_stimuli/dummy_custom_integration"
+):
+    monkeypatch.setenv("BIDS_LOADER_CACHE", os.path.join(str(tmpdir), "cache"))
+    stimuli_path = os.path.join(str(tmpdir), "stimuli")
+    shutil.copytree(integration_path, os.path.join(stimuli_path, "games"))
+    integrations = find_integrations(stimuli_path)
+    game_path = os.path.join(stimuli_path, "games", "Airstriker-Genesis")
+    assert integrations == {"Airstriker-Genesis": game_path}, "Integrations don't match."
+    cache_path = os.path.join(str(tmpdir), "roms.json")
+    assert verify_rom(game_path, cache_path), "Rom doesn't match its hash."
+    assert os.path.exists(cache_path), "Verification is not cached."
+    with open(os.path.join(game_path, "rom.md"), "ab") as f:
+        f.write(b"\0")
+    assert not verify_rom(game_path, cache_path), "Modified rom matches its hash."
+    os.remove(os.path.join(game_path, "rom.md"))
+    assert not verify_rom(game_path, cache_path), "Missing rom matches its hash."
+    shutil.copy(os.path.join(integration_path, "Airstriker-Genesis", "rom.md"), game_path)
+    assert register_integrations(stimuli_path) == integrations
+    assert os.path.dirname(game_path) in game._registered_paths, "Path is not registered."
+    assert os.path.exists(os.path.join(str(tmpdir), "cache", "roms.json")), "Not in the cache."
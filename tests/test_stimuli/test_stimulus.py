@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+from bids_loader.stimuli.base import Stimulus, align_samples
+
+
+def test_align_samples(fps=10.0, tr=1.5):
+    onsets = np.arange(300) / fps
+    samples = np.random.rand(300, 2)
+    binned = align_samples(samples, onsets, tr)
+    assert binned.shape == (20, 2), "Shape of the binned samples doesn't match."
+    assert np.allclose(binned, samples.reshape((20, 15, 2)).mean(axis=1)), "Bins don't match."
+    padded = align_samples(samples, onsets, tr, n_volumes=22)
+    assert np.isnan(padded[20:]).all(), "Volumes after the stimulus are not NaN."
+
+    events = pd.DataFrame({"onset": [1.0, 2.05, 10.0], "duration": [0.5, 0.0, 2.0]})
+    aligned = Stimulus(samples, onsets).align_to(events)
+    expected = [samples[10:15].mean(axis=0), samples[20], samples[100:120].mean(axis=0)]
+    assert np.allclose(aligned, expected), "Events don't match."
+
+    windows = align_samples(samples, onsets, tr, mode="window", window=3)
+    assert windows.shape == (20, 3, 2), "Shape of the windows doesn't match."
+    assert np.array_equal(windows[1], samples[27:30]), "Windows don't match."
+
+    impulses = np.zeros(300)
+    impulses[0] = 1
+    convolved = align_samples(impulses, onsets, tr, mode="hrf")
+    assert convolved.shape == (20,), "Shape of the convolved samples doesn't match."
+    assert 2 <= np.argmax(convolved) * tr <= 7, "Peak of the response is not delayed."
+    slow = align_samples(np.ones(10), np.arange(10) * 3.0, tr, mode="hrf")
+    assert np.allclose(slow[-5:], slow[-1], rtol=0.05), "Slow samples are not held."
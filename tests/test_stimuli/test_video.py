@@ -0,0 +1,69 @@
+import os
+import numpy as np
+import av
+from bids_loader.stimuli.video import VideoLoader
+
+
+def _make_video(tmpdir, n_frames=100, fps=25, gop_size=10):
+    """Encode a video whose frame i has red level 2*i, and return its frames."""
+    path = os.path.join(str(tmpdir), "video.mp4")
+    frames = np.zeros((n_frames, 48, 64, 3), dtype=np.uint8)
+    frames[..., 0] = 2 * np.arange(n_frames)[:, None, None]
+    with av.open(path, "w") as container:
+        stream = container.add_stream("mpeg4", rate=fps)
+        stream.width, stream.height, stream.pix_fmt = 64, 48, "yuv420p"
+        stream.codec_context.gop_size = gop_size
+        for frame in frames:
+            for packet in stream.encode(av.VideoFrame.from_ndarray(frame, format="rgb24")):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+    return path, frames
+
+
+def test_load_frames(tmpdir):
+    path, frames = _make_video(tmpdir)
+    loader = VideoLoader(os.path.join(str(tmpdir), "cache"))
+    index = loader.get_index(path)
+    assert len(index) == 100 and np.isclose(index.fps, 25), "Index doesn't match."
+    assert len(os.listdir(os.path.join(str(tmpdir), "cache"))) == 1, "Index is not cached."
+    all_frames = loader.load_frames(path)
+    assert all_frames.shape == frames.shape and all_frames.dtype == np.uint8
+    red = all_frames[..., 0].mean(axis=(1, 2))
+    assert np.allclose(red, frames[..., 0].mean(axis=(1, 2)), atol=4), "Frames don't match."
+
+    selected = loader.load_frames(path, tr=1.5, size=(32, 24))
+    assert selected.shape == (3, 24, 32, 3), "Shape of the resized frames doesn't match."
+    assert np.array_equal(selected, loader.load_frames(path, size=(32, 24))[[0, 37, 75]])
+    onsets = [3.0, 0.5, 0.51, 2.0]
+    selected = loader.load_frames(path, onsets=onsets)
+    assert np.array_equal(selected, all_frames[[75, 12, 12, 50]]), "Frames at onsets don't match."
+    gray = loader.load_frames(path, frame_stride=10, format="gray")
+    assert gray.shape == (10, 48, 64), "Shape of the gray frames doesn't match."
+
+
+def test_iter_batches(tmpdir):
+    path, _ = _make_video(tmpdir)
+    loader = VideoLoader(os.path.join(str(tmpdir), "cache"))
+    expected = loader.load_frames(path, target_fps=10, size=(32, 24), crop=(4, 8, 16, 16))
+    assert expected.shape == (40, 16, 16, 3), "Shape of the cropped frames doesn't match."
+    batches = loader.iter_batches(
+        path, batch_size=7, target_fps=10, size=(32, 24), crop=(4, 8, 16, 16), n_threads=3
+    )
+    frames = np.concatenate([batch.copy() for _, batch in batches])
+    assert np.array_equal(frames, expected), "Batches don't match."
+    for start, batch in loader.iter_batches(path, batch_size=8, n_threads=2, n_buffers=2):
+        if start == 16:
+            break
+    assert np.array_equal(batch, loader.load_frames(path)[16:24]), "Batch doesn't match."
+
+
+def test_align_to(tmpdir):
+    path, frames = _make_video(tmpdir)
+    loader = VideoLoader(os.path.join(str(tmpdir), "cache"))
+    stimulus = loader.load(path, frame_stride=5, format="gray")
+    assert np.allclose(stimulus.onsets, np.arange(0, 100, 5) / 25), "Onsets don't match."
+    aligned = loader.align_to(path, 1.0, format="gray", size=(8, 6))
+    assert aligned.shape == (4, 6, 8), "Shape of the aligned frames doesn't match."
+    brightness = aligned.mean(axis=(1, 2))
+    assert np.all(np.diff(brightness) > 0), "Frames are not aligned in order."
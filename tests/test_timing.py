@@ -0,0 +1,31 @@
+import numpy as np
+from bids_loader.timing import sample_index, window_mean
+
+
+def test_window_mean():
+    times = np.sort(np.random.rand(1000) * 10)
+    values = np.random.rand(1000, 3)
+    starts, stops = np.array([0, 2.5, 7, 11]), np.array([1, 5, 7.5, 12])
+    means = window_mean(times, values, starts, stops)
+    for start, stop, mean in zip(starts[:3], stops[:3], means[:3]):
+        expected = values[(times >= start) & (times < stop)].mean(axis=0)
+        assert np.allclose(mean, expected), "Window means don't match."
+    assert np.isnan(means[3]).all(), "Empty windows are not NaN."
+    assert np.array_equal(sample_index(np.arange(5.0), [-1, 0, 2.5, 10]), [0, 0, 2, 4])
+
+
+def test_window_mean_chunks():
+    times = np.arange(100) / 10
+    values = np.random.randint(0, 256, size=(100, 4, 3), dtype=np.uint8)
+    # overlapping and empty windows, and windows outside of the samples
+    starts, stops = np.array([-1, 0.5, 2, 2.5, 4, 9.5, 12]), np.array([0.3, 3, 4, 2.5, 9, 11, 13])
+    expected = window_mean(times, values.astype(float), starts, stops)
+    for chunk_size in [1, 7, 1000]:
+        means = window_mean(times, values, starts, stops, chunk_size=chunk_size)
+        assert np.allclose(means, expected, equal_nan=True), "Chunked means don't match."
+    for start, stop, mean in zip(starts, stops, expected):
+        window = (times >= start) & (times < stop)
+        if window.any():
+            assert np.allclose(mean, values[window].mean(axis=0)), "Window means don't match."
+        else:
+            assert np.isnan(mean).all(), "Empty windows are not NaN."